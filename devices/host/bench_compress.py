@@ -0,0 +1,113 @@
+'''
+Compression ratio of compress.py on synthetic but realistic sensor traces:
+a day of readings every 60 s with a few ms of scheduling jitter.
+
+    python3 devices/host/bench_compress.py --hours 24 --interval 60
+
+For every trace reports the raw size (32 bit timestamp + 32 bit value per
+sample), the compressed size, the ratio, bits per sample, and how many
+samples fit one 255 byte LoRa frame behind the codec header.
+'''
+import hostpath  # noqa: F401
+
+import argparse
+import math
+import random
+
+import codec
+import compress
+from sx127x import MAX_PKT_LENGTH
+
+RAW_SAMPLE_SIZE = 8
+
+
+def timestamps(count, interval_ms, jitter_ms):
+    at = 1560668066000
+    for i in range(count):
+        yield (at + i * interval_ms + int(random.gauss(0, jitter_ms))) & 0xffffffff
+
+
+def traces(count, interval_ms, jitter_ms):
+    day = 24 * 3600 * 1000 / interval_ms
+
+    def temperature(i):
+        return 20 + 4 * math.sin(2 * math.pi * i / day) + random.gauss(0, 0.05)
+
+    humidity = 55.0
+    pressure = 101325
+    battery = 4150
+    traces = {'temperature_c (float)': (compress.KIND_FLOAT, []),
+              'temperature_c x100 (int)': (compress.KIND_INTEGER, []),
+              'humidity_pct x10 (int)': (compress.KIND_INTEGER, []),
+              'pressure_pa (int)': (compress.KIND_INTEGER, []),
+              'battery_mv (int)': (compress.KIND_INTEGER, []),
+              'counter (int)': (compress.KIND_INTEGER, [])}
+    for i, at in enumerate(timestamps(count, interval_ms, jitter_ms)):
+        t = temperature(i)
+        humidity = min(100.0, max(0.0, humidity + random.gauss(0, 0.2)))
+        pressure += int(random.gauss(0, 8))
+        if random.random() < 0.05:
+            battery -= 1
+        traces['temperature_c (float)'][1].append((at, round(t, 2)))
+        traces['temperature_c x100 (int)'][1].append((at, round(t * 100)))
+        traces['humidity_pct x10 (int)'][1].append((at, round(humidity * 10)))
+        traces['pressure_pa (int)'][1].append((at, pressure))
+        traces['battery_mv (int)'][1].append((at, battery))
+        traces['counter (int)'][1].append((at, i))
+    return traces
+
+
+def compress_trace(kind, samples):
+    # frame by frame as a node would send them; returns (bytes, frames)
+    buffer = bytearray(MAX_PKT_LENGTH)
+    total = 0
+    frames = 0
+    pending = list(samples)
+    while pending:
+        offset = codec.SERIES.encode_into(buffer, 1, frames, (0, 0))  # sent_ms does not matter here
+        encoder = compress.SeriesEncoder(buffer, kind, offset)
+        taken = 0
+        while taken < len(pending) and encoder.add(*pending[taken]):
+            taken += 1
+        length = encoder.finish()
+
+        decoded = []
+        compress.decode(memoryview(buffer)[:length], lambda at, value: decoded.append((at, value)), offset)
+        check(kind, pending[:taken], decoded)
+
+        total += length - offset
+        frames += 1
+        pending = pending[taken:]
+    return total, frames
+
+
+def check(kind, expected, decoded):
+    if len(expected) != len(decoded):
+        raise Exception('Decoded {} samples, expected {}.'.format(len(decoded), len(expected)))
+    for (at, value), (decoded_at, decoded_value) in zip(expected, decoded):
+        if at != decoded_at or (value != decoded_value if kind == compress.KIND_INTEGER
+                                else abs(value - decoded_value) > 1e-5 * max(1.0, abs(value))):
+            raise Exception('Sample ({}, {}) decoded as ({}, {}).'.format(at, value, decoded_at, decoded_value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hours', type=float, default=24.0)
+    parser.add_argument('--interval', type=float, default=60.0, help='seconds between readings')
+    parser.add_argument('--jitter', type=float, default=3.0, help='ms standard deviation of the timestamps')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    count = int(args.hours * 3600 / args.interval)
+    print('{:<26} {:>8} {:>8} {:>11} {:>7} {:>12} {:>16}'.format(
+        'trace', 'samples', 'raw B', 'compressed', 'ratio', 'bits/sample', 'samples/frame'))
+    for name, (kind, samples) in traces(count, int(args.interval * 1000), args.jitter).items():
+        size, frames = compress_trace(kind, samples)
+        raw = RAW_SAMPLE_SIZE * len(samples)
+        print('{:<26} {:>8} {:>8} {:>11} {:>7.2f} {:>12.1f} {:>16.1f}'.format(
+            name, len(samples), raw, size, raw / size, 8.0 * size / len(samples), len(samples) / frames))
+
+
+if __name__ == '__main__':
+    main()
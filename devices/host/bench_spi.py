@@ -0,0 +1,66 @@
+'''
+SPI cost of the SX127x driver per operation, measured on the emulator.
+Run from anywhere with: python3 devices/host/bench_spi.py
+'''
+import hostpath  # noqa: F401
+
+from controller_emulated import EmulatedController
+from radio_engine import RadioEngine
+from sx127x import SX127x
+
+
+def measure(radio, label, operation):
+    radio.reset_counters()
+    operation()
+    print('{:<40} {:>6} transactions {:>6} bytes'.format(label, radio.spi_transactions, radio.spi_bytes))
+
+
+def main():
+    controller = EmulatedController()
+    radio = None
+
+    def add():
+        nonlocal radio
+        lora = controller.add_transceiver(SX127x(name='LoRa'),
+                                          pin_id_ss=EmulatedController.PIN_ID_FOR_LORA_SS,
+                                          pin_id_RxDone=EmulatedController.PIN_ID_FOR_LORA_DIO0)
+        radio = controller.radios[EmulatedController.PIN_ID_FOR_LORA_SS]
+        return lora
+
+    lora = add()
+    measure(radio, 'init()', lora.init)
+
+    for size in (16, 64, 255):
+        payload = bytes(range(size % 256)) if size < 256 else bytes(255)
+
+        def send():
+            lora.beginPacket()
+            lora.write(payload)
+            lora.endPacket()
+        measure(radio, 'send {} bytes'.format(size), send)
+
+    for size in (16, 64, 255):
+        payload = bytes(size)
+        lora.receive()
+        radio.deliver(payload)
+        measure(radio, 'receivedPacket() + read_payload() {}'.format(size),
+                lambda: lora.receivedPacket() and lora.read_payload())
+
+    engine = RadioEngine(lora)
+    engine.start()
+    received = []
+    for size in (16, 255):
+        measure(radio, 'RadioEngine interrupt receive {}'.format(size),
+                lambda: radio.deliver(bytes(size)))
+        engine.read_batch(lambda payload, rssi, snr, timestamp: received.append(bytes(payload)))
+    engine.stop()
+
+    lora.standby()
+    measure(radio, 'configure() SF12 -> SF7, 14 dBm',
+            lambda: lora.configure({'spreading_factor': 7, 'tx_power_level': 14}))
+    measure(radio, 'configure() unchanged',
+            lambda: lora.configure({'spreading_factor': 7, 'tx_power_level': 14}))
+
+
+if __name__ == '__main__':
+    main()
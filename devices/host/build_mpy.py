@@ -0,0 +1,57 @@
+'''
+Precompile shared/ to .mpy bytecode with mpy-cross, for boards running a
+stock firmware: copy the output directory to the board as /shared and the
+modules import without being compiled on the device at every boot.
+(With a custom firmware, freeze them instead, see devices/manifest.py.)
+
+    python3 devices/host/build_mpy.py --output build/shared
+
+mpy-cross must match the firmware's bytecode version; it comes with the
+MicroPython sources or from pip (mpy-cross).
+'''
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+SHARED = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared')
+
+
+def mpy_cross_command(executable):
+    if executable:
+        return [executable]
+    if shutil.which('mpy-cross'):
+        return ['mpy-cross']
+    try:
+        import mpy_cross  # noqa: F401
+    except ImportError:
+        raise SystemExit('mpy-cross not found, install it (pip install mpy-cross) or pass --mpy-cross')
+    return [sys.executable, '-m', 'mpy_cross']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default='build/shared')
+    parser.add_argument('--mpy-cross', default='', help='path of the mpy-cross executable')
+    parser.add_argument('--opt', type=int, default=3, help='optimisation level, 3 drops asserts and line numbers')
+    args = parser.parse_args()
+
+    command = mpy_cross_command(args.mpy_cross)
+    os.makedirs(args.output, exist_ok=True)
+    source_bytes = 0
+    output_bytes = 0
+    for name in sorted(os.listdir(SHARED)):
+        if not name.endswith('.py'):
+            continue
+        source = os.path.join(SHARED, name)
+        output = os.path.join(args.output, name[:-3] + '.mpy')
+        subprocess.run(command + ['-O{}'.format(args.opt), '-o', output, source], check=True)
+        source_bytes += os.path.getsize(source)
+        output_bytes += os.path.getsize(output)
+        print('{:<24} {:>7} -> {:>7} bytes'.format(name, os.path.getsize(source), os.path.getsize(output)))
+    print('{:<24} {:>7} -> {:>7} bytes'.format('total', source_bytes, output_bytes))
+
+
+if __name__ == '__main__':
+    main()
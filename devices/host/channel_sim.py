@@ -0,0 +1,276 @@
+'''
+Discrete event simulation of many nodes sharing one channel with a hub.
+Nodes and hub are the real SX127x driver and RadioEngine on emulated
+radios; the simulator only plays the air in between: time on air, path
+loss, receiver sensitivity, SF orthogonality and the capture effect.
+
+    python3 devices/host/channel_sim.py --nodes 10 50 100 200 --interval 60
+
+Reports delivery ratio, latency percentiles (start of transmission to the
+hub application), channel utilisation, the airtime offered to the
+busiest frequency / SF channel per unit time (above 1 means transmissions
+must overlap), and throughput, the airtime delivered on it per unit time,
+for each node count.
+
+With --tdma nodes send in the slots tdma.SlotSchedule assigns them, once
+per interval, off by --clock-error ms (standard deviation) as a node
+disciplined by beacons would be, instead of pure ALOHA; beacons themselves
+are not simulated, their window at the start of each period stays free.
+Neither are downlinks, the room slots keep for them stays unused.
+'''
+import hostpath  # noqa: F401
+
+import argparse
+import heapq
+import math
+import random
+import struct
+
+from airtime import time_on_air_ms
+from controller_emulated import EmulatedController
+from hub_radios import MultiRadioHub
+from radio_engine import RadioEngine, PacketRing
+from sx127x import SX127x
+from tdma import SlotSchedule
+
+FRAME = struct.Struct('<HH')  # node, sequence
+
+# sensitivity at 125 kHz per spreading factor (SX1276 datasheet, table 13)
+SENSITIVITY_DBM = {6: -118.0, 7: -123.0, 8: -126.0, 9: -129.0, 10: -132.0, 11: -134.5, 12: -137.0}
+NOISE_FIGURE_DB = 6.0
+
+
+def parameters(spreading_factor, frequency=915E6, bandwidth=125E3, tx_power=14):
+    return {'frequency': frequency, 'tx_power_level': tx_power, 'signal_bandwidth': bandwidth,
+            'spreading_factor': spreading_factor, 'coding_rate': 5, 'preamble_length': 8,
+            'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': True}
+
+
+def path_loss_db(distance_m, shadowing_db=0.0):
+    # log-distance model fitted to LoRa measurements (Bor et al., 2016)
+    return 127.41 + 10 * 2.08 * math.log10(max(distance_m, 1.0) / 40.0) + shadowing_db
+
+
+def sensitivity_dbm(spreading_factor, bandwidth):
+    return SENSITIVITY_DBM[spreading_factor] + 10 * math.log10(bandwidth / 125E3)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Transmission:
+    __slots__ = ('node', 'start', 'end', 'modem', 'rssi', 'payload')
+
+    def __init__(self, node, start, end, modem, rssi, payload):
+        self.node = node
+        self.start = start
+        self.end = end
+        self.modem = modem
+        self.rssi = rssi
+        self.payload = payload
+
+
+class Node:
+
+    def __init__(self, simulation, node_id, distance_m, spreading_factor, tx_power):
+        self.node_id = node_id
+        self.sequence = 0
+        self.rssi_at_hub = tx_power - path_loss_db(distance_m, random.gauss(0, simulation.shadowing_db))
+
+        controller = EmulatedController(on_transmit=simulation.on_transmit)
+        self.lora = controller.add_transceiver(
+            SX127x(name='node{}'.format(node_id), parameters=parameters(spreading_factor, tx_power=tx_power)),
+            pin_id_ss=EmulatedController.PIN_ID_FOR_LORA_SS,
+            pin_id_RxDone=EmulatedController.PIN_ID_FOR_LORA_DIO0)
+        self.radio = controller.radios[EmulatedController.PIN_ID_FOR_LORA_SS]
+        self.radio.node = self
+        self.slot_ms = -1  # nominal start of the next TDMA transmission
+
+    def send(self, payload_size):
+        payload = bytearray(payload_size)
+        FRAME.pack_into(payload, 0, self.node_id, self.sequence & 0xffff)
+        self.sequence += 1
+
+        self.lora.beginPacket()
+        self.lora.write(payload)
+        self.lora.endPacket()
+
+
+class ChannelSimulation:
+
+    def __init__(self, nodes, interval_ms, duration_ms, payload_size=20, hub_spreading_factors=(7, 9, 12),
+                 radius_m=250, capture_db=6.0, shadowing_db=0.0, jitter=0.1, tdma=False,
+                 clock_error_ms=2.0, seed=1):
+        random.seed(seed)
+        self.interval_ms = interval_ms
+        self.duration_ms = duration_ms
+        self.payload_size = payload_size
+        self.capture_db = capture_db
+        self.shadowing_db = shadowing_db
+        self.jitter = jitter
+        self.clock_error_ms = clock_error_ms
+        self.now = 0.0
+
+        self._events = []
+        self._order = 0
+        self._on_air = []
+        self._longest = 0.0
+        self._starts = {}
+
+        self.sent = 0
+        self.lost = {'sensitivity': 0, 'collision': 0, 'overflow': 0}
+        self.latencies = []
+        self.airtime = {}
+        self.carried = {}
+
+        # hub: one radio per spreading factor on a shared bus, read as one stream
+        controller = EmulatedController()
+        self.hub = []
+        engines = []
+        for i, sf in enumerate(sorted(hub_spreading_factors)):
+            lora = controller.add_transceiver(SX127x(name='hub{}'.format(i), parameters=parameters(sf)),
+                                              pin_id_ss=100 + i, pin_id_RxDone=200 + i)
+            engine = RadioEngine(lora, ring=PacketRing(capacity=4))
+            engines.append(engine)
+            self.hub.append((controller.radios[100 + i], engine, sf))
+        self.hub_radios = MultiRadioHub(engines)
+        self.hub_radios.start()
+
+        # nodes: evenly over a disc, each on the fastest SF of the hub its link budget allows
+        self.slots = SlotSchedule(period_ms=interval_ms, payload_size=payload_size) if tdma else None
+        self.nodes = []
+        for node_id in range(nodes):
+            distance = radius_m * math.sqrt(random.random())
+            rssi = 14 - path_loss_db(distance)
+            usable = [sf for (_, _, sf) in self.hub if rssi > sensitivity_dbm(sf, 125E3) + 3]
+            sf = usable[0] if usable else self.hub[-1][2]
+            node = Node(self, node_id, distance, sf, 14)
+            self.nodes.append(node)
+            slot = self.slots.assign(node_id, node.lora.parameters) if tdma else None
+            if slot:
+                node.slot_ms = slot[0] + self.slots.guard_ms
+                self.schedule(self._slot_error(node.slot_ms), self.on_send, node)
+            else:
+                self.schedule(random.uniform(0, interval_ms), self.on_send, node)
+
+    def schedule(self, at, action, argument):
+        self._order += 1
+        heapq.heappush(self._events, (at, self._order, action, argument))
+
+    def run(self):
+        while self._events:
+            at, _, action, argument = heapq.heappop(self._events)
+            if at > self.duration_ms:
+                break
+            self.now = at
+            action(argument)
+        return self.report()
+
+    def _slot_error(self, at):
+        return max(at + random.gauss(0, self.clock_error_ms), self.now)
+
+    def on_send(self, node):
+        node.send(self.payload_size)
+        if node.slot_ms >= 0:
+            node.slot_ms += self.interval_ms
+            self.schedule(self._slot_error(node.slot_ms), self.on_send, node)
+            return
+        toa = time_on_air_ms(node.lora.parameters, self.payload_size)
+        wait = self.interval_ms * (1 + random.uniform(-self.jitter, self.jitter))
+        self.schedule(self.now + max(wait, toa), self.on_send, node)
+
+    def on_transmit(self, radio, payload):
+        # called from the node's emulated radio when it enters TX mode
+        node = radio.node
+        toa = time_on_air_ms(node.lora.parameters, len(payload))
+        transmission = Transmission(node, self.now, self.now + toa, radio.modem(), node.rssi_at_hub, payload)
+        self.sent += 1
+        self.airtime[transmission.modem] = self.airtime.get(transmission.modem, 0) + toa
+        self._starts[payload[:FRAME.size]] = self.now
+        self._longest = max(self._longest, toa)
+        self._on_air.append(transmission)
+        self.schedule(transmission.end, self.on_end, transmission)
+
+    def on_end(self, transmission):
+        # anything that ended more than one airtime ago can no longer overlap
+        self._on_air = [t for t in self._on_air if t.end > self.now - self._longest]
+        modem = transmission.modem
+        sf = modem[2]
+        bandwidth = 125E3
+
+        if transmission.rssi < sensitivity_dbm(sf, bandwidth):
+            self.lost['sensitivity'] += 1
+            return
+
+        # only transmissions on the same frequency and SF interfere (SF orthogonality),
+        # and the strongest survives if it is capture_db above every other one.
+        for other in self._on_air:
+            if other is transmission or other.modem != modem:
+                continue
+            if other.start < transmission.end and other.end > transmission.start:
+                if transmission.rssi - other.rssi < self.capture_db:
+                    self.lost['collision'] += 1
+                    return
+
+        noise = -174 + 10 * math.log10(bandwidth) + NOISE_FIGURE_DB
+        for radio, engine, _ in self.hub:
+            if radio.deliver(transmission.payload, rssi=transmission.rssi,
+                             snr=min(transmission.rssi - noise, 12.0), modem=modem):
+                self.carried[modem] = self.carried.get(modem, 0) + transmission.end - transmission.start
+                overflows = engine.ring.overflows
+                self.hub_radios.read_batch(self.on_packet)
+                if engine.ring.overflows != overflows:
+                    self.lost['overflow'] += 1
+                return
+
+        self.lost['sensitivity'] += 1  # no hub radio listening on that SF
+
+    def on_packet(self, radio_name, payload, rssi, snr, timestamp):
+        start = self._starts.pop(bytes(payload[:FRAME.size]), None)
+        if start is not None:
+            self.latencies.append(self.now - start)
+
+    def report(self):
+        delivered = len(self.latencies)
+        busiest = max(self.airtime.values()) if self.airtime else 0
+        carried = max(self.carried.values()) if self.carried else 0
+        return {'nodes': len(self.nodes), 'sent': self.sent, 'delivered': delivered,
+                'delivery_ratio': delivered / self.sent if self.sent else float('nan'),
+                'latency_p50_ms': percentile(self.latencies, 0.50),
+                'latency_p95_ms': percentile(self.latencies, 0.95),
+                'latency_p99_ms': percentile(self.latencies, 0.99),
+                'utilisation': busiest / self.now if self.now else 0.0,
+                'throughput': carried / self.now if self.now else 0.0,
+                'lost': dict(self.lost)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 50, 100, 200])
+    parser.add_argument('--interval', type=float, default=60.0, help='seconds between sends per node')
+    parser.add_argument('--duration', type=float, default=3600.0, help='simulated seconds')
+    parser.add_argument('--payload', type=int, default=20, help='bytes per packet')
+    parser.add_argument('--hub-sf', type=int, nargs='+', default=[7, 9, 12])
+    parser.add_argument('--radius', type=float, default=250.0, help='metres')
+    parser.add_argument('--shadowing', type=float, default=0.0, help='dB standard deviation')
+    parser.add_argument('--tdma', action='store_true', help='send in beacon scheduled slots')
+    parser.add_argument('--clock-error', type=float, default=2.0, help='ms standard deviation in --tdma')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:>9} {:>7} {:>9} {:>9} {:>9} {:>6} {:>6}  lost'.format(
+        'nodes', 'sent', 'delivered', 'ratio', 'p50 ms', 'p95 ms', 'p99 ms', 'util', 'thru'))
+    for nodes in args.nodes:
+        result = ChannelSimulation(nodes, args.interval * 1000, args.duration * 1000, args.payload,
+                                   args.hub_sf, args.radius, shadowing_db=args.shadowing,
+                                   tdma=args.tdma, clock_error_ms=args.clock_error, seed=args.seed).run()
+        print('{nodes:>6} {sent:>8} {delivered:>9} {delivery_ratio:>7.3f} {latency_p50_ms:>9.1f} '
+              '{latency_p95_ms:>9.1f} {latency_p99_ms:>9.1f} {utilisation:>6.3f} {throughput:>6.3f}  {lost}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Scenario checks for dedup.Deduplicator: retransmissions, frames heard
+twice, reordering, sequence wraparound and node reboots.
+
+    python3 devices/host/check_dedup.py
+
+Prints one line per scenario and exits non-zero if any fails.
+'''
+import hostpath  # noqa: F401
+
+import sys
+
+from dedup import Deduplicator, WINDOW_BITS
+
+
+def accepted(dedup, node_id, sequences):
+    return [sequence for sequence in sequences if dedup.check(node_id, sequence)]
+
+
+def repeats():
+    dedup = Deduplicator()
+    got = accepted(dedup, 1, [0, 1, 1, 2, 0, 2, 3])
+    return got == [0, 1, 2, 3], got
+
+
+def reordering():
+    dedup = Deduplicator()
+    oldest = (5 - WINDOW_BITS) & 0xffff
+    got = accepted(dedup, 1, [5, 3, 4, 3, oldest, oldest])
+    return got == [5, 3, 4, oldest], got
+
+
+def wraparound():
+    dedup = Deduplicator()
+    got = accepted(dedup, 1, [0xfffe, 0xffff, 0, 0xffff, 1])
+    return got == [0xfffe, 0xffff, 0, 1], got
+
+
+def reboot():
+    # 500 frames, then the node restarts at 0: every new frame must pass
+    dedup = Deduplicator()
+    before = accepted(dedup, 1, range(500))
+    after = accepted(dedup, 1, range(500))
+    return len(before) == 500 and len(after) == 500 and dedup.restarts == 1, \
+        '{} + {} accepted, {} restarts'.format(len(before), len(after), dedup.restarts)
+
+
+def reboot_repeats():
+    # after the restart, repeats of the new sequence numbers are still dropped
+    dedup = Deduplicator()
+    accepted(dedup, 1, range(100))
+    got = accepted(dedup, 1, [0, 0, 1, 1, 2])
+    return got == [0, 1, 2], got
+
+
+def main():
+    failed = 0
+    for check in (repeats, reordering, wraparound, reboot, reboot_repeats):
+        ok, detail = check()
+        failed += not ok
+        print('{:<16} {}  {}'.format(check.__name__, 'ok' if ok else 'FAILED', detail))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
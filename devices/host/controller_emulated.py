@@ -0,0 +1,346 @@
+from _thread import allocate_lock
+from controller import Controller
+
+# registers and bits the emulator gives behaviour to, see sx127x.py
+REG_FIFO = 0x00
+REG_OP_MODE = 0x01
+REG_FIFO_ADDR_PTR = 0x0d
+REG_FIFO_TX_BASE_ADDR = 0x0e
+REG_FIFO_RX_BASE_ADDR = 0x0f
+REG_FIFO_RX_CURRENT_ADDR = 0x10
+REG_IRQ_FLAGS = 0x12
+REG_RX_NB_BYTES = 0x13
+REG_PKT_SNR_VALUE = 0x19
+REG_PKT_RSSI_VALUE = 0x1a
+REG_MODEM_CONFIG_1 = 0x1d
+REG_MODEM_CONFIG_2 = 0x1e
+REG_PAYLOAD_LENGTH = 0x22
+REG_SYNC_WORD = 0x39
+REG_DIO_MAPPING_1 = 0x40
+REG_DIO_MAPPING_2 = 0x41
+REG_VERSION = 0x42
+
+MODE_MASK = 0x07
+MODE_SLEEP = 0x00
+MODE_STDBY = 0x01
+MODE_TX = 0x03
+MODE_RX_CONTINUOUS = 0x05
+MODE_RX_SINGLE = 0x06
+MODE_CAD = 0x07
+
+IRQ_CAD_DETECTED_MASK = 0x01
+IRQ_CAD_DONE_MASK = 0x04
+IRQ_TX_DONE_MASK = 0x08
+IRQ_PAYLOAD_CRC_ERROR_MASK = 0x20
+IRQ_RX_DONE_MASK = 0x40
+IRQ_RX_TIME_OUT_MASK = 0x80
+
+# LoRa mode reset values of the registers the driver touches (SX1276 datasheet, table 41)
+RESET_VALUES = {REG_OP_MODE: 0x09, 0x06: 0x6c, 0x07: 0x80, 0x08: 0x00, 0x09: 0x4f, 0x0c: 0x20,
+                REG_FIFO_TX_BASE_ADDR: 0x80, REG_MODEM_CONFIG_1: 0x72, REG_MODEM_CONFIG_2: 0x70,
+                0x20: 0x00, 0x21: 0x08, REG_PAYLOAD_LENGTH: 0x01, 0x26: 0x04, 0x31: 0xc3,
+                0x37: 0x0a, REG_SYNC_WORD: 0x12, REG_VERSION: 0x12}
+
+# DIO index => (mapping register, shift, {mapping: irq mask}) for the events modelled
+DIO_EVENTS = ((REG_DIO_MAPPING_1, 6, {0x00: IRQ_RX_DONE_MASK, 0x01: IRQ_TX_DONE_MASK, 0x02: IRQ_CAD_DONE_MASK}),
+              (REG_DIO_MAPPING_1, 4, {0x00: IRQ_RX_TIME_OUT_MASK}),
+              (REG_DIO_MAPPING_1, 2, {}),
+              (REG_DIO_MAPPING_1, 0, {0x00: IRQ_CAD_DONE_MASK}),
+              (REG_DIO_MAPPING_2, 6, {0x00: IRQ_CAD_DETECTED_MASK}),
+              (REG_DIO_MAPPING_2, 4, {}))
+
+
+class SX127xEmulator:
+    '''
+    Register level model of an SX127x in LoRa mode.
+    Models op modes, the FIFO and its pointers, IRQ flags (write 1 to clear)
+    and DIO rising edges, and counts every SPI transaction. Packets leave
+    through on_transmit(emulator, payload) and arrive through deliver().
+    TX and CAD complete immediately unless auto_complete is False, in which
+    case complete_tx() / complete_cad() end them.
+    '''
+
+    def __init__(self, name='SX127x', on_transmit=None, auto_complete=True):
+        self.name = name
+        self.on_transmit = on_transmit
+        self.auto_complete = auto_complete
+        self.channel_busy = False
+        self.dio = [None] * 6
+        self.reset()
+
+    def reset(self):
+        self.registers = bytearray(128)
+        for address, value in RESET_VALUES.items():
+            self.registers[address] = value
+        self.fifo = bytearray(256)
+        self.transmitted = []
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.spi_transactions = 0
+        self.spi_bytes = 0
+        self.register_reads = [0] * 128
+        self.register_writes = [0] * 128
+
+    # SPI side
+
+    def transfer(self, address, value=0x00):
+        self.spi_transactions += 1
+        self.spi_bytes += 2
+        if address & 0x80:
+            self.write(address & 0x7f, value)
+            return bytearray(1)
+        return bytearray((self.read(address & 0x7f),))
+
+    def read_burst(self, address, buffer):
+        self.spi_transactions += 1
+        self.spi_bytes += 1 + len(buffer)
+        address &= 0x7f
+        for i in range(len(buffer)):
+            buffer[i] = self.read(address if address == REG_FIFO else address + i)
+
+    def write_burst(self, address, buffer):
+        self.spi_transactions += 1
+        self.spi_bytes += 1 + len(buffer)
+        address &= 0x7f
+        for i in range(len(buffer)):
+            self.write(address if address == REG_FIFO else address + i, buffer[i])
+
+    def read(self, address):
+        self.register_reads[address] += 1
+        if address == REG_FIFO:
+            pointer = self.registers[REG_FIFO_ADDR_PTR]
+            self.registers[REG_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+            return self.fifo[pointer]
+        return self.registers[address]
+
+    def write(self, address, value):
+        self.register_writes[address] += 1
+        if address == REG_FIFO:
+            pointer = self.registers[REG_FIFO_ADDR_PTR]
+            self.fifo[pointer] = value
+            self.registers[REG_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+        elif address == REG_IRQ_FLAGS:
+            self.registers[REG_IRQ_FLAGS] &= ~value & 0xff
+        elif address == REG_VERSION:
+            pass  # read only
+        elif address == REG_OP_MODE:
+            self.registers[REG_OP_MODE] = value
+            self._enter_mode(value & MODE_MASK)
+        else:
+            self.registers[address] = value
+
+    # radio side
+
+    def mode(self):
+        return self.registers[REG_OP_MODE] & MODE_MASK
+
+    def _set_mode(self, mode):
+        self.registers[REG_OP_MODE] = (self.registers[REG_OP_MODE] & ~MODE_MASK) | mode
+
+    def _enter_mode(self, mode):
+        if mode == MODE_TX:
+            length = self.registers[REG_PAYLOAD_LENGTH]
+            base = self.registers[REG_FIFO_TX_BASE_ADDR]
+            payload = bytes(self.fifo[(base + i) & 0xff] for i in range(length))
+            self.transmitted.append(payload)
+            if self.on_transmit:
+                self.on_transmit(self, payload)
+            if self.auto_complete:
+                self.complete_tx()
+        elif mode == MODE_CAD:
+            if self.auto_complete:
+                self.complete_cad(self.channel_busy)
+
+    def complete_tx(self):
+        # standby automatically on TX_DONE
+        self._set_mode(MODE_STDBY)
+        self.raise_irq(IRQ_TX_DONE_MASK)
+
+    def complete_cad(self, detected=False):
+        self._set_mode(MODE_STDBY)
+        self.raise_irq(IRQ_CAD_DONE_MASK | (IRQ_CAD_DETECTED_MASK if detected else 0))
+
+    def rx_timeout(self):
+        if self.mode() == MODE_RX_SINGLE:
+            self._set_mode(MODE_STDBY)
+            self.raise_irq(IRQ_RX_TIME_OUT_MASK)
+
+    def modem(self):
+        # (frequency, bandwidth bits, spreading factor, sync word): must match to demodulate
+        return (self.frequency(),
+                self.registers[REG_MODEM_CONFIG_1] >> 4,
+                self.registers[REG_MODEM_CONFIG_2] >> 4,
+                self.registers[REG_SYNC_WORD])
+
+    def frequency(self):
+        frf = (self.registers[0x06] << 16) | (self.registers[0x07] << 8) | self.registers[0x08]
+        return frf * 32E6 / 2**19
+
+    def implicit_header(self):
+        return bool(self.registers[REG_MODEM_CONFIG_1] & 0x01)
+
+    def deliver(self, payload, rssi=-60, snr=9.5, modem=None, crc_error=False):
+        # a packet arrives from the air, True if the radio was listening for it.
+        if self.mode() not in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE):
+            return False
+        if modem is not None and modem != self.modem():
+            return False
+
+        if self.implicit_header():
+            length = self.registers[REG_PAYLOAD_LENGTH]
+            payload = bytes(payload[:length]) + bytes(max(length - len(payload), 0))
+
+        if self.mode() == MODE_RX_CONTINUOUS:
+            # continuous mode keeps filling the FIFO where the last packet ended
+            start = (self.registers[REG_FIFO_RX_CURRENT_ADDR] + self.registers[REG_RX_NB_BYTES]) & 0xff
+        else:
+            start = self.registers[REG_FIFO_RX_BASE_ADDR]
+            self._set_mode(MODE_STDBY)
+
+        for i in range(len(payload)):
+            self.fifo[(start + i) & 0xff] = payload[i]
+        self.registers[REG_FIFO_RX_CURRENT_ADDR] = start
+        self.registers[REG_RX_NB_BYTES] = len(payload)
+        offset = 164 if self.frequency() < 868E6 else 157  # LF / HF port
+        self.registers[REG_PKT_RSSI_VALUE] = max(min(int(rssi) + offset, 255), 0)
+        self.registers[REG_PKT_SNR_VALUE] = int(snr * 4) & 0xff
+        self.raise_irq(IRQ_RX_DONE_MASK | (IRQ_PAYLOAD_CRC_ERROR_MASK if crc_error else 0))
+        return True
+
+    def raise_irq(self, mask):
+        self.registers[REG_IRQ_FLAGS] |= mask
+        for dio in range(6):
+            register, shift, events = DIO_EVENTS[dio]
+            event = events.get((self.registers[register] >> shift) & 0x03, 0)
+            if event & mask and self.dio[dio]:
+                self.dio[dio].fire()
+
+
+class EmulatedController(Controller):
+    '''
+    Controller for running the unmodified drivers on a host (CPython).
+    Every chip select pin gets its own SX127xEmulator on one shared emulated
+    SPI bus; DIO pins of a transceiver are wired to its emulator.
+    '''
+
+    PIN_ID_FOR_LORA_RESET = 14
+    PIN_ID_FOR_LORA_SS = 18
+    PIN_ID_FOR_LORA_DIO0 = 26
+
+    ON_BOARD_LED_PIN_NO = 2
+    ON_BOARD_LED_HIGH_IS_ON = True
+
+    class Pin:
+
+        def __init__(self, pin_id, on_change=None):
+            self.pin_id = pin_id
+            self._value = 0
+            self._on_change = on_change
+            self._handler = None
+
+        def value(self, value=None):
+            if value is None:
+                return self._value
+            self._value = value
+            if self._on_change:
+                self._on_change(self, value)
+
+        def low(self):
+            self.value(0)
+
+        def high(self):
+            self.value(1)
+
+        def set_handler_for_irq_on_rising_edge(self, handler):
+            self._handler = handler
+
+        def detach_irq(self):
+            self._handler = None
+
+        def fire(self):
+            if self._handler:
+                self._handler(self)
+
+    def __init__(self,
+                 pin_id_led = ON_BOARD_LED_PIN_NO,
+                 on_board_led_high_is_on = ON_BOARD_LED_HIGH_IS_ON,
+                 pin_id_reset = PIN_ID_FOR_LORA_RESET,
+                 blink_on_start = (0, 0, 0),
+                 on_transmit = None,
+                 auto_complete = True):
+
+        self.radios = {}
+        self.pin_id_reset = pin_id_reset
+        self.on_transmit = on_transmit
+        self.auto_complete = auto_complete
+        super().__init__(pin_id_led,
+                         on_board_led_high_is_on,
+                         pin_id_reset,
+                         blink_on_start)
+
+    def radio(self, pin_ss):
+        pin_id = pin_ss.pin_id
+        if pin_id not in self.radios:
+            self.radios[pin_id] = SX127xEmulator(on_transmit=self.on_transmit,
+                                                 auto_complete=self.auto_complete)
+        return self.radios[pin_id]
+
+    def add_transceiver(self, transceiver, *args, **kwargs):
+        # wire the DIO pins of the transceiver to its emulated radio
+        transceiver = super().add_transceiver(transceiver, *args, **kwargs)
+        radio = self.radio(transceiver.pin_ss)
+        radio.name = transceiver.name
+        radio.dio = [transceiver.pin_RxDone, transceiver.pin_RxTimeout,
+                     transceiver.pin_ValidHeader, transceiver.pin_CadDone,
+                     transceiver.pin_CadDetected, transceiver.pin_PayloadCrcError]
+        return transceiver
+
+    def _on_reset(self, pin, value):
+        if value == 0:
+            for radio in self.radios.values():
+                radio.reset()
+
+    def prepare_pin(self, pin_id, in_out = None):
+        if pin_id is not None:
+            on_change = self._on_reset if pin_id == self.pin_id_reset else None
+            return EmulatedController.Pin(pin_id, on_change)
+
+    def prepare_irq_pin(self, pin_id):
+        return self.prepare_pin(pin_id)
+
+    def get_spi(self):
+        return self
+
+    def prepare_spi(self, spi):
+        new_spi = Controller.Mock()
+        lock = allocate_lock()
+
+        def transfer(pin_ss, address, value = 0x00):
+            with lock:
+                return self.radio(pin_ss).transfer(address, value)
+
+        def read_burst(pin_ss, address, buffer):
+            with lock:
+                self.radio(pin_ss).read_burst(address, buffer)
+
+        def write_burst(pin_ss, address, buffer):
+            with lock:
+                self.radio(pin_ss).write_burst(address, buffer)
+
+        new_spi.transfer = transfer
+        new_spi.read_burst = read_burst
+        new_spi.write_burst = write_burst
+        new_spi.lock = lock
+        new_spi.close = lambda : None
+        return new_spi
+
+    def blink_led(self, times = 1, on_seconds = 0.1, off_seconds = 0.1):
+        # no LED on the host, and no point waiting for one.
+        for i in range(times):
+            self.led_on(True)
+            self.led_on(False)
+
+    def reset_pin(self, pin, duration_low = 0.05, duration_high = 0.05):
+        pin.low()
+        pin.high()
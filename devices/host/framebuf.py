@@ -0,0 +1,87 @@
+'''
+Host (CPython) stand-in for the framebuf module, MONO_VLSB only.
+Drawing goes into the caller's buffer with the same layout as on device;
+text() does not render glyphs.
+'''
+
+MONO_VLSB = 0
+
+
+class FrameBuffer:
+
+    def __init__(self, buffer, width, height, format=MONO_VLSB, stride=None):
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+
+    def fill(self, c):
+        value = 0xff if c else 0x00
+        for i in range(len(self.buffer)):
+            self.buffer[i] = value
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None if c is not None else 0
+        index = (y >> 3) * self.width + x
+        bit = 1 << (y & 7)
+        if c is None:
+            return 1 if self.buffer[index] & bit else 0
+        if c:
+            self.buffer[index] |= bit
+        else:
+            self.buffer[index] &= ~bit & 0xff
+
+    def hline(self, x, y, w, c):
+        for i in range(w):
+            self.pixel(x + i, y, c)
+
+    def vline(self, x, y, h, c):
+        for i in range(h):
+            self.pixel(x, y + i, c)
+
+    def line(self, x1, y1, x2, y2, c):
+        dx, dy = abs(x2 - x1), -abs(y2 - y1)
+        sx, sy = (1 if x1 < x2 else -1), (1 if y1 < y2 else -1)
+        error = dx + dy
+        while True:
+            self.pixel(x1, y1, c)
+            if x1 == x2 and y1 == y2:
+                return
+            twice = 2 * error
+            if twice >= dy:
+                error += dy
+                x1 += sx
+            if twice <= dx:
+                error += dx
+                y1 += sy
+
+    def rect(self, x, y, w, h, c):
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def fill_rect(self, x, y, w, h, c):
+        for i in range(h):
+            self.hline(x, y + i, w, c)
+
+    def scroll(self, dx, dy):
+        pixels = [[self.pixel(x, y) for x in range(self.width)] for y in range(self.height)]
+        for y in range(self.height):
+            for x in range(self.width):
+                if 0 <= x - dx < self.width and 0 <= y - dy < self.height:
+                    self.pixel(x, y, pixels[y - dy][x - dx])
+
+    def text(self, string, x, y, c=1):
+        pass
+
+    def blit(self, source, x, y, key=-1):
+        for sy in range(source.height):
+            for sx in range(source.width):
+                c = source.pixel(sx, sy)
+                if c != key:
+                    self.pixel(x + sx, y + sy, c)
+
+
+def FrameBuffer1(buffer, width, height):
+    return FrameBuffer(buffer, width, height, MONO_VLSB)
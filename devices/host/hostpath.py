@@ -0,0 +1,16 @@
+'''
+Make the device modules importable on the host.
+shared/ is flattened onto the device root, so it goes on sys.path; it is
+appended, so where shared/ ports a standard module (threading, queue, ...)
+CPython's own version wins.
+'''
+import os
+import sys
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+SHARED = os.path.join(os.path.dirname(HOST), 'shared')
+
+if HOST not in sys.path:
+    sys.path.insert(0, HOST)
+if SHARED not in sys.path:
+    sys.path.append(SHARED)
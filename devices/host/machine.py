@@ -0,0 +1,81 @@
+'''
+Host (CPython) stand-in for the parts of the machine module the drivers use.
+Pins hold a value, I2C and SPI only count the bytes written to them.
+'''
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = value if value is not None else 0
+        self._handler = None
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_RISING):
+        self._handler = handler
+
+
+class I2C:
+
+    def __init__(self, id=-1, scl=None, sda=None, freq=400000):
+        self.freq = freq
+        self.transactions = 0
+        self.bytes_written = 0
+
+    def writeto(self, addr, buf):
+        self.transactions += 1
+        self.bytes_written += len(buf)
+        return 1
+
+    def writevto(self, addr, vector):
+        self.transactions += 1
+        self.bytes_written += sum(len(buf) for buf in vector)
+        return 1
+
+
+class SPI:
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, id=-1, baudrate=1000000, polarity=0, phase=0, bits=8, firstbit=MSB,
+                 sck=None, mosi=None, miso=None):
+        self.bytes_written = 0
+
+    def write(self, buf):
+        self.bytes_written += len(buf)
+
+    def readinto(self, buf, write=0x00):
+        for i in range(len(buf)):
+            buf[i] = 0
+
+    def write_readinto(self, write_buf, read_buf):
+        self.write(write_buf)
+        self.readinto(read_buf)
+
+    def deinit(self):
+        pass
+
+
+def unique_id():
+    return b'\x24\x0a\xc4\x00\x00\x01'
+
+
+def reset():
+    raise SystemExit('machine.reset()')
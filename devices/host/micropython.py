@@ -0,0 +1,34 @@
+'''
+Host (CPython) stand-in for the micropython module, see "Running on a host" in the README.
+'''
+
+_scheduled = []
+_running = False
+
+SCHEDULE_QUEUE_SIZE = 8
+
+
+def const(value):
+    return value
+
+
+def schedule(function, argument):
+    # like micropython, callbacks run one at a time, never nested, in order.
+    global _running
+    if len(_scheduled) >= SCHEDULE_QUEUE_SIZE:
+        raise RuntimeError('schedule queue full')
+    _scheduled.append((function, argument))
+    if _running:
+        return
+
+    _running = True
+    try:
+        while _scheduled:
+            function, argument = _scheduled.pop(0)
+            function(argument)
+    finally:
+        _running = False
+
+
+def alloc_emergency_exception_buf(size):
+    pass
@@ -0,0 +1,179 @@
+'''
+Local MQTT broker stand-in for testing the hub's uplink on Linux.
+Accepts MQTT 3.1.1 CONNECT, PUBLISH (QoS 0/1) and PINGREQ, acknowledges as a
+broker would and keeps what was published; nothing is routed to subscribers.
+
+    python3 devices/host/mqtt_broker.py --port 1883
+
+With --selftest it pushes readings through MQTTBridge instead, dropping the
+connection every --drop-every publishes and refusing connections for the
+first --outage seconds (readings then go to a flash journal in a temporary
+directory), and reports what arrived.
+'''
+import hostpath  # noqa: F401
+
+import argparse
+import json
+import socket
+import struct
+import threading
+import time
+
+
+class BrokerStandIn:
+
+    def __init__(self, host='127.0.0.1', port=0, drop_every=0, verbose=False):
+        self.drop_every = drop_every
+        self.verbose = verbose
+        self.messages = []  # (topic, payload, dup)
+        self.connections = 0
+        self.down = False  # refuse connections, as during an outage
+        self._publishes = 0
+        self._lock = threading.Lock()
+
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(4)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # as brokers do
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def close(self):
+        self._server.close()
+
+    def _read(self, connection, size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _read_packet(self, connection):
+        first = self._read(connection, 1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self._read(connection, 1)[0]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first, self._read(connection, length)
+
+    def _serve(self, connection):
+        try:
+            while not self.down:
+                first, body = self._read_packet(connection)
+                kind = first & 0xf0
+                if kind == 0x10:
+                    connection.sendall(b'\x20\x02\x00\x00')
+                elif kind == 0x30:
+                    if self._publish(connection, first, body):
+                        return
+                elif kind == 0xc0:
+                    connection.sendall(b'\xd0\x00')
+                elif kind == 0xe0:
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def _publish(self, connection, first, body):
+        # returns True if the connection is to be dropped
+        topic_length, = struct.unpack_from('!H', body, 0)
+        topic = body[2:2 + topic_length].decode()
+        position = 2 + topic_length
+        qos = (first >> 1) & 0x03
+        packet_id = 0
+        if qos:
+            packet_id, = struct.unpack_from('!H', body, position)
+            position += 2
+        payload = body[position:]
+
+        with self._lock:
+            self._publishes += 1
+            if self.drop_every and self._publishes % self.drop_every == 0:
+                return True  # lost before it was stored and acknowledged
+            self.messages.append((topic, payload, bool(first & 0x08)))
+        if self.verbose:
+            print('{} {}'.format(topic, payload.decode()))
+        if qos:
+            connection.sendall(struct.pack('!BBH', 0x40, 0x02, packet_id))
+        return False
+
+
+def selftest(readings, rate, drop_every, batch_size, outage_s):
+    import tempfile
+    from journal import Journal
+    from mqtt import MQTTClient
+    from mqtt_bridge import MQTTBridge
+    import mqtt_bridge
+
+    mqtt_bridge.MIN_BACKOFF_MS = 50
+    mqtt_bridge.MAX_BACKOFF_MS = 500
+    broker = BrokerStandIn(drop_every=drop_every)
+    broker.down = outage_s > 0
+    journal = Journal(tempfile.mkdtemp() + '/journal', flush_ms=500)
+    bridge = MQTTBridge(MQTTClient('hub-selftest', '127.0.0.1', broker.port), 'lora/hub/readings',
+                        batch_size=batch_size, max_latency_ms=100, journal=journal,
+                        replay_per_second=rate * 2)
+    bridge.start()
+
+    started = time.perf_counter()
+    for i in range(readings):
+        bridge.submit(i % 50, 'temperature_c', i, 20.0 + (i % 7) / 10)
+        time.sleep(max(started + (i + 1) / rate - time.perf_counter(), 0))
+        if broker.down and time.perf_counter() - started > outage_s:
+            print('outage over, {} readings in the journal'.format(journal.unacked()))
+            broker.down = False
+    while bridge.pending() and time.perf_counter() - started < readings / rate + 60:
+        time.sleep(0.1)
+    bridge.stop(timeout_ms=5000)
+    elapsed = time.perf_counter() - started
+    broker.close()
+
+    received = [tuple(reading) for _, payload, _ in broker.messages for reading in json.loads(payload)]
+    print('readings submitted: {}, publishes: {} ({} republished), broker connections: {}'.format(
+        readings, bridge.published, bridge.republished, broker.connections))
+    print('readings at the broker: {} unique of {}, missing {}, in {:.2f} s'.format(
+        len(set(received)), len(received), readings - len(set(received)), elapsed))
+    print(bridge.stats())
+    print(journal.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--drop-every', type=int, default=0, help='drop the connection every n publishes')
+    parser.add_argument('--selftest', action='store_true')
+    parser.add_argument('--readings', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=1000, help='readings per second')
+    parser.add_argument('--outage', type=float, default=0, help='seconds the broker is down at first')
+    parser.add_argument('--batch', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest(args.readings, args.rate, args.drop_every, args.batch, args.outage)
+        return
+
+    broker = BrokerStandIn(port=args.port, drop_every=args.drop_every, verbose=True)
+    print('MQTT broker stand-in on port {}'.format(broker.port))
+    while True:
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
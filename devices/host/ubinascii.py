@@ -0,0 +1,4 @@
+'''
+Host (CPython) stand-in for the ubinascii module.
+'''
+from binascii import hexlify, unhexlify, a2b_base64, b2a_base64  # noqa: F401
@@ -1,7 +1,9 @@
-from shared import network
+import wifi
 
 # setup wifi to network
 WIFI_SSID = ""  # WiFi SSID
 WIFI_PASS = ""  # Wifi Password
 
-network.connect_to_wifi(ssid=WIFI_SSID, password=WIFI_PASS)
+# only starts associating: LoRa comes up meanwhile, main.py syncs the clock
+# and the MQTT bridge connects once the network is there
+wifi.start_wifi(ssid=WIFI_SSID, password=WIFI_PASS)
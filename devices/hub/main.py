@@ -1,8 +1,230 @@
+from time import time
+import _thread
+from clock import ticks_ms, ticks_diff, ticks_add
+from config_lora import get_nodename, get_node_id
+from controller_esp32 import ESP32Controller
+from sx127x import SX127x
+from radio_engine import RadioEngine, TX_POLL_SECONDS
+from hub_radios import MultiRadioHub
+from dedup import Deduplicator
+from reliable import AckTracker
+from adr import AdaptiveDataRate
+from downlink import DownlinkQueue, UPDATE_PROFILE, PRIORITY_HIGH, DOWNLINK_SIZE, pack_profile
+from tdma import BeaconClock, SlotSchedule, SLOT_PAYLOAD_SIZE
+from timeline import TIMELINE
+import wifi
+import batcher
+import codec
+import compress
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# one entry per SX127x sharing the SPI bus:
+# (name, chip select pin, DIO0 pin, parameters differing from the SX127x defaults,
+#  frame size for a radio in implicit header mode or 0)
+# give every radio its own frequency or spreading factor, e.g. a second module:
+# ('LoRa SF7', 17, 23, {'spreading_factor': 7}, 0),
+# or one listening for the header-less frames of an implicit.CHANNELS entry:
+# ('LoRa fixed', 17, 23) + implicit.CHANNELS.hub_radio(codec.ENVIRONMENT),
+RADIOS = (('LoRa', ESP32Controller.PIN_ID_FOR_LORA_SS, ESP32Controller.PIN_ID_FOR_LORA_DIO0, {}, 0),)
+
+MQTT_BROKER = ''  # host name or address, readings are only printed without one
+MQTT_PORT = 1883
+MQTT_TOPIC = 'lora/{}/readings'
+TIMELINE_TOPIC = 'lora/{}/timeline'  # timeline.py blob of the last spans
+TIMELINE_PERIOD_MS = 300000          # 0 to keep it to TIMELINE.dump() over serial
+JOURNAL_DIRECTORY = '/journal'  # readings the uplink cannot take wait here
+
+BEACON_PERIOD_MS = 60000  # also the TDMA period, nodes send once per period in their slot
+
+ACK_UPLINKS = False  # answer every uplink with an ACK, for nodes using reliable.ReliableSender
+
+
+def create_hub(controller):
+    engines = []
+    for name, pin_id_ss, pin_id_RxDone, parameters, implicit_size in RADIOS:
+        lora = controller.add_transceiver(SX127x(name=name),
+                                          pin_id_ss=pin_id_ss,
+                                          pin_id_RxDone=pin_id_RxDone)
+        if parameters:
+            lora.configure(parameters)
+        engines.append(RadioEngine(lora, implicit_size=implicit_size))
+    return MultiRadioHub(engines)
+
+
+def create_bridge():
+    if not MQTT_BROKER:
+        return None
+    # only loaded when there is an uplink to run
+    from journal import Journal
+    from mqtt import MQTTClient
+    from mqtt_bridge import MQTTBridge
+    name = get_nodename()
+    return MQTTBridge(MQTTClient(name, MQTT_BROKER, MQTT_PORT), MQTT_TOPIC.format(name),
+                      journal=Journal(JOURNAL_DIRECTORY))
+
+
+def wifi_connected():
+    try:
+        return wifi.wifi_connected()
+    except ImportError:
+        return False  # not micropython, no network module
+
+
+def sync_rtc(done):
+    # sets the RTC from NTP in its own thread, settime() blocks until the
+    # server answers or its socket times out; done[0] tells the loop
+    try:
+        import ntptime
+        ntptime.settime()
+    except Exception as e:
+        print('NTP unavailable, keeping the RTC: {}'.format(e))
+    done[0] = True
+
+
+async def send_beacon(engine, slots, clock, buffer, sequence):
+    # stamped as it goes on air: once the radio is free, nothing runs between
+    # the stamp and send() starting the transmission
+    while engine.transmitting():
+        await asyncio.sleep(TX_POLL_SECONDS)
+    size = slots.beacon_into(buffer, get_node_id(), sequence, engine.lora.parameters, clock.now_ms())
+    try:
+        await engine.send(memoryview(buffer)[:size])
+    except Exception as e:
+        print('[{}] beacon not sent: {}'.format(engine.lora.name, e))
+
+
+def send_beacons(hub, slots, clock, buffers, sequence):
+    # one beacon per radio listening with headers, all on air at once while
+    # the radios keep being read
+    for i in range(len(hub.engines)):
+        engine = hub.engines[i]
+        if not engine.implicit_size:
+            asyncio.create_task(send_beacon(engine, slots, clock, buffers[i], sequence))
+
+
 def main():
     controller = ESP32Controller()
-    lora = controller.add_transceiver(SX127x(name='LoRa'),
-                                      pin_id_ss=ESP32Controller.PIN_ID_FOR_LORA_SS,
-                                      pin_id_RxDone=ESP32Controller.PIN_ID_FOR_LORA_DIO0)
+    hub = create_hub(controller)
+    acks = AckTracker() if ACK_UPLINKS else None
+    dedup = acks if acks is not None else Deduplicator()
+    downlinks = DownlinkQueue()
+    # no bigger than the slots reserve for the answer, see tdma.py
+    downlink_buffers = {engine.lora.name: bytearray(DOWNLINK_SIZE) for engine in hub.engines}
+    downlink_sequence = [0]
+    adr = AdaptiveDataRate(spreading_factors=[engine.lora.parameters['spreading_factor']
+                                              for engine in hub.engines if not engine.implicit_size])
+    bridge = create_bridge()
+    clock = BeaconClock()
+    clock.discipline(int(time()) * 1000, ticks_ms())  # RTC until NTP answers
+    slots = SlotSchedule(period_ms=BEACON_PERIOD_MS, payload_size=SLOT_PAYLOAD_SIZE)
+    beacons = [bytearray(codec.MAX_FRAME_SIZE) for engine in hub.engines]
+
+    def on_reading(node_id, name, timestamp, value):
+        print('  node {:04x} {} at {}: {}'.format(node_id, name, timestamp, value))
+        if bridge:
+            bridge.submit(node_id, name, timestamp, value)
+
+    def wall_clock_ms(ticks):
+        # packets are stamped with ticks_ms() on arrival, upstream wants wall clock time
+        return clock.now_ms(ticks)
+
+    def series_ms(at, sent_ms, arrival_ms):
+        # a SERIES sample time on the node's clock, on the hub's: its age when sent
+        return arrival_ms - ((sent_ms - at) & 0xffffffff)
+
+    async def send_answer(engine, node_id):
+        # the frame is built once the radio is free and send() starts it
+        # without yielding, so answers queued on one radio share its buffer
+        while engine.transmitting():
+            await asyncio.sleep(TX_POLL_SECONDS)
+        buffer = downlink_buffers[engine.lora.name]
+        size = downlinks.frame_into(buffer, node_id, downlink_sequence[0], acks)
+        if not size:
+            return
+        downlink_sequence[0] += 1
+        adr.downlink_sent(node_id)
+        try:
+            await engine.send(memoryview(buffer)[:size])
+        except Exception as e:
+            print('[{}] downlink to {:04x} not sent: {}'.format(engine.lora.name, node_id, e))
+
+    def answer(radio_name, node_id):
+        # the node listens for a moment after each uplink, on the channel it
+        # used; the answer goes on air once on_packet has returned
+        engine = hub.engine(radio_name)
+        if engine.implicit_size:
+            return  # header-less channel, uplink only
+        if downlinks.pending(node_id) or (acks is not None and acks.pending(node_id)):
+            asyncio.create_task(send_answer(engine, node_id))
+
+    def on_packet(radio_name, payload, rssi, snr, timestamp):
+        try:
+            node_id, sequence, schema, values = codec.decode(payload)
+        except Exception as e:
+            print('[{}] rssi: {} snr: {} undecodable: {} {}'.format(radio_name, rssi, snr, bytes(payload), e))
+            return
+        fresh = acks.record(node_id, sequence) if acks is not None else dedup.check(node_id, sequence)
+        profile = adr.record(node_id, snr, sequence, hub.engine(radio_name).lora.parameters['spreading_factor']) \
+            if adr.spreading_factors else None
+        if profile:
+            downlinks.put(node_id, UPDATE_PROFILE, pack_profile(profile), PRIORITY_HIGH)
+        answer(radio_name, node_id)
+        if not fresh:
+            return  # heard before, by another radio or as a retransmission
+        if slots.assign(node_id, hub.engine(radio_name).lora.parameters) is None:
+            print('no TDMA slot left for node {:04x}, it stays on ALOHA'.format(node_id))
+        print('[{}] rssi: {} snr: {} node {:04x} #{} {} {}'.format(
+            radio_name, rssi, snr, node_id, sequence, schema.name, schema.describe(values)))
+        if schema is codec.BATCH:
+            batcher.unpack(payload, wall_clock_ms(timestamp), on_reading)
+        elif schema is codec.SERIES:
+            sensor_id, sent_ms = values
+            arrival_ms = wall_clock_ms(timestamp)
+            compress.decode(payload, lambda at, value: on_reading(
+                node_id, sensor_id, series_ms(at, sent_ms, arrival_ms), value), schema.size)
+        else:
+            at = wall_clock_ms(timestamp)
+            for name, value in zip(schema.names, values):
+                on_reading(node_id, name, at, value)
+
+    async def serve():
+        # transmissions run as tasks finished by TX_DONE, the radios keep
+        # being read while they are on air
+        sequence = 0
+        last_beacon = ticks_ms()
+        last_timeline = ticks_ms()
+        timeline_topic = TIMELINE_TOPIC.format(get_nodename())
+        ntp_started = False
+        ntp_done = [False]
+        while True:
+            if not ntp_started and wifi_connected():
+                # boot.py only started associating, the radios were listening meanwhile
+                _thread.start_new_thread(sync_rtc, (ntp_done,))
+                ntp_started = True
+            if ntp_done[0]:
+                # ms resolution hub clock for beacons and timestamps, from the RTC NTP set
+                clock.discipline(int(time()) * 1000, ticks_ms())
+                ntp_done[0] = False
+            if ticks_diff(ticks_ms(), last_beacon) >= BEACON_PERIOD_MS:
+                last_beacon = ticks_add(last_beacon, BEACON_PERIOD_MS)
+                send_beacons(hub, slots, clock, beacons, sequence)
+                sequence += 1
+            if bridge and TIMELINE_PERIOD_MS and ticks_diff(ticks_ms(), last_timeline) >= TIMELINE_PERIOD_MS:
+                last_timeline = ticks_add(last_timeline, TIMELINE_PERIOD_MS)
+                bridge.post(timeline_topic, TIMELINE.blob())
+            if hub.read_batch(on_packet):
+                await asyncio.sleep(0)  # transmissions go on between batches
+            else:
+                await asyncio.sleep(0.01)
+
+    if bridge:
+        bridge.start()
+    hub.start()
+    asyncio.run(serve())
 
 
 if __name__ == '__main__':
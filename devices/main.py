@@ -1,22 +1,29 @@
-from shared.controller_esp32 import ESP32Controller
-from shared.sx127x import SX127x
+import sys
 
 device_type = 'hub'  # hub | node
 
+# shared/ modules import each other by their flat names. Frozen into the
+# firmware (see manifest.py) they are found before the filesystem; otherwise
+# they load from shared/, as .py or as .mpy precompiled by host/build_mpy.py.
+SHARED_DIRECTORY = 'shared'
+
 
 def main():
-    controller = ESP32Controller()
-    lora = controller.add_transceiver(SX127x(name='LoRa'),
-                                      pin_id_ss=ESP32Controller.PIN_ID_FOR_LORA_SS,
-                                      pin_id_RxDone=ESP32Controller.PIN_ID_FOR_LORA_DIO0)
+    if SHARED_DIRECTORY not in sys.path:
+        sys.path.append(SHARED_DIRECTORY)
+
+    # only the role's own modules are imported, each role brings up its radio
+    # while the WiFi association started by its boot.py runs in the background
     if device_type == 'hub':
-        # do hubby things
         print('initiating device type: hub')
+        import hub.boot  # noqa: F401
+        from hub.main import main as run
     elif device_type == 'node':
-        # do nodey things
-        print('initiating device type: hub')
+        print('initiating device type: node')
+        from node.main import main as run
     else:
         raise Exception('device type must be set and be one of: (hub or node)')
+    run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,8 @@
+# MicroPython firmware manifest freezing shared/ as bytecode, so the modules
+# are not read and compiled from the filesystem at every boot (main.py falls
+# back to shared/ on the filesystem for anything not frozen). Module names
+# must not collide with built-in modules, which are found first. Code only
+# run on a host lives in host/, everything in shared/ is frozen. Build with
+#   make -C ports/esp32 FROZEN_MANIFEST=/path/to/devices/manifest.py
+include('$(PORT_DIR)/boards/manifest.py')
+freeze('shared', opt=3)
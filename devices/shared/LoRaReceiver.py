@@ -1,5 +1,9 @@
 from ssd1306 import SSD1306_I2C
 from machine import Pin, I2C
+from radio_engine import RadioEngine
+from tdma import BeaconClock
+from display_service import DisplayService
+import codec
 import time
 
 
@@ -24,29 +28,28 @@ def startup_view(screen):
 
 
 # char is 8x8 pixels wide
-def display_view(screen, packet_rssi, message, thingy_id, time_sync):
-    # clear display
-    screen.fill(0)
+def display_chrome(fbuf):
+    # static header and footer, drawn once
+    fbuf.vline(28, 0, 10, 1)
+    fbuf.vline(108, 0, 10, 1)
+    fbuf.hline(0, 10, 128, 1)
+    fbuf.text('REC', 0, 0, 1)
+    fbuf.text("UP", 112, 0, 1)
 
+    fbuf.hline(0, 54, 128, 1)
+    fbuf.text("{}".format("OK"), 0, 56, 1)
+
+
+def display_view(screen, state):
     # header
-    screen.vline(28, 0, 10)
-    screen.vline(108, 0, 10)
-    screen.hline(0, 10, 128)
-    screen.text('REC', 0, 0)
-    screen.text(thingy_id, 32, 0)
-    screen.text("UP", 112, 0)
+    screen.text(state.get('thingy_id', ''), 32, 0)
 
     # main body
-    screen.text(message, 0, 12)
-    screen.text("RSSI:{0}".format(packet_rssi), 0, 24)
+    screen.text(state.get('message', ''), 0, 12)
+    screen.text("RSSI:{0}".format(state.get('rssi', '')), 0, 24)
 
     # footer
-    screen.hline(0, 54, 128)
-    screen.text("{}".format("OK"), 0, 56)
-    screen.text("{}".format(time_sync), 48, 56)
-
-    # update display
-    screen.show()
+    screen.text("{}".format(state.get('time_sync', '')), 48, 56)
 
 def receive(lora):
     print("LoRa Receiver")
@@ -57,22 +60,39 @@ def receive(lora):
     i2c = I2C(scl=scl, sda=sda, freq=450000)
     oled = SSD1306_I2C(128, 64, i2c, addr=0x3c)
 
-    last_sync_time = 1560668066
-    time_last_sync = time.time()
+    # hub time, disciplined by its beacons
+    clock = BeaconClock()
 
     def get_estimated_time():
-        return last_sync_time + time.time() - time_last_sync
+        return clock.now_ms() // 1000 if clock.synced else '--'
 
-    startup_view(oled)
+    # the splash plays in the display thread, packets are received meanwhile
+    display = DisplayService(oled, display_view, chrome=display_chrome)
+    display.start(intro=startup_view)
 
-    while True:
-        if lora.receivedPacket():
-            lora.blink_led()
+    def on_packet(payload, packet_rssi, packet_snr, timestamp):
+        lora.blink_led()
+
+        try:
+            node_id, sequence, schema, values = codec.decode(payload)
+            if schema is codec.BEACON:
+                time_s, time_ms = values[:2]
+                clock.discipline(time_s * 1000 + time_ms + int(lora.timeOnAir(len(payload))), timestamp)
+            message = schema.describe(values)
+            display.update('thingy_id', "{:04x}".format(node_id))
+            display.update('message', message)
+            display.update('rssi', packet_rssi)
+            display.update('time_sync', get_estimated_time())
+            print("*** Received {} #{} from {:04x} ***\n{}".format(schema.name, sequence, node_id, message))
 
-            try:
-                payload = lora.read_payload()
-                display_view(oled, lora.packetRssi(), payload.decode(), "thing1", get_estimated_time())
-                print("*** Received message ***\n{}".format(payload.decode()))
+        except Exception as e:
+            print(e)
 
-            except Exception as e:
-                print(e)
+    engine = RadioEngine(lora)
+    engine.start()
+
+    while True:
+        # packets are queued by the DIO0 interrupt, handle whatever has arrived.
+        if not engine.read_batch(on_packet):
+            lora.memory_policy.idle()
+            time.sleep(0.01)
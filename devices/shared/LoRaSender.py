@@ -1,6 +1,27 @@
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
 from time import sleep
 from ssd1306 import SSD1306_I2C
 from machine import Pin, I2C
+from config_lora import get_node_id
+from clock import ticks_ms, ticks_diff
+from tdma import SlotClient, SLOT_PAYLOAD_SIZE
+from adr import LinkProfile
+from downlink import ReceiveWindow, DownlinkHandler, UPDATE_INTERVAL, INTERVAL_FORMAT
+from batcher import Batcher, SensorBatch
+import codec
+import implicit
+
+ALOHA_INTERVAL_MS = 1000  # until a hub beacon gives the node a slot, the hub may change it
+
+# one reading per sensor every slot (or ALOHA interval), sent in BATCH
+# frames: a frame goes out once it is nearly full or the oldest reading of
+# a sensor is max_latency_ms old, longer latency buys less airtime.
+# (sensor id, value format, scale exponent, max latency ms)
+SENSOR_COUNTER = 0
+SENSORS = ((SENSOR_COUNTER, 'H', 0, 300000),)
 
 def send(lora):
     counter = 0
@@ -22,12 +43,64 @@ def send(lora):
         oled.text(message2, 0, 50)
         oled.show()
 
-    while True:
-        payload = 'Hello ({0})'.format(counter)
-        print("Sending packet: \n{}\n".format(payload))
-        draw("{0}".format(payload), "RSSI: {0}".format(lora.packetRssi()))
+    node_id = get_node_id()
+    batcher = Batcher([SensorBatch(sensor_id, value_format, scale_exponent, max_latency_ms)
+                       for sensor_id, value_format, scale_exponent, max_latency_ms in SENSORS],
+                      max_frame=SLOT_PAYLOAD_SIZE)
+    frame = bytearray(SLOT_PAYLOAD_SIZE)
+    sequence = 0
+    slots = SlotClient(node_id)
+    window = ReceiveWindow(lora)
+    link = LinkProfile(lora)
+    interval_ms = [ALOHA_INTERVAL_MS]
+
+    def on_update(key, view, offset, length):
+        if key == UPDATE_INTERVAL:
+            interval_ms[0] = struct.unpack_from(INTERVAL_FORMAT, view, offset)[0] * 1000
+
+    downlinks = DownlinkHandler(node_id, link=link, on_update=on_update)
 
-        lora.println(payload)
+    def on_frame(view, ticks):
+        try:
+            if not slots.handle_beacon(view, ticks, lora):
+                downlinks.handle(view, ticks)
+        except Exception as e:
+            print(e)
 
+    def wait_for_turn():
+        # until the node has a slot, listen for beacons for interval_ms;
+        # then keep the radio asleep but for the beacons due before the slot
+        started = ticks_ms()
+        while True:
+            wait = slots.wait_ms()
+            if wait < 0:
+                wait = interval_ms[0] - ticks_diff(ticks_ms(), started)
+                if wait <= 0:
+                    return
+                window.listen(on_frame, wait)
+                continue
+            if wait <= 0:
+                return
+            beacon = slots.beacon_wait_ms() - slots.guard_ms
+            if 0 <= beacon < wait:
+                lora.sleep()
+                sleep(beacon / 1000)
+                window.listen(on_frame, 2 * slots.guard_ms)
+            else:
+                lora.sleep()
+                sleep(wait / 1000)
+
+    while True:
+        batcher.add(SENSOR_COUNTER, counter & 0xffff)  # 'H' above
+        draw("Counter ({0})".format(counter), "RSSI: {0}".format(lora.packetRssi()))
         counter += 1
-        sleep(1)
+
+        if batcher.due():
+            size = batcher.encode_into(frame, node_id, sequence)
+            print("Sending batch #{} of {} bytes, counter {}\n".format(sequence, size, counter - 1))
+            implicit.CHANNELS.send(lora, frame, size)
+            sequence += 1
+            link.uplink_sent()
+            window.listen(on_frame)  # the hub answers right after an uplink
+
+        wait_for_turn()
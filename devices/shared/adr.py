@@ -0,0 +1,231 @@
+from array import array
+from dedup import sequence_distance, WINDOW_BITS
+
+# demodulator SNR floor per spreading factor (SX1276 datasheet, table 13)
+REQUIRED_SNR = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+MIN_TX_POWER = 2
+MAX_TX_POWER = 17
+TX_POWER_STEP = 3  # dB per ADR step, as in LoRaWAN
+
+# node fallback: after ACK_LIMIT uplinks without a downlink, one step back
+# every ACK_DELAY uplinks; the hub replays the same rule to stay in sync
+ACK_LIMIT = 16
+ACK_DELAY = 8
+REFRESH_UPLINKS = ACK_LIMIT // 2  # hub re-sends the profile after this many uplinks without a downlink
+
+
+class AdaptiveDataRate:
+    '''
+    Hub side adaptive data rate.
+    Keeps a sliding window of uplink SNR per node and, once a window is full,
+    derives the fastest spreading factor and lowest TX power that still leave
+    margin_db above the demodulation floor (the LoRaWAN ADR algorithm).
+    record() returns the new profile to push down to the node, or None.
+
+    Hub and node must agree on the profile. The node steps back towards
+    its fallback when it hears no downlink for ACK_LIMIT uplinks (see
+    LinkProfile), so record() also hands out the current profile again
+    once REFRESH_UPLINKS uplinks went by since downlink_sent(), which
+    keeps a node in touch from falling back and puts one that did back on
+    the hub's profile. When sequence numbers show the hub missed enough
+    uplinks for the node to have stepped back, it replays those steps, and
+    an uplink heard on another spreading factor than expected (pass the
+    receiving radio's) resets the node to that SF at full power. A profile
+    push that gets lost leaves the node on a more robust profile than the
+    hub assumes, until the next refresh gets through.
+
+    A radio only demodulates the spreading factor it is tuned to, so
+    spreading_factors must list the SFs the hub actually listens on. With a
+    single radio that leaves just TX power to adapt.
+
+    Bandwidth is not adapted. Doubling it costs the same 3 dB of link
+    budget as one SF step buys, so the SF steps already cover that
+    trade-off. A node moved to another bandwidth would need a hub radio
+    listening on it, and the PROFILE update (downlink.py) carries only SF
+    and power.
+    '''
+
+    def __init__(self, spreading_factors=(12,), window=20, margin_db=10.0,
+                 default_profile=None, max_nodes=64):
+        self.spreading_factors = sorted(spreading_factors)
+        self.window = window
+        self.margin_db = margin_db
+        self.max_nodes = max_nodes
+        self.default_profile = default_profile if default_profile else \
+            {'spreading_factor': self.spreading_factors[-1], 'tx_power_level': MAX_TX_POWER}
+
+        self._snr = {}
+        self._counts = {}
+        self._profiles = {}
+        self._sequences = {}       # node id => last sequence number heard
+        self._since_downlink = {}  # node id => uplinks since the last downlink
+        self.updates = 0
+        self.refreshes = 0
+        self.fallbacks = 0
+
+    def profile(self, node_id):
+        return self._profiles.get(node_id, self.default_profile)
+
+    def forget(self, node_id):
+        for table in (self._snr, self._counts, self._profiles, self._sequences, self._since_downlink):
+            if node_id in table:
+                del table[node_id]
+
+    def downlink_sent(self, node_id):
+        # any downlink answered the node's last uplink, it resets its fallback count
+        if node_id in self._since_downlink:
+            self._since_downlink[node_id] = 0
+
+    def record(self, node_id, snr, sequence=None, spreading_factor=None):
+        if node_id not in self._snr:
+            if len(self._snr) >= self.max_nodes:
+                return None
+            self._snr[node_id] = array('f', [0] * self.window)
+            self._counts[node_id] = 0
+            self._since_downlink[node_id] = 0
+
+        uplinks = self._uplinks(node_id, sequence)
+        before = self._since_downlink[node_id]
+        since = before + uplinks
+        self._since_downlink[node_id] = since
+        self._replay_fallback(node_id, before, since)
+        if spreading_factor is not None and spreading_factor != self.profile(node_id)['spreading_factor']:
+            # heard on another SF than the node should be on: a profile push
+            # was lost, or the node fell back further than the hub could tell
+            self._set_profile(node_id, {'spreading_factor': spreading_factor,
+                                        'tx_power_level': self.default_profile['tx_power_level']})
+            self.fallbacks += 1
+
+        count = self._counts[node_id]
+        self._snr[node_id][count % self.window] = snr
+        self._counts[node_id] = count + 1
+        current = self.profile(node_id)
+        new = current if count + 1 < self.window else self.evaluate(max(self._snr[node_id]), current)
+        if new == current:
+            if since >= REFRESH_UPLINKS and node_id in self._profiles:
+                self.refreshes += 1
+                return current
+            return None
+
+        # link changes with the profile, start a fresh window.
+        self._profiles[node_id] = new
+        self._counts[node_id] = 0
+        self.updates += 1
+        return new
+
+    def evaluate(self, snr, current):
+        sf = current['spreading_factor']
+        power = current['tx_power_level']
+
+        steps = int((snr - REQUIRED_SNR[sf] - self.margin_db) // TX_POWER_STEP)
+
+        # spend positive margin on speed first, then on lowering power.
+        faster = [s for s in self.spreading_factors if s < sf]
+        while steps > 0 and faster:
+            sf = faster.pop()
+            steps -= 1
+        while steps > 0 and power > MIN_TX_POWER:
+            power = max(power - TX_POWER_STEP, MIN_TX_POWER)
+            steps -= 1
+
+        # negative margin only ever raises power, the node falls back on SF itself.
+        while steps < 0 and power < MAX_TX_POWER:
+            power = min(power + TX_POWER_STEP, MAX_TX_POWER)
+            steps += 1
+
+        return {'spreading_factor': sf, 'tx_power_level': power}
+
+    def _uplinks(self, node_id, sequence):
+        # uplinks the node sent since the last one heard, this one included
+        if sequence is None:
+            return 1
+        last = self._sequences.get(node_id)
+        if last is None:
+            self._sequences[node_id] = sequence
+            return 1
+        distance = sequence_distance(sequence, last)
+        if distance > 0:
+            self._sequences[node_id] = sequence
+            return distance
+        if distance >= -WINDOW_BITS:
+            return 0  # heard before or late, already counted
+        # a reboot: the node starts over on its fallback profile
+        self._sequences[node_id] = sequence
+        self._since_downlink[node_id] = 0
+        self._set_profile(node_id, self.default_profile)
+        return 1
+
+    def _replay_fallback(self, node_id, before, since):
+        # the node sent this uplink after since - 1 others without a downlink,
+        # stepping back after the ACK_LIMIT-th, ACK_LIMIT + ACK_DELAY-th, ...
+        steps = _steps(since - 1) - _steps(before - 1)
+        if steps <= 0 or node_id not in self._profiles:
+            return
+        profile = dict(self._profiles[node_id])
+        fallback = self.default_profile
+        for _ in range(steps):
+            if profile['tx_power_level'] < fallback['tx_power_level']:
+                profile['tx_power_level'] = fallback['tx_power_level']
+            elif profile['spreading_factor'] < fallback['spreading_factor']:
+                profile['spreading_factor'] = fallback['spreading_factor']
+        self._set_profile(node_id, profile)
+        self.fallbacks += 1
+
+    def _set_profile(self, node_id, profile):
+        # the node changed profile on its own, start a fresh window
+        if profile == self.default_profile:
+            if node_id in self._profiles:
+                del self._profiles[node_id]
+        else:
+            self._profiles[node_id] = profile
+        self._counts[node_id] = 0
+
+
+def _steps(uplinks):
+    # step backs LinkProfile took after uplinks without a downlink
+    return 0 if uplinks < ACK_LIMIT else (uplinks - ACK_LIMIT) // ACK_DELAY + 1
+
+
+class LinkProfile:
+    '''
+    Node side of adaptive data rate.
+    apply() reconfigures the radio with a profile pushed down from the hub.
+    If ack_limit uplinks go by without hearing any downlink, the link is
+    presumed lost and every further ack_delay uplinks the node steps back
+    towards the fallback profile: full power first, then the fallback SF.
+    '''
+
+    def __init__(self, lora, fallback=None, ack_limit=ACK_LIMIT, ack_delay=ACK_DELAY):
+        self.lora = lora
+        # by default the profile the hub's AdaptiveDataRate starts nodes on
+        self.fallback = fallback if fallback else \
+            {'spreading_factor': lora.parameters['spreading_factor'], 'tx_power_level': MAX_TX_POWER}
+        self.ack_limit = ack_limit
+        self.ack_delay = ack_delay
+        self._since_downlink = 0
+        self.fallbacks = 0
+
+    def apply(self, profile):
+        self.lora.configure(profile)
+        self._since_downlink = 0
+
+    def downlink_heard(self):
+        self._since_downlink = 0
+
+    def uplink_sent(self):
+        self._since_downlink += 1
+        overdue = self._since_downlink - self.ack_limit
+        if overdue >= 0 and overdue % self.ack_delay == 0:
+            self._step_back()
+
+    def _step_back(self):
+        parameters = self.lora.parameters
+        if parameters['tx_power_level'] < self.fallback['tx_power_level']:
+            self.lora.configure({'tx_power_level': self.fallback['tx_power_level']})
+        elif parameters['spreading_factor'] < self.fallback['spreading_factor']:
+            # straight back to an SF the hub is known to listen on
+            self.lora.configure({'spreading_factor': self.fallback['spreading_factor']})
+        else:
+            return
+        self.fallbacks += 1
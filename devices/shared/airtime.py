@@ -0,0 +1,181 @@
+from clock import ticks_ms, ticks_diff
+
+# ETSI EN 300 220 sub-bands for EU868 as (low Hz, high Hz, duty cycle).
+EU868_SUB_BANDS = ((863.0E6, 868.0E6, 0.01),
+                   (868.0E6, 868.6E6, 0.01),
+                   (868.7E6, 869.2E6, 0.001),
+                   (869.4E6, 869.65E6, 0.1),
+                   (869.7E6, 870.0E6, 0.01))
+
+ONE_HOUR_MS = 3600 * 1000
+
+
+def symbol_time_ms(parameters):
+    return 1000 * 2**parameters['spreading_factor'] / parameters['signal_bandwidth']
+
+
+def low_data_rate_optimize(parameters):
+    # mandated when the symbol time exceeds 16ms
+    return symbol_time_ms(parameters) > 16
+
+
+def time_on_air_ms(parameters, payload_length):
+    '''
+    Time a packet of payload_length bytes occupies the air, in milliseconds,
+    following the Semtech SX1276 datasheet (section 4.1.1.7) formula for the
+    given parameters dict (as used by SX127x).
+    '''
+    sf = parameters['spreading_factor']
+    t_sym = symbol_time_ms(parameters)
+
+    crc = 1 if parameters['enable_CRC'] else 0
+    ih = 1 if parameters['implicitHeader'] else 0
+    de = 1 if low_data_rate_optimize(parameters) else 0
+    cr = parameters['coding_rate'] - 4
+
+    numerator = 8 * payload_length - 4 * sf + 28 + 16 * crc - 20 * ih
+    denominator = 4 * (sf - 2 * de)
+    payload_symbols = 8 + max(-(-numerator // denominator) * (cr + 4), 0)
+
+    return (parameters['preamble_length'] + 4.25 + payload_symbols) * t_sym
+
+
+class DutyCycleScheduler:
+    '''
+    Keeps transmissions within a rolling airtime budget per sub-band.
+    Each band is (low Hz, high Hz, duty cycle); frequencies outside every band
+    are unrestricted. For a self-imposed budget on a band without regulation
+    (e.g. AU915) pass bands=((915E6, 928E6, 0.01),).
+    Sends that would exceed the budget are queued and released by service().
+    '''
+
+    def __init__(self, bands=EU868_SUB_BANDS, window_ms=ONE_HOUR_MS,
+                 history=64, queue_size=8):
+        self.bands = bands
+        self.window_ms = window_ms
+        self.queue_size = queue_size
+
+        # per band ring of (start ticks, airtime ms) of recent transmissions
+        self._history = history
+        self._starts = [[0] * history for _ in bands]
+        self._airtimes = [[0] * history for _ in bands]
+        self._heads = [0] * len(bands)
+        self._counts = [0] * len(bands)
+
+        self._queue = []
+        self.deferred = 0
+        self.dropped = 0
+
+    def band_of(self, frequency):
+        for i in range(len(self.bands)):
+            low, high, duty = self.bands[i]
+            if low <= frequency < high:
+                return i
+        return -1
+
+    def _expire(self, band, now):
+        # forget transmissions that left the rolling window
+        starts = self._starts[band]
+        while self._counts[band]:
+            oldest = (self._heads[band] - self._counts[band]) % self._history
+            if ticks_diff(now, starts[oldest]) < self.window_ms:
+                break
+            self._counts[band] -= 1
+
+    def used_ms(self, frequency, now=None):
+        band = self.band_of(frequency)
+        if band < 0:
+            return 0
+        now = ticks_ms() if now is None else now
+        self._expire(band, now)
+        airtimes = self._airtimes[band]
+        used = 0
+        for i in range(self._counts[band]):
+            used += airtimes[(self._heads[band] - 1 - i) % self._history]
+        return used
+
+    def delay_ms(self, frequency, airtime_ms, now=None):
+        # how long until airtime_ms fits the budget, 0 if it fits now.
+        band = self.band_of(frequency)
+        if band < 0:
+            return 0
+
+        now = ticks_ms() if now is None else now
+        budget = self.bands[band][2] * self.window_ms
+        excess = self.used_ms(frequency, now) + airtime_ms - budget
+        if excess <= 0 and self._counts[band] < self._history:
+            return 0
+        if airtime_ms > budget:
+            return -1  # never fits
+
+        # wait for the oldest transmissions to expire until the excess is covered
+        # (or, with a full history, at least one slot frees up).
+        starts = self._starts[band]
+        airtimes = self._airtimes[band]
+        for i in range(self._counts[band]):
+            index = (self._heads[band] - self._counts[band] + i) % self._history
+            excess -= airtimes[index]
+            if excess <= 0:
+                return max(self.window_ms - ticks_diff(now, starts[index]), 1)
+        return self.window_ms
+
+    def record(self, frequency, airtime_ms, now=None):
+        band = self.band_of(frequency)
+        if band < 0:
+            return
+        now = ticks_ms() if now is None else now
+        head = self._heads[band]
+        self._starts[band][head] = now
+        self._airtimes[band][head] = airtime_ms
+        self._heads[band] = (head + 1) % self._history
+        self._counts[band] = min(self._counts[band] + 1, self._history)
+
+    def send(self, lora, buffer, implicitHeader=False):
+        # transmit now if the budget allows, otherwise queue for service().
+        # returns True if sent now.
+        if not self._queue:
+            delay = self._try_send(lora, buffer, implicitHeader)
+            if delay == 0:
+                return True
+            if delay < 0:
+                self.dropped += 1
+                return False
+
+        if len(self._queue) >= self.queue_size:
+            self._queue.pop(0)
+            self.dropped += 1
+        self._queue.append((bytes(buffer), implicitHeader))
+        self.deferred += 1
+        return False
+
+    def service(self, lora):
+        # release queued sends in order while the budget allows, returns count sent.
+        sent = 0
+        while self._queue:
+            buffer, implicitHeader = self._queue[0]
+            delay = self._try_send(lora, buffer, implicitHeader)
+            if delay > 0:
+                break
+            self._queue.pop(0)
+            if delay < 0:
+                self.dropped += 1
+            else:
+                sent += 1
+        return sent
+
+    def pending(self):
+        return len(self._queue)
+
+    def _try_send(self, lora, buffer, implicitHeader):
+        # transmits and returns 0 if allowed, otherwise the delay_ms() verdict.
+        frequency = lora.parameters['frequency']
+        airtime = lora.timeOnAir(len(buffer), implicitHeader)
+        delay = self.delay_ms(frequency, airtime)
+        if delay != 0:
+            return delay
+
+        self.record(frequency, airtime)
+        lora.beginPacket(implicitHeader)
+        lora.write(buffer)
+        lora.endPacket()
+        return 0
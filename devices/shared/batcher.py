@@ -0,0 +1,169 @@
+'''
+Node side batching of sensor readings into one frame, hub side unpacking.
+
+A MSG_BATCH frame is the codec header followed by one section per sensor:
+
+    sensor id (B) | value format (B) | scale exponent (b) | time unit ms (H) | count (B)
+    count * (age (H) | value)
+
+age is how long before the frame was built the reading was taken, in time
+units, so the hub timestamps readings against its own clock on arrival.
+Values are fixed-point, value * 10**scale_exponent in the value format.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from array import array
+from clock import ticks_ms, ticks_diff
+from sx127x import MAX_PKT_LENGTH
+import codec
+
+SECTION_FORMAT = '<BBbHB'
+SECTION_SIZE = struct.calcsize(SECTION_FORMAT)
+AGE_FORMAT = '<H'
+AGE_SIZE = struct.calcsize(AGE_FORMAT)
+MAX_AGE = 0xffff
+
+
+class SensorBatch:
+    '''
+    Readings of one sensor waiting to be sent, kept in preallocated arrays.
+    A reading is due to be sent max_latency_ms after the oldest buffered one.
+    '''
+
+    def __init__(self, sensor_id, value_format='h', scale_exponent=2,
+                 max_latency_ms=60000, time_unit_ms=100, capacity=None):
+        self.sensor_id = sensor_id
+        self.value_format = value_format
+        self.scale_exponent = scale_exponent
+        self.scale = 10 ** scale_exponent
+        self.max_latency_ms = max_latency_ms
+        self.time_unit_ms = time_unit_ms
+        self.reading_size = AGE_SIZE + struct.calcsize('<' + value_format)
+        self._reading_format = '<' + value_format
+
+        if capacity is None:
+            capacity = (MAX_PKT_LENGTH - codec.HEADER_SIZE - SECTION_SIZE) // self.reading_size
+        self.capacity = capacity
+        self._ticks = array('L', [0] * capacity)
+        self._values = array(value_format, [0] * capacity)
+        self._count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value, now=None):
+        # False (and the reading dropped) if the batch is full
+        if self._count >= self.capacity:
+            self.dropped += 1
+            return False
+        self._ticks[self._count] = ticks_ms() if now is None else now
+        self._values[self._count] = value if self.value_format == 'f' else round(value * self.scale)
+        self._count += 1
+        return True
+
+    def due(self, now=None):
+        if not self._count:
+            return False
+        if self._count >= self.capacity:
+            return True
+        now = ticks_ms() if now is None else now
+        return ticks_diff(now, self._ticks[0]) >= self.max_latency_ms
+
+    def section_size(self, count=None):
+        return SECTION_SIZE + self.reading_size * (self._count if count is None else count)
+
+    def write_into(self, buffer, offset, space, now):
+        # write as many of the oldest readings as fit in space bytes at
+        # buffer[offset:], drop them from the batch; returns bytes written.
+        count = min(self._count, (space - SECTION_SIZE) // self.reading_size)
+        if count <= 0:
+            return 0
+
+        struct.pack_into(SECTION_FORMAT, buffer, offset, self.sensor_id, ord(self.value_format),
+                         self.scale_exponent, self.time_unit_ms, count)
+        position = offset + SECTION_SIZE
+        for i in range(count):
+            age = ticks_diff(now, self._ticks[i]) // self.time_unit_ms
+            struct.pack_into(AGE_FORMAT, buffer, position, min(max(age, 0), MAX_AGE))
+            struct.pack_into(self._reading_format, buffer, position + AGE_SIZE, self._values[i])
+            position += self.reading_size
+
+        # keep what did not fit, oldest first
+        for i in range(count, self._count):
+            self._ticks[i - count] = self._ticks[i]
+            self._values[i - count] = self._values[i]
+        self._count -= count
+        return position - offset
+
+
+class Batcher:
+    '''
+    Packs the batches of several sensors into MSG_BATCH frames.
+    due() tells when a frame should go out: a sensor's latency deadline
+    expired, or the buffered readings (nearly) fill a frame.
+    '''
+
+    def __init__(self, batches, max_frame=MAX_PKT_LENGTH):
+        self.batches = batches
+        self.max_frame = max_frame
+        self._by_id = {}
+        for batch in batches:
+            self._by_id[batch.sensor_id] = batch
+
+    def add(self, sensor_id, value, now=None):
+        return self._by_id[sensor_id].add(value, now)
+
+    def pending_size(self):
+        size = codec.HEADER_SIZE
+        for batch in self.batches:
+            if len(batch):
+                size += batch.section_size()
+        return size
+
+    def due(self, now=None):
+        now = ticks_ms() if now is None else now
+        largest_reading = max(batch.reading_size for batch in self.batches)
+        if self.pending_size() + largest_reading > self.max_frame:
+            return True
+        for batch in self.batches:
+            if batch.due(now):
+                return True
+        return False
+
+    def encode_into(self, buffer, node_id, sequence, now=None):
+        # returns the frame length, 0 if nothing was buffered
+        now = ticks_ms() if now is None else now
+        position = codec.BATCH.encode_into(buffer, node_id, sequence, ())
+        for batch in self.batches:
+            if len(batch):
+                position += batch.write_into(buffer, position, self.max_frame - position, now)
+        return position if position > codec.HEADER_SIZE else 0
+
+
+def unpack(view, arrival_ms, handler, offset=0):
+    # hand every reading of the MSG_BATCH frame at view[offset:] to
+    # handler(node_id, sensor_id, timestamp_ms, value); returns the reading count.
+    node_id, sequence, msg_type = codec.decode_header(view, offset)
+    if msg_type != codec.MSG_BATCH:
+        raise Exception('Not a batch frame.')
+
+    count = 0
+    position = offset + codec.HEADER_SIZE
+    end = len(view)
+    while position + SECTION_SIZE <= end:
+        sensor_id, value_format, scale_exponent, time_unit_ms, readings = \
+            struct.unpack_from(SECTION_FORMAT, view, position)
+        reading_format = '<' + chr(value_format)
+        position += SECTION_SIZE
+        scale = 10 ** scale_exponent
+        for i in range(readings):
+            age, = struct.unpack_from(AGE_FORMAT, view, position)
+            value, = struct.unpack_from(reading_format, view, position + AGE_SIZE)
+            position += AGE_SIZE + struct.calcsize(reading_format)
+            handler(node_id, sensor_id, arrival_ms - age * time_unit_ms,
+                    value if value_format == ord('f') else value / scale)
+            count += 1
+    return count
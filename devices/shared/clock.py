@@ -0,0 +1,18 @@
+try:
+    from utime import ticks_ms, ticks_us, ticks_diff, ticks_add
+
+except ImportError:
+    # not micropython, monotonic ticks that never wrap.
+    from time import perf_counter
+
+    def ticks_ms():
+        return int(perf_counter() * 1000)
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(new, old):
+        return new - old
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
@@ -0,0 +1,128 @@
+'''
+Binary frame codec shared by nodes and hub.
+
+A frame is a fixed header followed by the fields of the schema registered
+for its message type:
+
+    version (B) | node id (H) | sequence (H) | message type (B) | fields ...
+
+All little endian. Fields are fixed-point: a float is sent as
+round(value * scale) in the field's struct format and divided back on
+decode. Decoding works straight from a memoryview (e.g. a receive ring
+slot) with struct.unpack_from, without slicing the payload.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+
+CODEC_VERSION = 1
+
+HEADER_FORMAT = '<BHHB'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_FRAME_SIZE = 255  # SX127x FIFO
+
+MSG_COUNTER = 1
+MSG_HEARTBEAT = 2
+MSG_ENVIRONMENT = 3
+MSG_BATCH = 4
+MSG_SERIES = 5
+MSG_ACK = 6
+MSG_BEACON = 7
+MSG_DOWNLINK = 8
+
+SCHEMAS = {}
+
+
+class Schema:
+    '''
+    fields: sequence of (name, struct format character, scale).
+    fixed: False if a variable length body follows the fields.
+    '''
+
+    def __init__(self, msg_type, name, fields, fixed=True):
+        self.msg_type = msg_type
+        self.fixed = fixed
+        self.name = name
+        self.names = tuple(field[0] for field in fields)
+        self.scales = tuple(field[2] for field in fields)
+        self.format = '<' + ''.join(field[1] for field in fields)
+        self.size = HEADER_SIZE + struct.calcsize(self.format)
+
+    def encode_into(self, buffer, node_id, sequence, values, offset=0):
+        # returns the frame length written at buffer[offset:]
+        struct.pack_into(HEADER_FORMAT, buffer, offset,
+                         CODEC_VERSION, node_id & 0xffff, sequence & 0xffff, self.msg_type)
+        scales = self.scales
+        struct.pack_into(self.format, buffer, offset + HEADER_SIZE,
+                         *[value if scale == 1 else round(value * scale)
+                           for value, scale in zip(values, scales)])
+        return self.size
+
+    def decode(self, view, offset=0):
+        # field values of the frame at view[offset:], scaled back
+        raw = struct.unpack_from(self.format, view, offset + HEADER_SIZE)
+        scales = self.scales
+        return tuple(value if scale == 1 else value / scale for value, scale in zip(raw, scales))
+
+    def describe(self, values):
+        return ' '.join('{}={}'.format(name, value) for name, value in zip(self.names, values))
+
+
+def register(schema):
+    SCHEMAS[schema.msg_type] = schema
+    return schema
+
+
+def decode_header(view, offset=0):
+    # (node id, sequence, message type) of the frame at view[offset:]
+    if len(view) - offset < HEADER_SIZE:
+        raise Exception('Frame too short for a header.')
+    version, node_id, sequence, msg_type = struct.unpack_from(HEADER_FORMAT, view, offset)
+    if version != CODEC_VERSION:
+        raise Exception('Unsupported codec version {}.'.format(version))
+    return node_id, sequence, msg_type
+
+
+def decode(view, offset=0):
+    # (node id, sequence, schema, values) of the frame at view[offset:]
+    node_id, sequence, msg_type = decode_header(view, offset)
+    schema = SCHEMAS.get(msg_type)
+    if schema is None:
+        raise Exception('Unknown message type {}.'.format(msg_type))
+    if len(view) - offset < schema.size:
+        raise Exception('Frame too short for {}.'.format(schema.name))
+    return node_id, sequence, schema, schema.decode(view, offset)
+
+
+COUNTER = register(Schema(MSG_COUNTER, 'counter', (('counter', 'I', 1),)))
+
+HEARTBEAT = register(Schema(MSG_HEARTBEAT, 'heartbeat', (('uptime_s', 'I', 1),
+                                                         ('battery_v', 'H', 1000),
+                                                         ('free_kb', 'H', 1))))
+
+ENVIRONMENT = register(Schema(MSG_ENVIRONMENT, 'environment', (('temperature_c', 'h', 100),
+                                                               ('humidity_pct', 'H', 100),
+                                                               ('pressure_hpa', 'H', 10))))
+
+# header only here, the variable length body is packed and unpacked by batcher.py
+BATCH = register(Schema(MSG_BATCH, 'batch', (), fixed=False))
+
+# sensor id, the node's ms clock as the frame is built, then a compressed
+# (timestamp, value) series from compress.py, timestamps on that same clock
+# (32 bits, not ticks_ms() which wraps sooner); the hub moves them onto its own
+SERIES = register(Schema(MSG_SERIES, 'series', (('sensor_id', 'B', 1), ('sent_ms', 'I', 1)), fixed=False))
+
+# downlink, node id is the addressee: latest sequence number heard from it
+# and a bitmap of the 32 before (see reliable.py)
+ACK = register(Schema(MSG_ACK, 'ack', (('latest', 'H', 1), ('received', 'I', 1))))
+
+# downlink broadcast, node id is the hub's: hub clock when it went on air,
+# the beacon period and a count of slot map entries following (see tdma.py)
+BEACON = register(Schema(MSG_BEACON, 'beacon', (('time_s', 'I', 1), ('time_ms', 'H', 1),
+                                                ('period_ms', 'I', 1), ('slots', 'B', 1)), fixed=False))
+
+# downlink, node id is the addressee: a count of (key, length, value)
+# updates following, answered in the node's receive window (see downlink.py)
+DOWNLINK = register(Schema(MSG_DOWNLINK, 'downlink', (('updates', 'B', 1),), fixed=False))
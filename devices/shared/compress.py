@@ -0,0 +1,330 @@
+'''
+Time series compression for sensor payloads (after Pelkonen et al., Gorilla).
+
+A series of (timestamp, value) samples is packed into a bit stream:
+
+    kind (B) | sample count (B) | first timestamp (32 bits) | first value | samples ...
+
+Timestamps are integers (ms or s) stored as delta-of-delta, which is 1 bit
+for a sample taken on schedule:
+
+    '0'                     unchanged delta
+    '10'   + 7 bits         delta-of-delta in [-63, 64]
+    '110'  + 9 bits         [-255, 256]
+    '1110' + 12 bits        [-2047, 2048]
+    '1111' + 32 bits        anything else
+
+Integer values are stored as the zigzag varint of the change from the
+previous value (one byte as long as it moved by less than 64). Float values
+(single precision) are XORed with the previous one:
+
+    '0'                     same value
+    '10' + meaningful bits  the XOR fits the previous leading / trailing zero window
+    '11' + 5 bits leading zeros + 5 bits length - 1 + meaningful bits
+
+The encoder writes into a caller supplied buffer (e.g. after a codec header,
+ahead of SX127x.write()) and keeps its state in a few ints, so it runs in
+bounded memory. add() returns False, and leaves the stream as it was, when
+the sample does not fit.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+KIND_INTEGER = 0
+KIND_FLOAT = 1
+
+HEADER_SIZE = 2
+MAX_SAMPLES = 255
+
+_NO_WINDOW = 32
+
+
+def _leading_zeros(x):
+    # of a non-zero 32 bit value
+    n = 0
+    if not (x & 0xffff0000):
+        n += 16
+        x <<= 16
+    if not (x & 0xff000000):
+        n += 8
+        x <<= 8
+    if not (x & 0xf0000000):
+        n += 4
+        x <<= 4
+    if not (x & 0xc0000000):
+        n += 2
+        x <<= 2
+    if not (x & 0x80000000):
+        n += 1
+    return n
+
+
+def _trailing_zeros(x):
+    # of a non-zero 32 bit value
+    n = 0
+    if not (x & 0xffff):
+        n += 16
+        x >>= 16
+    if not (x & 0xff):
+        n += 8
+        x >>= 8
+    if not (x & 0xf):
+        n += 4
+        x >>= 4
+    if not (x & 0x3):
+        n += 2
+        x >>= 2
+    if not (x & 0x1):
+        n += 1
+    return n
+
+
+class SeriesEncoder:
+
+    def __init__(self, buffer, kind=KIND_INTEGER, offset=0, end=None):
+        self.buffer = buffer
+        self.kind = kind
+        self.offset = offset
+        self.end = len(buffer) if end is None else end
+        self._scratch = bytearray(4)
+        self.reset()
+
+    def reset(self):
+        buffer = self.buffer
+        for i in range(self.offset, self.end):
+            buffer[i] = 0
+        self._bit = (self.offset + HEADER_SIZE) * 8
+        self._overflow = False
+        self.count = 0
+        self._timestamp = 0
+        self._delta = 0
+        self._value = 0
+        self._leading = _NO_WINDOW
+        self._trailing = 0
+
+    def _write(self, value, bits):
+        # most significant bit first
+        bit = self._bit
+        if self._overflow or bit + bits > self.end * 8:
+            self._overflow = True
+            return
+        buffer = self.buffer
+        while bits:
+            index = bit >> 3
+            free = 8 - (bit & 7)
+            take = free if bits > free else bits
+            bits -= take
+            buffer[index] |= ((value >> bits) & ((1 << take) - 1)) << (free - take)
+            bit += take
+        self._bit = bit
+
+    def _truncate(self, bit):
+        # drop everything written after bit
+        buffer = self.buffer
+        index = bit >> 3
+        if bit & 7:
+            buffer[index] &= (0xff << (8 - (bit & 7))) & 0xff
+            index += 1
+        for i in range(index, (self._bit + 7) >> 3):
+            buffer[i] = 0
+        self._bit = bit
+        self._overflow = False
+
+    def _write_varint(self, value):
+        value = value << 1 if value >= 0 else ((-value) << 1) - 1
+        while value > 0x7f:
+            self._write((value & 0x7f) | 0x80, 8)
+            value >>= 7
+        self._write(value, 8)
+
+    def _write_delta_of_delta(self, dod):
+        if dod == 0:
+            self._write(0, 1)
+        elif -63 <= dod <= 64:
+            self._write(0b10, 2)
+            self._write(dod + 63, 7)
+        elif -255 <= dod <= 256:
+            self._write(0b110, 3)
+            self._write(dod + 255, 9)
+        elif -2047 <= dod <= 2048:
+            self._write(0b1110, 4)
+            self._write(dod + 2047, 12)
+        else:
+            self._write(0b1111, 4)
+            self._write(dod & 0xffffffff, 32)
+
+    def _float_bits(self, value):
+        struct.pack_into('<f', self._scratch, 0, value)
+        return int.from_bytes(self._scratch, 'little')
+
+    def _write_xor(self, xor):
+        if xor == 0:
+            self._write(0, 1)
+            return
+        leading = _leading_zeros(xor)
+        trailing = _trailing_zeros(xor)
+        if leading >= self._leading and trailing >= self._trailing:
+            self._write(0b10, 2)
+            self._write(xor >> self._trailing, 32 - self._leading - self._trailing)
+        else:
+            meaningful = 32 - leading - trailing
+            self._write(0b11, 2)
+            self._write(leading, 5)
+            self._write(meaningful - 1, 5)
+            self._write(xor >> trailing, meaningful)
+            self._leading = leading
+            self._trailing = trailing
+
+    def add(self, timestamp, value):
+        if self.count >= MAX_SAMPLES:
+            return False
+        bit = self._bit
+        leading = self._leading
+        trailing = self._trailing
+
+        if self.kind == KIND_FLOAT:
+            value = self._float_bits(value)
+        if self.count == 0:
+            delta = 0
+            self._write(timestamp & 0xffffffff, 32)
+            if self.kind == KIND_FLOAT:
+                self._write(value, 32)
+            else:
+                self._write_varint(value)
+        else:
+            delta = timestamp - self._timestamp
+            self._write_delta_of_delta(delta - self._delta)
+            if self.kind == KIND_FLOAT:
+                self._write_xor(value ^ self._value)
+            else:
+                self._write_varint(value - self._value)
+
+        if self._overflow:
+            self._truncate(bit)
+            self._leading = leading
+            self._trailing = trailing
+            return False
+        self._timestamp = timestamp
+        self._delta = delta
+        self._value = value
+        self.count += 1
+        return True
+
+    def finish(self):
+        # fills in the header, returns the length of buffer used (offset included)
+        self.buffer[self.offset] = self.kind
+        self.buffer[self.offset + 1] = self.count
+        return (self._bit + 7) >> 3
+
+
+class SeriesDecoder:
+    '''
+    Reads the samples back one at a time:
+
+        decoder = SeriesDecoder(view, offset)
+        while decoder.next():
+            use(decoder.timestamp, decoder.value)
+    '''
+
+    def __init__(self, view, offset=0):
+        self.view = view
+        self.kind = view[offset]
+        self.remaining = view[offset + 1]
+        self._bit = (offset + HEADER_SIZE) * 8
+        self._end = len(view) * 8
+        self._scratch = bytearray(4)
+        self._first = True
+        self._delta = 0
+        self._bits = 0
+        self._leading = 0
+        self._trailing = 0
+        self.timestamp = 0
+        self.value = 0
+
+    def _read(self, bits):
+        bit = self._bit
+        if bit + bits > self._end:
+            raise Exception('Compressed series truncated.')
+        view = self.view
+        value = 0
+        while bits:
+            available = 8 - (bit & 7)
+            take = available if bits > available else bits
+            value = (value << take) | ((view[bit >> 3] >> (available - take)) & ((1 << take) - 1))
+            bits -= take
+            bit += take
+        self._bit = bit
+        return value
+
+    def _read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self._read(8)
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not (byte & 0x80):
+                break
+        return value >> 1 if not (value & 1) else -((value + 1) >> 1)
+
+    def _read_delta_of_delta(self):
+        if not self._read(1):
+            return 0
+        if not self._read(1):
+            return self._read(7) - 63
+        if not self._read(1):
+            return self._read(9) - 255
+        if not self._read(1):
+            return self._read(12) - 2047
+        dod = self._read(32)
+        return dod - 0x100000000 if dod & 0x80000000 else dod
+
+    def _read_xor(self):
+        if not self._read(1):
+            return 0
+        if self._read(1):
+            self._leading = self._read(5)
+            meaningful = self._read(5) + 1
+            self._trailing = 32 - self._leading - meaningful
+        return self._read(32 - self._leading - self._trailing) << self._trailing
+
+    def _float(self, bits):
+        struct.pack_into('<I', self._scratch, 0, bits)
+        return struct.unpack_from('<f', self._scratch, 0)[0]
+
+    def next(self):
+        if not self.remaining:
+            return False
+        self.remaining -= 1
+
+        if self._first:
+            self._first = False
+            self.timestamp = self._read(32)
+            if self.kind == KIND_FLOAT:
+                self._bits = self._read(32)
+            else:
+                self.value = self._read_varint()
+        else:
+            self._delta += self._read_delta_of_delta()
+            self.timestamp += self._delta
+            if self.kind == KIND_FLOAT:
+                self._bits ^= self._read_xor()
+            else:
+                self.value += self._read_varint()
+
+        if self.kind == KIND_FLOAT:
+            self.value = self._float(self._bits)
+        return True
+
+
+def decode(view, handler, offset=0):
+    # hand every sample of the series at view[offset:] to handler(timestamp, value);
+    # returns the sample count.
+    decoder = SeriesDecoder(view, offset)
+    count = 0
+    while decoder.next():
+        handler(decoder.timestamp, decoder.value)
+        count += 1
+    return count
@@ -19,3 +19,9 @@ def get_nodename():
     uuid = ubinascii.hexlify(machine.unique_id()).decode()
     node_name = "ESP_" + uuid
     return node_name
+
+
+def get_node_id():
+    # 16 bit short id for frame headers, from the NIC specific half of the MAC
+    uuid = machine.unique_id()
+    return (uuid[-2] << 8) | uuid[-1]
@@ -1,4 +1,7 @@
 from time import sleep
+from timeline import TIMELINE
+
+SPAN_RESET_PIN = TIMELINE.span_id('controller.reset_pin')
 
 
 class Controller:
@@ -34,8 +37,11 @@ class Controller:
         self.pin_led = self.prepare_pin(pin_id_led)
         self.on_board_led_high_is_on = on_board_led_high_is_on
         self.pin_reset = self.prepare_pin(pin_id_reset)
+        started = TIMELINE.begin()
         self.reset_pin(self.pin_reset)
+        TIMELINE.end(SPAN_RESET_PIN, started)
         self.transceivers = {}
+        self.spi = None
         self.blink_led(*blink_on_start)
 
 
@@ -57,8 +63,13 @@ class Controller:
         transceiver.pin_CadDetected = self.prepare_irq_pin(pin_id_CadDetected)
         transceiver.pin_PayloadCrcError = self.prepare_irq_pin(pin_id_PayloadCrcError)
 
-        self.spi = self.prepare_spi(self.get_spi())
+        # every transceiver shares the one SPI bus, selected by its own SS pin.
+        if self.spi is None:
+            self.spi = self.prepare_spi(self.get_spi())
         transceiver.transfer = self.spi.transfer
+        transceiver.read_burst = self.spi.read_burst
+        transceiver.write_burst = self.spi.write_burst
+        transceiver.spi_lock = self.spi.lock
 
         transceiver.init()
 
@@ -99,6 +110,9 @@ class Controller:
             # a spi should provide:
             # .close()
             # .transfer(pin_ss, address, value = 0x00)
+            # .read_burst(pin_ss, address, buffer)   # fill buffer in one transaction.
+            # .write_burst(pin_ss, address, buffer)  # send buffer in one transaction.
+            # .lock                                  # held for the duration of every transaction.
         '''
         raise NotImplementedError(reason)
 
@@ -1,4 +1,5 @@
 from machine import Pin, SPI, reset
+from _thread import allocate_lock
 from controller import Controller
 
 
@@ -88,20 +89,50 @@ class ESP32Controller(Controller):
 
         if spi:
             new_spi = Controller.Mock()
+            address_buffer = bytearray(1)
+            lock = allocate_lock()  # several transceivers (and threads) share the bus
 
             def transfer(pin_ss, address, value = 0x00):
                 response = bytearray(1)
 
-                pin_ss.low()
+                with lock:
+                    pin_ss.low()
 
-                spi.write(bytes([address]))
-                spi.write_readinto(bytes([value]), response)
+                    spi.write(bytes([address]))
+                    spi.write_readinto(bytes([value]), response)
 
-                pin_ss.high()
+                    pin_ss.high()
 
                 return response
 
+            # burst access: the SX127x auto-increments (or, for REG_FIFO, streams)
+            # while chip select stays low, so a whole payload is one transaction.
+            def read_burst(pin_ss, address, buffer):
+                with lock:
+                    address_buffer[0] = address
+
+                    pin_ss.low()
+
+                    spi.write(address_buffer)
+                    spi.readinto(buffer, 0x00)
+
+                    pin_ss.high()
+
+            def write_burst(pin_ss, address, buffer):
+                with lock:
+                    address_buffer[0] = address
+
+                    pin_ss.low()
+
+                    spi.write(address_buffer)
+                    spi.write(buffer)
+
+                    pin_ss.high()
+
             new_spi.transfer = transfer
+            new_spi.read_burst = read_burst
+            new_spi.write_burst = write_burst
+            new_spi.lock = lock
             new_spi.close = spi.deinit
             return new_spi
 
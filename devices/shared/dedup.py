@@ -0,0 +1,124 @@
+from array import array
+
+WINDOW_BITS = 32  # sequence numbers before the latest one a node's window remembers
+
+
+def sequence_distance(newer, older):
+    # how far newer is ahead of older in the 16 bit sequence space, negative if behind
+    distance = (newer - older) & 0xffff
+    return distance - 0x10000 if distance & 0x8000 else distance
+
+
+class Deduplicator:
+    '''
+    Hub side duplicate suppression keyed on (node id, sequence number), for
+    retransmissions and for frames heard by several radios or hubs.
+    Every node gets a slot with the latest sequence number heard and a bitmap
+    of the WINDOW_BITS before it (bit i: latest - 1 - i). Slots are
+    preallocated, max_nodes of them, and the least recently heard node
+    gives up its slot when they run out, so memory stays bounded however
+    many nodes there are. A sequence number further than WINDOW_BITS from
+    the latest, ahead or behind, re-bases the window: a node that reboots
+    starts over at 0 and must not be taken for repeats. check() is O(1): one dict lookup, a few array
+    updates and a move to the front of the LRU list.
+    '''
+
+    def __init__(self, max_nodes=1024):
+        self.max_nodes = max_nodes
+        self._slots = {}  # node id => slot
+        self._nodes = array('H', [0] * max_nodes)
+        self._latest = array('H', [0] * max_nodes)
+        self._bitmaps = array('L', [0] * max_nodes)
+
+        # doubly linked LRU list over the slots, most recent first;
+        # index max_nodes is the head, free slots sit at the tail.
+        self._next = array('H', [(i + 1) % (max_nodes + 1) for i in range(max_nodes + 1)])
+        self._prev = array('H', [(i - 1) % (max_nodes + 1) for i in range(max_nodes + 1)])
+
+        self.hits = 0       # duplicates dropped
+        self.misses = 0     # new frames let through
+        self.evictions = 0  # nodes forgotten for lack of slots
+        self.restarts = 0   # sequence jumps beyond the window, taken as node reboots
+
+    def _unlink(self, slot):
+        self._next[self._prev[slot]] = self._next[slot]
+        self._prev[self._next[slot]] = self._prev[slot]
+
+    def _link_after(self, slot, after):
+        self._prev[slot] = after
+        self._next[slot] = self._next[after]
+        self._prev[self._next[after]] = slot
+        self._next[after] = slot
+
+    def _allocate(self, node_id):
+        head = self.max_nodes
+        slot = self._prev[head]
+        occupant = self._nodes[slot]
+        if self._slots.get(occupant) == slot:
+            del self._slots[occupant]
+            self.evictions += 1
+        self._slots[node_id] = slot
+        self._nodes[slot] = node_id
+        return slot
+
+    def check(self, node_id, sequence):
+        # True if (node id, sequence) is new and the frame should go on
+        head = self.max_nodes
+        slot = self._slots.get(node_id)
+        if slot is None:
+            slot = self._allocate(node_id)
+            self._latest[slot] = sequence
+            self._bitmaps[slot] = 0
+            fresh = True
+        else:
+            fresh = self._update(slot, sequence)
+
+        self._unlink(slot)
+        self._link_after(slot, head)
+        if fresh:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fresh
+
+    def _update(self, slot, sequence):
+        distance = sequence_distance(sequence, self._latest[slot])
+        if distance > WINDOW_BITS or distance < -WINDOW_BITS:
+            # beyond the window either way: the node restarted its sequence
+            # numbers (a reboot) or was away long, start over from this frame
+            self._bitmaps[slot] = 0
+            self._latest[slot] = sequence
+            self.restarts += 1
+            return True
+        if distance > 0:
+            self._bitmaps[slot] = ((self._bitmaps[slot] << distance) |
+                                   (1 << (distance - 1))) & 0xffffffff
+            self._latest[slot] = sequence
+            return True
+        if distance == 0:
+            return False  # a repeat
+        bit = 1 << (-distance - 1)
+        if self._bitmaps[slot] & bit:
+            return False
+        self._bitmaps[slot] |= bit
+        return True
+
+    def window(self, node_id):
+        # (latest sequence number, bitmap) heard from the node, None if unknown
+        slot = self._slots.get(node_id)
+        if slot is None:
+            return None
+        return self._latest[slot], self._bitmaps[slot]
+
+    def forget(self, node_id):
+        slot = self._slots.pop(node_id, None)
+        if slot is not None:
+            self._unlink(slot)
+            self._link_after(slot, self._prev[self.max_nodes])
+
+    def __len__(self):
+        return len(self._slots)
+
+    def stats(self):
+        return {'nodes': len(self._slots), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'restarts': self.restarts}
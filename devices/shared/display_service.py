@@ -0,0 +1,111 @@
+'''
+Display rendering off the radio path.
+
+The radio loop only calls update(), which stores the latest value of a
+piece of state and returns; a burst of packets just overwrites the same
+entries. A worker thread (start()), a coroutine (serve()) or a poll loop
+(service()) renders what changed at most max_fps times a second: the
+static chrome, drawn once into its own framebuffer at start, is blitted,
+render(screen, state) draws the rest and show() sends the changed pages.
+A splash screen can play as the thread's intro while the radio is already
+receiving.
+'''
+import _thread
+import framebuf
+from time import sleep
+from clock import ticks_ms, ticks_diff
+from timeline import TIMELINE
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+SPAN_DISPLAY_VIEW = TIMELINE.span_id('display_view')  # render and show, one frame
+
+
+class DisplayService:
+
+    def __init__(self, screen, render, chrome=None, max_fps=5):
+        # chrome(fbuf) draws the static parts, render(screen, state) the rest
+        self.screen = screen
+        self.render = render
+        self.interval_ms = 1000 // max_fps
+        self.state = {}
+
+        self._chrome = None
+        if chrome:
+            self._chrome_buffer = bytearray(screen.pages * screen.width)
+            self._chrome = framebuf.FrameBuffer(self._chrome_buffer, screen.width, screen.height,
+                                                framebuf.MONO_VLSB)
+            chrome(self._chrome)
+
+        self._lock = _thread.allocate_lock()
+        self._changed = False
+        self._last_render = ticks_ms() - self.interval_ms
+        self._running = False
+        self._stopped = True
+
+        self.updates = 0
+        self.frames = 0
+
+    def update(self, name, value):
+        # called from the radio path, never touches the display
+        with self._lock:
+            self.state[name] = value
+            self._changed = True
+            self.updates += 1
+
+    def wait_ms(self):
+        # ms until the next frame may be rendered, -1 if nothing changed
+        if not self._changed:
+            return -1
+        return max(self.interval_ms - ticks_diff(ticks_ms(), self._last_render), 0)
+
+    def service(self):
+        # render a frame if something changed and the frame rate allows, True if it did
+        if self.wait_ms() != 0:
+            return False
+        with self._lock:
+            state = dict(self.state)  # the radio path may update while rendering
+            self._changed = False
+        started = TIMELINE.begin()
+        screen = self.screen
+        if self._chrome:
+            screen.blit(self._chrome, 0, 0, screen.width, screen.height)
+        else:
+            screen.fill(0)
+        self.render(screen, state)
+        screen.show()
+        TIMELINE.end(SPAN_DISPLAY_VIEW, started)
+        self._last_render = ticks_ms()
+        self.frames += 1
+        return True
+
+    def start(self, intro=None):
+        # intro(screen), e.g. a splash animation, plays first in the thread
+        self._running = True
+        self._stopped = False
+        _thread.start_new_thread(self._run, (intro,))
+
+    def stop(self):
+        self._running = False
+        while not self._stopped:
+            sleep(self.interval_ms / 1000)
+
+    def _run(self, intro):
+        try:
+            if intro:
+                intro(self.screen)
+            while self._running:
+                if not self.service():
+                    wait = self.wait_ms()
+                    sleep((wait if wait > 0 else self.interval_ms) / 1000)
+        finally:
+            self._stopped = True
+
+    async def serve(self):
+        while True:
+            if not self.service():
+                wait = self.wait_ms()
+                await asyncio.sleep((wait if wait > 0 else self.interval_ms) / 1000)
@@ -0,0 +1,316 @@
+'''
+Downlink to nodes that only listen right after they transmit.
+
+A node opens one short receive window after each uplink (ReceiveWindow,
+the radio in MODE_RX_SINGLE with a timeout, in standby or asleep the rest
+of the cycle). The hub answers inside it with one DOWNLINK frame
+coalescing what it holds for that node: its ACK, if it has one pending,
+and then the queued updates by priority, as many as fit:
+
+    updates (B) | key (B) | length (B) | value ... | key (B) | ...
+
+DownlinkQueue keeps the updates per node on the hub, DownlinkHandler
+hands them out on the node.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from time import sleep
+from clock import ticks_ms, ticks_diff, ticks_add
+from sx127x import IRQ_RX_DONE_MASK, IRQ_RX_TIME_OUT_MASK, IRQ_PAYLOAD_CRC_ERROR_MASK, REG_DIO_MAPPING_1
+from airtime import symbol_time_ms
+import codec
+
+ENTRY_FORMAT = '<BB'  # key, value length
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+# update keys and their value formats
+UPDATE_ACK = 0       # latest, received bitmap (see reliable.py)
+UPDATE_PROFILE = 1   # spreading factor, TX power (see adr.py)
+UPDATE_INTERVAL = 2  # seconds between uplinks
+ACK_FORMAT = '<HI'
+PROFILE_FORMAT = '<Bb'
+INTERVAL_FORMAT = '<I'
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+DEFAULT_TTL_MS = 24 * 3600 * 1000
+RX_WINDOW_MS = 250
+DOWNLINK_SIZE = 32  # largest DOWNLINK frame, the TDMA slots reserve its time on air
+
+
+def pack_profile(profile):
+    return struct.pack(PROFILE_FORMAT, profile['spreading_factor'], profile['tx_power_level'])
+
+
+def unpack_profile(view, offset):
+    spreading_factor, tx_power_level = struct.unpack_from(PROFILE_FORMAT, view, offset)
+    return {'spreading_factor': spreading_factor, 'tx_power_level': tx_power_level}
+
+
+def unpack(view, handler, offset=0):
+    # hands handler(key, view, value offset, value length) every update of
+    # the DOWNLINK frame at view[offset:], returns their count
+    count = codec.DOWNLINK.decode(view, offset)[0]
+    position = offset + codec.DOWNLINK.size
+    for i in range(count):
+        key, length = struct.unpack_from(ENTRY_FORMAT, view, position)
+        position += ENTRY_SIZE
+        if position + length > len(view):
+            raise Exception('Downlink update {} truncated.'.format(key))
+        handler(key, view, position, length)
+        position += length
+    return count
+
+
+class DownlinkQueue:
+    '''
+    Hub side: a bounded queue of pending updates per node (depth entries,
+    max_nodes nodes), each with a priority and an expiry. An update with
+    the key of one still pending replaces it, so a node that was away only
+    gets the latest value. When a queue is full the lowest priority entry
+    gives way, unless the new one ranks lower still.
+    '''
+
+    def __init__(self, max_nodes=64, depth=4):
+        self.max_nodes = max_nodes
+        self.depth = depth
+        self._queues = {}  # node id => list of [priority, expires, key, value]
+
+        self.queued = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def put(self, node_id, key, value, priority=PRIORITY_NORMAL, ttl_ms=DEFAULT_TTL_MS, now=None):
+        # True if the update is queued
+        now = ticks_ms() if now is None else now
+        expires = ticks_add(now, ttl_ms)
+        queue = self._queues.get(node_id)
+        if queue is None:
+            if len(self._queues) >= self.max_nodes:
+                self.dropped += 1
+                return False
+            queue = self._queues[node_id] = []
+
+        for entry in queue:
+            if entry[2] == key:
+                entry[0] = max(entry[0], priority)
+                entry[1] = expires
+                entry[3] = bytes(value)
+                self.coalesced += 1
+                return True
+
+        self._expire(queue, now)
+        if len(queue) >= self.depth:
+            lowest = 0
+            for i in range(1, len(queue)):
+                if queue[i][0] < queue[lowest][0]:
+                    lowest = i
+            if queue[lowest][0] > priority:
+                self.dropped += 1
+                return False
+            del queue[lowest]
+            self.dropped += 1
+
+        queue.append([priority, expires, key, bytes(value)])
+        self.queued += 1
+        return True
+
+    def _expire(self, queue, now):
+        i = 0
+        while i < len(queue):
+            if ticks_diff(queue[i][1], now) < 0:
+                del queue[i]
+                self.expired += 1
+            else:
+                i += 1
+
+    def pending(self, node_id, now=None):
+        queue = self._queues.get(node_id)
+        if not queue:
+            return 0
+        self._expire(queue, ticks_ms() if now is None else now)
+        return len(queue)
+
+    def forget(self, node_id):
+        self._queues.pop(node_id, None)
+
+    def frame_into(self, buffer, node_id, sequence, acks=None, now=None):
+        # the DOWNLINK frame for the node's receive window: its pending ACK
+        # from an AckTracker, then updates by priority while they fit in
+        # buffer. Returns its length, 0 if there is nothing to send.
+        queue = self._queues.get(node_id)
+        if queue:
+            self._expire(queue, ticks_ms() if now is None else now)
+            queue.sort(key=lambda entry: -entry[0])  # stable, oldest first within a priority
+        window = acks.take(node_id) if acks is not None and acks.pending(node_id) else None
+        if not queue and window is None:
+            return 0
+
+        end = min(len(buffer), codec.MAX_FRAME_SIZE)
+        size = codec.DOWNLINK.size
+        count = 0
+        if window is not None:
+            struct.pack_into(ENTRY_FORMAT, buffer, size, UPDATE_ACK, struct.calcsize(ACK_FORMAT))
+            struct.pack_into(ACK_FORMAT, buffer, size + ENTRY_SIZE, window[0], window[1])
+            size += ENTRY_SIZE + struct.calcsize(ACK_FORMAT)
+            count += 1
+
+        i = 0
+        while queue and i < len(queue):
+            value = queue[i][3]
+            if size + ENTRY_SIZE + len(value) > end:
+                i += 1  # a smaller one further down may still fit
+                continue
+            struct.pack_into(ENTRY_FORMAT, buffer, size, queue[i][2], len(value))
+            buffer[size + ENTRY_SIZE:size + ENTRY_SIZE + len(value)] = value
+            size += ENTRY_SIZE + len(value)
+            count += 1
+            del queue[i]
+            self.delivered += 1
+        if not queue and node_id in self._queues:
+            del self._queues[node_id]
+
+        codec.DOWNLINK.encode_into(buffer, node_id, sequence, (count,))
+        return size
+
+    def stats(self):
+        return {'nodes': len(self._queues), 'queued': self.queued, 'coalesced': self.coalesced,
+                'expired': self.expired, 'dropped': self.dropped, 'delivered': self.delivered}
+
+
+class ReceiveWindow:
+    '''
+    Node side: listen() opens a single receive window, the radio in
+    MODE_RX_SINGLE giving up timeout_ms after it started unless a preamble
+    begins, and hands handler(payload, ticks) the frame heard, if any. The
+    radio is left in standby; radio_on_ms adds up the time spent listening.
+
+    With DIO0 on an irq pin the window sleeps in symbol time steps until
+    RX_DONE (or RX_TIME_OUT on DIO1) interrupts, the IRQ flags are read
+    over SPI only then; without DIO1 once more after timeout_ms. Without
+    any the flags are polled once per symbol time.
+    '''
+
+    def __init__(self, lora, timeout_ms=RX_WINDOW_MS):
+        self.lora = lora
+        self.timeout_ms = timeout_ms
+        self.windows = 0
+        self.heard = 0
+        self.radio_on_ms = 0
+        self._done = False
+        self._done_ticks = 0
+        self._timed_out = False
+        self._checked = False
+        self._on_done_ref = self._on_done  # bind once, no allocation per window
+        self._on_timeout_ref = self._on_timeout
+
+    def _on_done(self, pin):
+        self._done_ticks = ticks_ms()
+        self._done = True
+
+    def _on_timeout(self, pin):
+        self._timed_out = True
+
+    def _asleep(self, elapsed, timeout_ms, step):
+        # True while there is nothing to read over SPI
+        lora = self.lora
+        if not lora.pin_RxDone or self._done or self._timed_out:
+            return False
+        if lora.pin_RxTimeout or self._checked:
+            return True
+        # DIO1 not wired: look once whether the chip gave up, a frame under way ends in RX_DONE
+        return elapsed < timeout_ms + step
+
+    def listen(self, handler, timeout_ms=0):
+        # True if a frame was heard
+        lora = self.lora
+        timeout_ms = timeout_ms if timeout_ms else self.timeout_ms
+        # a frame that started in time is received to its end
+        limit = timeout_ms + int(lora.timeOnAir(codec.MAX_FRAME_SIZE))
+        step = max(int(symbol_time_ms(lora.parameters)), 1)
+        self._done = self._timed_out = self._checked = False
+        if lora.pin_RxDone:
+            # DIO0 => RxDone, DIO1 => RxTimeout
+            lora.updateRegister(REG_DIO_MAPPING_1, lora.readShadow(REG_DIO_MAPPING_1) & 0x0f)
+            lora.pin_RxDone.set_handler_for_irq_on_rising_edge(self._on_done_ref)
+            if lora.pin_RxTimeout:
+                lora.pin_RxTimeout.set_handler_for_irq_on_rising_edge(self._on_timeout_ref)
+        lora.receive(timeoutMs=timeout_ms)
+        started = ticks_ms()
+        self.windows += 1
+        try:
+            while True:
+                elapsed = ticks_diff(ticks_ms(), started)
+                if elapsed > limit:
+                    lora.standby()
+                    return False
+                if self._asleep(elapsed, timeout_ms, step):
+                    sleep(step / 1000)
+                    continue
+                flags = lora.getIrqFlags()
+                if flags & IRQ_RX_DONE_MASK:
+                    if flags & IRQ_PAYLOAD_CRC_ERROR_MASK:
+                        return False
+                    ticks = self._done_ticks if self._done else ticks_ms()
+                    self.heard += 1
+                    handler(lora.read_payload_view(), ticks)
+                    return True
+                if flags & IRQ_RX_TIME_OUT_MASK:
+                    lora.standby()
+                    return False
+                self._checked = True
+                sleep(step / 1000)
+        finally:
+            if lora.pin_RxDone:
+                lora.pin_RxDone.detach_irq()
+                if lora.pin_RxTimeout:
+                    lora.pin_RxTimeout.detach_irq()
+            self.radio_on_ms += ticks_diff(ticks_ms(), started)
+
+
+class DownlinkHandler:
+    '''
+    Node side: handle() takes every frame heard in a receive window and
+    acts on a DOWNLINK addressed to this node, ACKs going to a
+    ReliableSender, profiles to a LinkProfile and any other update to
+    on_update(key, view, offset, length). Any DOWNLINK or ACK for this node
+    tells the LinkProfile the link is alive, as the hub counts it too.
+    '''
+
+    def __init__(self, node_id, sender=None, link=None, on_update=None):
+        self.node_id = node_id
+        self.sender = sender
+        self.link = link
+        self.on_update = on_update
+        self._update_ref = self._update  # bind once, no allocation per frame
+        self.updates = 0
+
+    def handle(self, view, ticks=0):
+        # True if the frame was a downlink for this node
+        node_id, sequence, msg_type = codec.decode_header(view)
+        if node_id != self.node_id:
+            return False
+        if msg_type != codec.MSG_ACK and msg_type != codec.MSG_DOWNLINK:
+            return False
+        if self.link:
+            self.link.downlink_heard()  # any answer from the hub, the link is alive
+        if msg_type == codec.MSG_ACK:
+            return self.sender.handle_downlink(view) if self.sender else False
+        unpack(view, self._update_ref)
+        return True
+
+    def _update(self, key, view, offset, length):
+        self.updates += 1
+        if key == UPDATE_ACK:
+            if self.sender:
+                self.sender.acknowledge(*struct.unpack_from(ACK_FORMAT, view, offset))
+        elif key == UPDATE_PROFILE and self.link:
+            self.link.apply(unpack_profile(view, offset))
+        elif self.on_update:
+            self.on_update(key, view, offset, length)
@@ -0,0 +1,52 @@
+class MultiRadioHub:
+    '''
+    Several SX127x radios on one hub, each with its own RadioEngine and
+    tuned to its own frequency / spreading factor, read as one stream.
+    read_batch() hands handler(radio_name, payload, rssi, snr, timestamp)
+    the packets of every radio, at most limit per radio per call so a busy
+    radio cannot starve the others.
+    Which radio a node uses follows from the spreading factor adr.py puts
+    it on, answers go back on the radio that heard the uplink.
+    '''
+
+    def __init__(self, engines):
+        self.engines = engines
+        self._handler = None
+        self._adapters = [self._adapter(engine.lora.name) for engine in engines]
+        self.received = [0] * len(engines)
+
+    def _adapter(self, name):
+        # one closure per radio, built once so read_batch does not allocate
+        def tagged(payload, rssi, snr, timestamp):
+            self._handler(name, payload, rssi, snr, timestamp)
+        return tagged
+
+    def start(self):
+        for engine in self.engines:
+            engine.start()
+
+    def stop(self):
+        for engine in self.engines:
+            engine.stop()
+
+    def read_batch(self, handler, limit=0):
+        self._handler = handler
+        count = 0
+        for i in range(len(self.engines)):
+            received = self.engines[i].read_batch(self._adapters[i], limit)
+            self.received[i] += received
+            count += received
+        return count
+
+    def engine(self, name):
+        for engine in self.engines:
+            if engine.lora.name == name:
+                return engine
+
+    def stats(self):
+        stats = {}
+        for i in range(len(self.engines)):
+            engine = self.engines[i]
+            stats[engine.lora.name] = engine.stats()
+            stats[engine.lora.name]['received'] = self.received[i]
+        return stats
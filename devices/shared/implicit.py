@@ -0,0 +1,87 @@
+'''
+Header-less (implicit header) fast path for fixed length message types.
+
+In implicit header mode the LoRa header (payload length, coding rate and
+CRC flag, 20 bits sent at coding rate 4/8) is left out, so the receiver
+must already know the length. A radio in implicit mode cannot demodulate
+explicit header frames and vice versa, so every fixed length message type
+that goes out header-less gets its own channel: modem parameters (e.g. a
+spreading factor or frequency) the hub listens on with a radio in implicit
+header mode sized for that schema.
+
+Airtime is spent in blocks of coding rate + 4 symbols, so the 20 bits save
+a block for some lengths and spreading factors and nothing for others
+(12 byte ENVIRONMENT frames: 14% at SF9, none at SF8); saving_ms() tells.
+The table is shared configuration, nodes and hub must agree on it.
+'''
+from airtime import time_on_air_ms
+import codec
+
+
+class ImplicitChannels:
+    '''
+    channels: sequence of (schema, parameters), parameters being the modem
+    parameters of the channel that differ from the radio's defaults.
+    send() transmits a frame header-less on its channel if its type has one,
+    with the usual explicit header otherwise.
+    '''
+
+    def __init__(self, channels=()):
+        self._channels = {}
+        for schema, parameters in channels:
+            if not schema.fixed:
+                raise Exception('{} frames have no fixed length.'.format(schema.name))
+            self._channels[schema.msg_type] = (schema, parameters)
+        self._restore = {}
+        self.implicit_sent = 0
+        self.explicit_sent = 0
+
+    def parameters(self, msg_type):
+        # modem parameters of the type's header-less channel, None if it has none
+        channel = self._channels.get(msg_type)
+        return channel[1] if channel else None
+
+    def hub_radio(self, schema):
+        # (parameters, implicit size) of the hub radio listening for the schema's frames
+        return self._channels[schema.msg_type][1], schema.size
+
+    def send(self, lora, buffer, length=None):
+        length = len(buffer) if length is None else length
+        node_id, sequence, msg_type = codec.decode_header(buffer)
+        channel = self._channels.get(msg_type)
+        if channel is None or length != channel[0].size:
+            lora.beginPacket(False)
+            lora.write(memoryview(buffer)[:length])
+            lora.endPacket()
+            self.explicit_sent += 1
+            return False
+
+        parameters = channel[1]
+        restore = self._restore
+        restore.clear()
+        for key in parameters:
+            restore[key] = lora.parameters[key]
+
+        lora.standby()
+        lora.configure(parameters)
+        lora.beginPacket(True)
+        lora.write(memoryview(buffer)[:length])
+        lora.endPacket()
+        lora.configure(restore)
+        self.implicit_sent += 1
+        return True
+
+    def saving_ms(self, lora, schema):
+        # time on air a header-less frame of the schema saves on its channel
+        parameters = dict(lora.parameters)
+        parameters.update(self._channels[schema.msg_type][1])
+        parameters['implicitHeader'] = False
+        explicit = time_on_air_ms(parameters, schema.size)
+        parameters['implicitHeader'] = True
+        return explicit - time_on_air_ms(parameters, schema.size)
+
+
+# which message types go out header-less, and where. Empty by default: every
+# entry needs a hub radio configured from hub_radio(), e.g. on a second module
+#     CHANNELS = ImplicitChannels(((codec.ENVIRONMENT, {'spreading_factor': 9}),))
+CHANNELS = ImplicitChannels()
@@ -0,0 +1,229 @@
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+try:
+    from ubinascii import crc32
+except ImportError:
+    from binascii import crc32
+import os
+from clock import ticks_ms, ticks_diff
+
+# node id, name type, reading name, timestamp ms, value; followed by a CRC32 of those
+RECORD_FORMAT = '<HB17sqd'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT) + 4
+
+# names are stored as text, the type says what to hand back on read
+NAME_STR = 0
+NAME_INT = 1  # a sensor id
+
+SEGMENT_SUFFIX = '.jnl'
+CURSOR_FILE = 'cursor'
+
+
+class Journal:
+    '''
+    Append-only segmented log of readings on the filesystem, for the hub to
+    park what the uplink cannot take during an outage.
+
+    Records are fixed size (RECORD_SIZE) and numbered by a serial that only
+    grows; segment file n holds serials n * segment_records onwards. Appends
+    collect in a RAM page of page_records, written to the current segment in
+    one sequential write when the page fills or flush_ms after the first
+    record, which keeps flash wear and write amplification low.
+
+    read() hands out records in order from the oldest one not yet read,
+    ack(serial) marks everything before serial as delivered: segments that
+    are entirely acknowledged are deleted and the acknowledged serial is
+    persisted (atomically, by rename) whenever a segment goes and every
+    cursor_interval records. After a reboot reading resumes from the last
+    persisted serial, so at most cursor_interval records are delivered twice.
+    A torn last write is detected by its CRC (or partial length) and
+    skipped. With more than max_segments segments the oldest is dropped.
+    '''
+
+    def __init__(self, directory='/journal', segment_records=1024, page_records=100,
+                 flush_ms=5000, cursor_interval=256, max_segments=64):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.page_records = page_records
+        self.flush_ms = flush_ms
+        self.cursor_interval = cursor_interval
+        self.max_segments = max_segments
+
+        self._page = bytearray(page_records * RECORD_SIZE)
+        self._page_count = 0
+        self._page_started = 0
+        self._record = bytearray(RECORD_SIZE)
+
+        self.appended = 0
+        self.dropped = 0
+        self.corrupt = 0
+        self.flushes = 0
+
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # exists
+        self._recover()
+
+    def _path(self, name):
+        return '{}/{}'.format(self.directory, name)
+
+    def _segment_path(self, segment):
+        return self._path('{:08d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+        segments.sort()
+        return segments
+
+    def _recover(self):
+        segments = self._segments()
+        self._first_segment = segments[0] if segments else 0
+        if segments:
+            last = segments[-1]
+            size = os.stat(self._segment_path(last))[6]
+            if size % RECORD_SIZE:
+                # torn write at the tail: carry on in a fresh segment
+                self._write_serial = (last + 1) * self.segment_records
+            else:
+                self._write_serial = last * self.segment_records + size // RECORD_SIZE
+        else:
+            self._write_serial = 0
+
+        self._acked = self._first_segment * self.segment_records
+        try:
+            with open(self._path(CURSOR_FILE), 'rb') as f:
+                self._acked = max(self._acked, struct.unpack('<Q', f.read(8))[0])
+        except (OSError, ValueError):
+            pass
+        self._acked = min(self._acked, self._write_serial)
+        self._read_serial = self._acked
+        self._persisted = self._acked
+
+    def pending(self):
+        # records appended but not yet handed out by read()
+        return self._write_serial + self._page_count - self._read_serial
+
+    def unacked(self):
+        return self._write_serial + self._page_count - self._acked
+
+    def append(self, node_id, name, timestamp, value):
+        offset = self._page_count * RECORD_SIZE
+        if isinstance(name, int):
+            kind, name = NAME_INT, str(name)
+        else:
+            kind = NAME_STR
+        struct.pack_into(RECORD_FORMAT, self._page, offset, node_id, kind, name.encode(), timestamp, value)
+        struct.pack_into('<I', self._page, offset + RECORD_SIZE - 4,
+                         crc32(memoryview(self._page)[offset:offset + RECORD_SIZE - 4]))
+        if not self._page_count:
+            self._page_started = ticks_ms()
+        self._page_count += 1
+        self.appended += 1
+        if self._page_count == self.page_records:
+            self.flush()
+
+    def service(self):
+        # flush a page that has waited flush_ms
+        if self._page_count and ticks_diff(ticks_ms(), self._page_started) >= self.flush_ms:
+            self.flush()
+
+    def flush(self):
+        if not self._page_count:
+            return
+        written = 0
+        while written < self._page_count:
+            segment = self._write_serial // self.segment_records
+            room = (segment + 1) * self.segment_records - self._write_serial
+            count = min(room, self._page_count - written)
+            with open(self._segment_path(segment), 'ab') as f:
+                f.write(memoryview(self._page)[written * RECORD_SIZE:(written + count) * RECORD_SIZE])
+            self._write_serial += count
+            written += count
+        self._page_count = 0
+        self.flushes += 1
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        segments = self._segments()
+        while len(segments) > self.max_segments:
+            oldest = segments.pop(0)
+            os.remove(self._segment_path(oldest))
+            end = (oldest + 1) * self.segment_records
+            self.dropped += max(end - max(self._acked, oldest * self.segment_records), 0)
+            self._first_segment = segments[0]
+            self._acked = max(self._acked, end)
+            self._read_serial = max(self._read_serial, end)
+            self._persist()
+
+    def read(self, handler, limit):
+        # hands handler(node_id, name, timestamp, value) up to limit records
+        # in order; returns the serial to ack() once they are delivered.
+        if self._read_serial >= self._write_serial and self._page_count:
+            self.flush()
+        count = 0
+        while count < limit and self._read_serial < self._write_serial:
+            segment = self._read_serial // self.segment_records
+            index = self._read_serial - segment * self.segment_records
+            try:
+                with open(self._segment_path(segment), 'rb') as f:
+                    f.seek(index * RECORD_SIZE)
+                    while count < limit and index < self.segment_records and \
+                            f.readinto(self._record) == RECORD_SIZE:
+                        self._deliver(handler)
+                        index += 1
+                        count += 1
+                        self._read_serial += 1
+            except OSError:
+                pass
+            if count < limit and index < self.segment_records and self._read_serial < self._write_serial:
+                # segment ended early (torn tail or missing): skip to the next one
+                self._read_serial = (segment + 1) * self.segment_records
+        return self._read_serial
+
+    def _deliver(self, handler):
+        record = self._record
+        if struct.unpack_from('<I', record, RECORD_SIZE - 4)[0] != \
+                crc32(memoryview(record)[:RECORD_SIZE - 4]):
+            self.corrupt += 1
+            return
+        node_id, kind, name, timestamp, value = struct.unpack_from(RECORD_FORMAT, record)
+        end = name.find(b'\0')
+        name = (name[:end] if end >= 0 else name).decode()
+        handler(node_id, int(name) if kind == NAME_INT else name, timestamp, value)
+
+    def ack(self, serial):
+        if serial <= self._acked:
+            return
+        self._acked = serial
+        reclaimed = False
+        while self._first_segment < serial // self.segment_records:
+            try:
+                os.remove(self._segment_path(self._first_segment))
+            except OSError:
+                pass
+            self._first_segment += 1
+            reclaimed = True
+        if reclaimed or serial - self._persisted >= self.cursor_interval:
+            self._persist()
+
+    def _persist(self):
+        temporary = self._path(CURSOR_FILE + '.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(struct.pack('<Q', self._acked))
+        os.rename(temporary, self._path(CURSOR_FILE))
+        self._persisted = self._acked
+
+    def rewind(self):
+        # hand out again everything not acknowledged, e.g. after losing the uplink
+        self._read_serial = self._acked
+
+    def stats(self):
+        return {'pending': self.pending(), 'unacked': self.unacked(), 'appended': self.appended,
+                'flushes': self.flushes, 'dropped': self.dropped, 'corrupt': self.corrupt,
+                'segments': self._write_serial // self.segment_records - self._first_segment + 1}
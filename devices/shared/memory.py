@@ -0,0 +1,120 @@
+import gc
+from timeline import TIMELINE
+
+try:
+    mem_free = gc.mem_free
+    mem_alloc = gc.mem_alloc
+except AttributeError:
+    # not micropython, heap statistics are unavailable.
+    mem_free = None
+    mem_alloc = None
+
+SPAN_GC = TIMELINE.span_id('gc')
+
+
+class MemoryPolicy:
+    '''
+    Decides when the radio hot paths (send / receive) pay for a gc.collect().
+    after_packet() is called once per packet sent or received, idle() from
+    loops with nothing to do. Every policy tracks heap high-water marks.
+    '''
+
+    def __init__(self):
+        self.collections = 0
+        self.min_free = -1
+        self.max_alloc = 0
+
+    def sample(self):
+        # update high-water marks, returns free heap bytes (-1 if unknown).
+        if mem_free is None:
+            return -1
+        free = mem_free()
+        allocated = mem_alloc()
+        if self.min_free < 0 or free < self.min_free:
+            self.min_free = free
+        if allocated > self.max_alloc:
+            self.max_alloc = allocated
+        return free
+
+    def collect(self):
+        self.sample()
+        started = TIMELINE.begin()
+        gc.collect()
+        TIMELINE.end(SPAN_GC, started)
+        self.collections += 1
+
+    def after_packet(self):
+        pass
+
+    def idle(self):
+        pass
+
+    def report(self):
+        free = self.sample()
+        print('[Memory - free: {}   allocated: {}   min free: {}   max allocated: {}   collections: {}]'.format(
+            free, mem_alloc() if mem_alloc else -1, self.min_free, self.max_alloc, self.collections))
+
+
+class AlwaysCollect(MemoryPolicy):
+    '''
+    Full collection after every packet, the original driver behaviour.
+    '''
+
+    def after_packet(self):
+        self.collect()
+
+
+class ThresholdCollect(MemoryPolicy):
+    '''
+    Collect only once free heap drops below min_free bytes.
+    '''
+
+    def __init__(self, min_free=16384):
+        super().__init__()
+        self.threshold = min_free
+
+    def after_packet(self):
+        free = self.sample()
+        if 0 <= free < self.threshold:
+            self.collect()
+
+
+class IdleCollect(MemoryPolicy):
+    '''
+    Never collect on the hot path, collect in the next idle period after
+    packets have been handled. Falls back to collecting on the hot path if
+    free heap drops below min_free bytes before any idle time comes along.
+    '''
+
+    def __init__(self, min_free=4096):
+        super().__init__()
+        self.threshold = min_free
+        self._dirty = False
+
+    def after_packet(self):
+        self._dirty = True
+        free = self.sample()
+        if 0 <= free < self.threshold:
+            self.collect()
+            self._dirty = False
+
+    def idle(self):
+        if self._dirty:
+            self.collect()
+            self._dirty = False
+
+
+class AutoCollect(MemoryPolicy):
+    '''
+    Leave it to the allocator: gc.threshold() triggers a collection after
+    allocation_bytes have been allocated since the last one.
+    '''
+
+    def __init__(self, allocation_bytes=8192):
+        super().__init__()
+        gc.enable()
+        if hasattr(gc, 'threshold'):
+            gc.threshold(allocation_bytes)
+
+    def after_packet(self):
+        self.sample()
@@ -0,0 +1,198 @@
+'''
+Minimal MQTT 3.1.1 client: CONNECT, PUBLISH at QoS 0/1, PUBACK, PINGREQ.
+Just enough for the hub's uplink, on MicroPython and CPython sockets alike.
+publish() does not wait for the PUBACK, poll() reports the packet ids the
+broker acknowledged, so the caller can keep several publishes in flight.
+'''
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xc0
+PINGRESP = 0xd0
+DISCONNECT = 0xe0
+
+DUP_FLAG = 0x08
+QOS1_FLAG = 0x02
+
+
+class MQTTException(Exception):
+    pass
+
+
+def _encode_length(buffer, length):
+    # remaining length varint into buffer, returns its size
+    i = 0
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        buffer[i] = byte | 0x80 if length else byte
+        i += 1
+        if not length:
+            return i
+
+
+class MQTTClient:
+
+    def __init__(self, client_id, host, port=1883, user=None, password=None,
+                 keepalive=60, timeout_s=5):
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.timeout_s = timeout_s
+
+        self.sock = None
+        self._poller = None
+        self._header = bytearray(5)
+        self._input = bytearray(256)
+        self._input_length = 0
+        self._next_id = 0
+
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self, clean_session=False):
+        address = socket.getaddrinfo(self.host, self.port)[0][-1]
+        self.sock = socket.socket()
+        self.sock.settimeout(self.timeout_s)
+        try:
+            self.sock.connect(address)
+
+            flags = 0x00 if not clean_session else 0x02
+            payload = self._string(self.client_id)
+            if self.user is not None:
+                flags |= 0x80
+                payload += self._string(self.user)
+                if self.password is not None:
+                    flags |= 0x40
+                    payload += self._string(self.password)
+            variable = b'\x00\x04MQTT\x04' + struct.pack('!BH', flags, self.keepalive)
+            self._send_packet(CONNECT, variable + payload)
+
+            response = self._read_exactly(4)
+            if response[0] != CONNACK or response[3] != 0:
+                raise MQTTException('Connection refused, return code {}.'.format(response[3]))
+        except Exception:
+            self.close()
+            raise
+
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLIN)
+        self._input_length = 0
+        return response[2] & 0x01  # session present
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self._poller = None
+
+    def disconnect(self):
+        if self.sock:
+            try:
+                self._send_packet(DISCONNECT, b'')
+            except OSError:
+                pass
+        self.close()
+
+    def next_packet_id(self):
+        self._next_id = self._next_id % 0xffff + 1
+        return self._next_id
+
+    def publish(self, topic, payload, qos=1, packet_id=0, dup=False):
+        # returns the packet id to wait for with poll(), 0 at QoS 0
+        flags = PUBLISH
+        variable = self._string(topic)
+        if qos:
+            flags |= QOS1_FLAG | (DUP_FLAG if dup else 0)
+            packet_id = packet_id or self.next_packet_id()
+            variable += struct.pack('!H', packet_id)
+        self._send_packet(flags, variable, payload)
+        return packet_id if qos else 0
+
+    def ping(self):
+        self._send_packet(PINGREQ, b'')
+
+    def poll(self, handler, timeout_ms=0):
+        # hands handler(packet id) every PUBACK that arrived, waiting at most
+        # timeout_ms for the first one; returns the number of packets read.
+        count = 0
+        while self._poller.poll(timeout_ms if not count else 0):
+            space = memoryview(self._input)[self._input_length:]
+            received = self.sock.readinto(space) if hasattr(self.sock, 'readinto') else \
+                self.sock.recv_into(space)
+            if not received:
+                self.close()
+                raise MQTTException('Connection closed by broker.')
+            self._input_length += received
+            count += self._parse(handler)
+        return count
+
+    def _parse(self, handler):
+        count = 0
+        data = self._input
+        while self._input_length >= 2:
+            length = data[1]
+            if length & 0x80:
+                raise MQTTException('Unexpected long packet from broker.')
+            if self._input_length < 2 + length:
+                break
+            kind = data[0] & 0xf0
+            if kind == PUBACK:
+                handler(struct.unpack_from('!H', data, 2)[0])
+            elif kind != PINGRESP:
+                raise MQTTException('Unexpected packet type 0x{:02x}.'.format(data[0]))
+            size = 2 + length
+            data[:self._input_length - size] = data[size:self._input_length]
+            self._input_length -= size
+            count += 1
+        return count
+
+    def _string(self, value):
+        if isinstance(value, str):
+            value = value.encode()
+        return struct.pack('!H', len(value)) + value
+
+    def _send_packet(self, first_byte, variable, payload=b''):
+        header = self._header
+        header[0] = first_byte
+        size = 1 + _encode_length(memoryview(header)[1:], len(variable) + len(payload))
+        # one write per packet, separate small writes stall on Nagle / delayed ACK
+        self._write(bytes(header[:size]) + variable + payload)
+
+    def _write(self, data):
+        sock = self.sock
+        if sock is None:
+            raise MQTTException('Not connected.')
+        if hasattr(sock, 'sendall'):
+            sock.sendall(data)
+        else:
+            sock.write(data)
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise MQTTException('Connection closed by broker.')
+            data += chunk
+        return data
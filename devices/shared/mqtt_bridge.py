@@ -0,0 +1,272 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+try:
+    import urandom as random
+except ImportError:
+    import random
+import _thread
+from time import sleep
+from clock import ticks_ms, ticks_diff
+from mqtt import MQTTException
+
+MIN_BACKOFF_MS = 1000
+MAX_BACKOFF_MS = 60000
+POLL_MS = 50
+
+
+class MQTTBridge:
+    '''
+    Forwards decoded readings from the hub to an MQTT broker.
+    The radio path only calls submit(), which appends to a bounded queue in
+    memory and never touches the network. A worker thread keeps one
+    persistent connection, packs up to batch_size readings into each
+    publish (a JSON list of [node, name, timestamp, value]) and keeps up to
+    inflight QoS 1 publishes awaiting their PUBACK. Readings wait in the
+    queue while the broker is unreachable (store and forward, the oldest
+    dropped beyond queue_size). Unacknowledged publishes go out again
+    after a reconnect. Reconnects back off exponentially, with jitter,
+    from MIN_BACKOFF_MS to MAX_BACKOFF_MS.
+
+    With a Journal, the worker moves queued readings to flash while the
+    broker is unreachable or the queue is half full, and keeps doing so
+    until the journal is drained, so RAM use stays flat however long the
+    outage. When the connection drops, the queue and the readings of
+    unacknowledged publishes go to the journal too. Its pages are written
+    when full or after the journal's flush_ms, so a reboot loses at most
+    that much of the readings, and flash is not written every tick. Only
+    the worker touches the journal, the radio path never waits on flash. Once the queue is empty
+    the journal is replayed in order at replay_per_second at most, its
+    records acked as the broker acknowledges them.
+
+    post() hands over a message outside the readings, e.g. diagnostics,
+    published at QoS 0 on its own topic once connected; only the latest
+    per topic is kept.
+    '''
+
+    def __init__(self, client, topic, batch_size=16, max_latency_ms=2000,
+                 inflight=4, queue_size=512, keepalive_ms=30000, journal=None,
+                 replay_per_second=50):
+        self.client = client
+        self.topic = topic
+        self.batch_size = batch_size
+        self.max_latency_ms = max_latency_ms
+        self.inflight = inflight
+        self.queue_size = queue_size
+        self.keepalive_ms = keepalive_ms
+        self.journal = journal
+        self.replay_per_second = replay_per_second
+
+        self._lock = _thread.allocate_lock()
+        self._queue = []
+        self._oldest = 0
+        self._unacked = {}  # packet id => (payload, readings, journal serial or -1)
+        self._posts = {}    # topic => payload
+        self._batch = []
+        self._last_replay = 0
+        self._running = False
+        self._stopped = True
+        self._backoff_ms = MIN_BACKOFF_MS
+        self._last_write = 0
+
+        self.submitted = 0
+        self.dropped = 0
+        self.published = 0
+        self.delivered = 0
+        self.republished = 0
+        self.connects = 0
+        self.failures = 0
+
+    def submit(self, node_id, name, timestamp, value):
+        # called from the radio path, never blocks on the network or flash
+        with self._lock:
+            self.submitted += 1
+            if len(self._queue) >= self.queue_size:
+                self._queue.pop(0)
+                self.dropped += 1
+            if not self._queue:
+                self._oldest = ticks_ms()
+            self._queue.append((node_id, name, timestamp, value))
+
+    def post(self, topic, payload):
+        # never blocks, payload must not change once handed over
+        with self._lock:
+            self._posts[topic] = payload
+
+    def pending(self):
+        pending = len(self._queue) + sum(len(entry[1]) for entry in self._unacked.values())
+        return pending + self.journal.pending() if self.journal else pending
+
+    def start(self):
+        self._running = True
+        self._stopped = False
+        _thread.start_new_thread(self._run, ())
+
+    def stop(self, timeout_ms=5000):
+        # flushes what it can within timeout_ms, then disconnects
+        started = ticks_ms()
+        while self.pending() and self.client.connected() and \
+                ticks_diff(ticks_ms(), started) < timeout_ms:
+            sleep(POLL_MS / 1000)
+        self._running = False
+        while not self._stopped and ticks_diff(ticks_ms(), started) < timeout_ms + 1000:
+            sleep(POLL_MS / 1000)
+
+    def _run(self):
+        try:
+            while self._running:
+                self._service_journal()
+                if not self.client.connected():
+                    if not self._connect():
+                        self._sleep_backoff()
+                        continue
+                try:
+                    self.service()
+                except (OSError, MQTTException) as e:
+                    print('MQTT connection lost: {}'.format(e))
+                    self.client.close()
+                    self.failures += 1
+                    self._spill_unacked()
+        finally:
+            self.client.disconnect()
+            if self.journal:
+                self._spill_unacked()
+                self._spill()
+                self.journal.flush()
+            self._stopped = True
+
+    def _connect(self):
+        try:
+            self.client.connect()
+        except (OSError, MQTTException) as e:
+            print('MQTT connect to {} failed: {}'.format(self.client.host, e))
+            self.failures += 1
+            return False
+        self.connects += 1
+        self._backoff_ms = MIN_BACKOFF_MS
+        self._last_write = ticks_ms()
+        for packet_id in sorted(self._unacked):
+            self.client.publish(self.topic, self._unacked[packet_id][0], 1, packet_id, dup=True)
+            self.republished += 1
+        return True
+
+    def _sleep_backoff(self):
+        delay = self._backoff_ms
+        self._backoff_ms = min(self._backoff_ms * 2, MAX_BACKOFF_MS)
+        delay += random.getrandbits(16) * delay // 4 // 0xffff  # up to 25% jitter
+        started = ticks_ms()
+        while self._running and ticks_diff(ticks_ms(), started) < delay:
+            self._service_journal()
+            sleep(POLL_MS / 1000)
+
+    def _service_journal(self):
+        journal = self.journal
+        if not journal:
+            return
+        connected = self.client.connected()
+        if self._queue and (not connected or journal.pending() or
+                            len(self._queue) >= self.queue_size // 2):
+            self._spill()
+        journal.service()
+
+    def _spill(self):
+        # queued readings to the journal, the flash writes outside the lock
+        with self._lock:
+            queue = self._queue
+            self._queue = []
+        for reading in queue:
+            self.journal.append(*reading)
+
+    def _spill_unacked(self):
+        # the connection is gone: readings of live publishes in flight go to
+        # the journal, replayed ones are still in it and are read again
+        if not self.journal:
+            return
+        for packet_id in sorted(self._unacked):
+            readings, serial = self._unacked[packet_id][1:]
+            if serial < 0:
+                for reading in readings:
+                    self.journal.append(*reading)
+        self._unacked = {}
+        self.journal.rewind()
+
+    def service(self):
+        # one round of the worker: publish due batches and posts, read the PUBACKs
+        while len(self._unacked) < self.inflight and self._due():
+            self._publish_batch()
+        while len(self._unacked) < self.inflight and not self._queue and self._replay_due():
+            self._replay_batch()
+        if self._posts:
+            self._publish_posts()
+        if ticks_diff(ticks_ms(), self._last_write) >= self.keepalive_ms:
+            self.client.ping()
+            self._last_write = ticks_ms()
+        full = len(self._unacked) >= self.inflight
+        self.client.poll(self._acknowledged, POLL_MS if full or self._queue else self._replay_wait_ms())
+
+    def _due(self):
+        count = len(self._queue)
+        if not count:
+            return False
+        return count >= self.batch_size or not self._running or \
+            ticks_diff(ticks_ms(), self._oldest) >= self.max_latency_ms
+
+    def _replay_wait_ms(self):
+        # until the next replay batch may go, POLL_MS if there is nothing to replay
+        if not self.journal or not self.journal.pending():
+            return POLL_MS
+        interval_ms = self.batch_size * 1000 // self.replay_per_second
+        return min(max(interval_ms - ticks_diff(ticks_ms(), self._last_replay), 0), POLL_MS)
+
+    def _replay_due(self):
+        return self._replay_wait_ms() == 0
+
+    def _publish_batch(self):
+        with self._lock:
+            batch = self._queue[:self.batch_size]
+            del self._queue[:self.batch_size]
+            self._oldest = ticks_ms()
+        self._publish(batch, -1)
+
+    def _replay_batch(self):
+        batch = self._batch
+        serial = self.journal.read(self._collect, self.batch_size)
+        self._last_replay = ticks_ms()
+        if batch:
+            self._publish(batch, serial)
+            self._batch = []
+        else:
+            self.journal.ack(serial)  # nothing readable, e.g. a torn record
+
+    def _publish_posts(self):
+        with self._lock:
+            posts = self._posts
+            self._posts = {}
+        for topic, payload in posts.items():
+            self.client.publish(topic, payload, 0)
+        self._last_write = ticks_ms()
+
+    def _collect(self, node_id, name, timestamp, value):
+        self._batch.append((node_id, name, timestamp, value))
+
+    def _publish(self, batch, serial):
+        payload = json.dumps(batch).encode()
+        packet_id = self.client.next_packet_id()
+        self._unacked[packet_id] = (payload, batch, serial)
+        self.client.publish(self.topic, payload, 1, packet_id)
+        self._last_write = ticks_ms()
+        self.published += 1
+
+    def _acknowledged(self, packet_id):
+        entry = self._unacked.pop(packet_id, None)
+        if entry:
+            self.delivered += len(entry[1])
+            if entry[2] >= 0:
+                self.journal.ack(entry[2])
+
+    def stats(self):
+        return {'submitted': self.submitted, 'queued': len(self._queue), 'inflight': len(self._unacked),
+                'published': self.published, 'delivered': self.delivered,
+                'republished': self.republished, 'dropped': self.dropped,
+                'connects': self.connects, 'failures': self.failures}
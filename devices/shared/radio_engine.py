@@ -0,0 +1,236 @@
+from array import array
+from micropython import schedule
+from clock import ticks_ms, ticks_diff
+from sx127x import MAX_PKT_LENGTH, REG_DIO_MAPPING_1, REG_OP_MODE, MODE_LONG_RANGE_MODE, MODE_TX, \
+    IRQ_TX_DONE_MASK, IRQ_RX_DONE_MASK, IRQ_PAYLOAD_CRC_ERROR_MASK, LBT_MAX_ATTEMPTS
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+DIO0_RX_DONE = 0x00
+DIO0_TX_DONE = 0x40
+
+TX_POLL_SECONDS = 0.005
+TX_TIMEOUT_MS = 15000
+
+
+class PacketRing:
+    '''
+    Fixed-capacity ring of preallocated packet slots.
+    Single producer (the radio drain) and single consumer (application code),
+    each side only ever moves its own index so no lock is needed between the
+    scheduled drain and the main loop.
+    '''
+
+    def __init__(self, capacity=8, slot_size=MAX_PKT_LENGTH):
+        self.capacity = capacity
+        self._slots = [bytearray(slot_size) for _ in range(capacity)]
+        self._views = [memoryview(slot) for slot in self._slots]
+        self.lengths = array('H', [0] * capacity)
+        self.rssi = array('h', [0] * capacity)
+        self.snr = array('f', [0] * capacity)
+        self.timestamps = array('L', [0] * capacity)
+
+        # indices run modulo 2 * capacity so full and empty can be told apart
+        self._wrap = 2 * capacity
+        self._write_index = 0
+        self._read_index = 0
+        self.overflows = 0
+
+    def __len__(self):
+        return (self._write_index - self._read_index) % self._wrap
+
+    def reserve(self):
+        # slot number to fill next, or -1 (and an overflow counted) when full
+        if len(self) >= self.capacity:
+            self.overflows += 1
+            return -1
+        return self._write_index % self.capacity
+
+    def slot(self, index):
+        return self._slots[index]
+
+    def commit(self, index, length, rssi, snr, timestamp):
+        self.lengths[index] = length
+        self.rssi[index] = rssi
+        self.snr[index] = snr
+        self.timestamps[index] = timestamp
+        self._write_index = (self._write_index + 1) % self._wrap
+
+    def consume(self, handler, limit=0):
+        # hand the oldest packets to handler(payload, rssi, snr, timestamp).
+        # payload is a view into the slot and is only valid during the call.
+        count = 0
+        while len(self) and (limit <= 0 or count < limit):
+            index = self._read_index % self.capacity
+            handler(self._views[index][:self.lengths[index]],
+                    self.rssi[index], self.snr[index], self.timestamps[index])
+            self._read_index = (self._read_index + 1) % self._wrap
+            count += 1
+        return count
+
+
+class RadioEngine:
+    '''
+    Interrupt-driven receiver and transmitter.
+    The DIO0 handler only records the event and schedules a drain. On RxDone
+    the drain copies the FIFO into the next free ring slot and application
+    code consumes the ring in batches with read_batch(). On TxDone it
+    completes the pending send() and puts the radio back into continuous
+    receive. DIO0 is remapped between RxDone and TxDone automatically.
+    DIO0 edges that come in before the drain runs merge into one, the FIFO
+    only holds the last packet, so the ones before it are counted as
+    dropped.
+    '''
+
+    def __init__(self, lora, ring=None, implicit_size=0):
+        self.lora = lora
+        self.ring = ring if ring else PacketRing()
+        self.implicit_size = implicit_size
+        self.irq_count = 0
+        self.crc_errors = 0
+        self.dropped = 0
+        self._serviced = 0  # irq_count when the last event was drained
+        self._pending = False
+        self._drain_ref = self._drain  # bind once, scheduling must not allocate
+        self._tx_busy = False
+        self._tx_done = False
+        self.tx_count = 0
+        self.tx_timeouts = 0
+
+    def start(self):
+        if not self.lora.pin_RxDone:
+            raise Exception('RadioEngine needs DIO0 wired to an irq pin.')
+        self.lora.writeRegister(REG_DIO_MAPPING_1, DIO0_RX_DONE)
+        self.lora.pin_RxDone.set_handler_for_irq_on_rising_edge(self._handle_irq)
+        self.lora.receive(self.implicit_size)
+
+    def stop(self):
+        self.lora.pin_RxDone.detach_irq()
+        self.lora.standby()
+
+    def transmitting(self):
+        # True from send() until reception has resumed after TX_DONE
+        return self._tx_busy
+
+    def _handle_irq(self, event_source):
+        self.irq_count += 1
+        if not self._pending:
+            self._pending = True
+            try:
+                schedule(self._drain_ref, None)
+            except RuntimeError:
+                pass  # schedule queue full, the next service() call drains it.
+
+    def _drain(self, _):
+        # the callback may land in the middle of a transaction of the main
+        # thread, if the bus is taken leave the event to the next service() call.
+        if self.lora.spi_lock.locked():
+            return
+        self.service()
+
+    def service(self):
+        # drain one pending DIO0 event; safe to call from a coroutine or poll loop.
+        if not self._pending:
+            return False
+        count = self.irq_count  # before clearing, an IRQ in between is merged into this event
+        self._pending = False
+        if count - self._serviced > 1:
+            self.dropped += count - self._serviced - 1
+        self._serviced = count
+
+        irqFlags = self.lora.getIrqFlags()
+        if self._tx_busy:
+            if irqFlags & IRQ_TX_DONE_MASK:
+                self._finish_send()
+            return False
+
+        if not irqFlags & IRQ_RX_DONE_MASK:
+            return False
+        if irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK:
+            self.crc_errors += 1
+            return False
+
+        index = self.ring.reserve()
+        if index < 0:
+            return False
+
+        length = self.lora.readinto(self.ring.slot(index))
+        self.ring.commit(index, length,
+                         self.lora.packetRssi(), self.lora.packetSnr(), ticks_ms())
+        self.lora.collect_garbage()
+        return True
+
+    def _finish_send(self):
+        # standby automatically on TX_DONE, map DIO0 back and resume listening.
+        self.lora.writeRegister(REG_DIO_MAPPING_1, DIO0_RX_DONE)
+        self.lora.receive(self.implicit_size)
+        self._tx_done = True
+
+    async def send(self, buffer, implicitHeader=False, timeout_ms=TX_TIMEOUT_MS,
+                   listen_before_talk=False, max_attempts=LBT_MAX_ATTEMPTS):
+        # returns once the packet is on air and reception has resumed,
+        # other coroutines keep running while the radio transmits.
+        # with listen_before_talk, returns False if the channel stayed busy.
+        while self._tx_busy:
+            await asyncio.sleep(TX_POLL_SECONDS)
+
+        self._tx_busy = True
+        self._tx_done = False
+
+        lora = self.lora
+        if listen_before_talk:
+            busy = 0
+            while lora.channelActivityDetect():
+                busy += 1
+                if busy >= max_attempts:
+                    lora._countSend(busy - 1, busy, False)
+                    self._finish_send()
+                    self._tx_busy = False
+                    return False
+                await asyncio.sleep(lora.backoffMs(busy - 1) / 1000)
+            lora._countSend(busy, busy, True)
+
+        lora.beginPacket(implicitHeader)
+        lora.write(buffer)
+        lora.writeRegister(REG_DIO_MAPPING_1, DIO0_TX_DONE)
+        lora.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
+
+        started = ticks_ms()
+        try:
+            while not self._tx_done:
+                if self._pending:
+                    self.service()
+                    continue
+                if ticks_diff(ticks_ms(), started) > timeout_ms:
+                    self.tx_timeouts += 1
+                    lora.getIrqFlags()
+                    self._finish_send()
+                    raise Exception('TX_DONE not signalled within {} ms.'.format(timeout_ms))
+                await asyncio.sleep(TX_POLL_SECONDS)
+        finally:
+            self._tx_busy = False
+
+        self.tx_count += 1
+        self.lora.collect_garbage()
+        return True
+
+    async def serve(self, handler, limit=0, idle_seconds=0.01):
+        # consume the receive ring forever from a coroutine.
+        while True:
+            if not self.read_batch(handler, limit):
+                self.lora.memory_policy.idle()
+                await asyncio.sleep(idle_seconds)
+
+    def read_batch(self, handler, limit=0):
+        if self._pending:
+            self.service()
+        return self.ring.consume(handler, limit)
+
+    def stats(self):
+        return {'irqs': self.irq_count, 'queued': len(self.ring),
+                'overflows': self.ring.overflows, 'crc_errors': self.crc_errors, 'dropped': self.dropped,
+                'sent': self.tx_count, 'tx_timeouts': self.tx_timeouts}
@@ -0,0 +1,224 @@
+from clock import ticks_ms, ticks_diff
+from dedup import Deduplicator, WINDOW_BITS, sequence_distance
+import codec
+
+ACK_BITS = WINDOW_BITS  # earlier sequence numbers an ACK reports on besides the latest
+
+FREE = 0
+QUEUED = 1   # waiting for its first transmission (or for duty cycle budget)
+SENT = 2     # on air, waiting for an ACK
+LOST = 3     # reported missing or timed out, to retransmit
+
+
+class AckTracker(Deduplicator):
+    '''
+    Hub side of reliable delivery: the dedup window of every node doubles as
+    its ACK, encoded as one frame (latest + bitmap) for the node's downlink
+    window.
+    '''
+
+    def __init__(self, max_nodes=1024):
+        Deduplicator.__init__(self, max_nodes)
+        self._unacked = bytearray(max_nodes)
+
+    def record(self, node_id, sequence):
+        # True if the frame is new, False for a retransmission already seen;
+        # repeats are acknowledged again too, the ACK got lost.
+        fresh = self.check(node_id, sequence)
+        self._unacked[self._slots[node_id]] = 1
+        return fresh
+
+    def pending(self, node_id):
+        slot = self._slots.get(node_id)
+        return slot is not None and self._unacked[slot] == 1
+
+    def take(self, node_id):
+        # (latest, bitmap) to acknowledge, None if the node is unknown; clears pending
+        window = self.window(node_id)
+        if window is not None:
+            self._unacked[self._slots[node_id]] = 0
+        return window
+
+    def ack_into(self, buffer, node_id, sequence, offset=0):
+        # encodes the node's ACK frame, returns its length (0 if nothing to ack)
+        window = self.take(node_id)
+        if window is None:
+            return 0
+        return codec.ACK.encode_into(buffer, node_id, sequence, window, offset)
+
+
+class ReliableSender:
+    '''
+    Node side of reliable delivery.
+    Every frame sent is kept in a window of preallocated slots until the hub
+    acknowledges it. An ACK reports the latest sequence number heard and a
+    bitmap of the ACK_BITS before it, so only frames it shows missing are
+    retransmitted, as are frames no ACK covered within ack_timeout_ms.
+
+    Retries are bounded twice: max_attempts transmissions per frame, and a
+    budget of retry_ratio retransmissions per new frame (at most window
+    saved up). With a DutyCycleScheduler, transmissions wait in the window
+    until the band's budget allows them instead of being queued twice.
+    When the window is full the oldest frame is given up.
+
+        sequence = sender.next_sequence()
+        size = codec.ENVIRONMENT.encode_into(frame, node_id, sequence, values)
+        sender.send(frame, size)
+        ...
+        sender.handle_downlink(payload)  # from the receive window
+        sender.service()                 # periodically
+    '''
+
+    def __init__(self, lora, node_id, window=8, max_attempts=3, ack_timeout_ms=30000,
+                 retry_ratio=1.0, scheduler=None, link=None, frame_size=codec.MAX_FRAME_SIZE):
+        self.lora = lora
+        self.node_id = node_id
+        self.window = window
+        self.max_attempts = max_attempts
+        self.ack_timeout_ms = ack_timeout_ms
+        self.retry_ratio = retry_ratio
+        self.scheduler = scheduler
+        self.link = link
+
+        self._frames = [bytearray(frame_size) for _ in range(window)]
+        self._lengths = [0] * window
+        self._sequences = [0] * window
+        self._attempts = bytearray(window)
+        self._sent_at = [0] * window
+        self._states = bytearray(window)
+        self._tail = 0   # oldest slot
+        self._count = 0  # slots from the tail on, free ones included
+
+        self._sequence = 0
+        self._retry_tokens = 0.0
+
+        self.sent = 0
+        self.retransmitted = 0
+        self.acked = 0
+        self.given_up = 0
+
+    def next_sequence(self):
+        sequence = self._sequence
+        self._sequence = (sequence + 1) & 0xffff
+        return sequence
+
+    def in_flight(self):
+        count = 0
+        for i in range(self.window):
+            if self._states[i] != FREE:
+                count += 1
+        return count
+
+    def send(self, buffer, length=None):
+        # takes a copy of the frame; True if it went on air right away
+        length = len(buffer) if length is None else length
+        if self._count == self.window:
+            if self._states[self._tail] != FREE:
+                self.given_up += 1
+            self._states[self._tail] = FREE
+            self._advance()
+
+        index = (self._tail + self._count) % self.window
+        self._count += 1
+        memoryview(self._frames[index])[:length] = memoryview(buffer)[:length]
+        self._lengths[index] = length
+        self._sequences[index] = codec.decode_header(buffer)[1]
+        self._attempts[index] = 0
+        self._states[index] = QUEUED
+        self._retry_tokens = min(self._retry_tokens + self.retry_ratio, self.window)
+
+        if self._transmit(index):
+            self._states[index] = SENT
+            return True
+        return False
+
+    def handle_downlink(self, view):
+        # feed every frame heard in the receive window, True if it was our ACK
+        node_id, sequence, msg_type = codec.decode_header(view)
+        if msg_type != codec.MSG_ACK or node_id != self.node_id:
+            return False
+        latest, bitmap = codec.ACK.decode(view)
+        if self.link:
+            self.link.downlink_heard()
+        self.acknowledge(latest, bitmap)
+        return True
+
+    def acknowledge(self, latest, bitmap):
+        # an ACK: latest sequence number the hub heard, bitmap of the ACK_BITS before
+        for i in range(self.window):
+            state = self._states[i]
+            if state != SENT and state != LOST:
+                continue
+            distance = sequence_distance(latest, self._sequences[i])
+            if distance < 0:
+                continue  # sent after the hub built the ACK
+            if distance == 0 or (distance <= ACK_BITS and bitmap & (1 << (distance - 1))):
+                self._states[i] = FREE
+                self.acked += 1
+            else:
+                self._states[i] = LOST
+        self._advance()
+
+    def service(self, now=None):
+        # retransmit what is lost or timed out, send what waited for budget;
+        # returns the number of transmissions.
+        now = ticks_ms() if now is None else now
+        count = 0
+        for n in range(self._count):
+            i = (self._tail + n) % self.window
+            state = self._states[i]
+            if state == SENT and ticks_diff(now, self._sent_at[i]) >= self.ack_timeout_ms:
+                state = self._states[i] = LOST
+
+            if state == LOST:
+                if self._attempts[i] >= self.max_attempts:
+                    self._states[i] = FREE
+                    self.given_up += 1
+                    continue
+                if self._retry_tokens < 1:
+                    continue
+                if self._transmit(i):
+                    self._retry_tokens -= 1
+                    self._states[i] = SENT
+                    self.retransmitted += 1
+                    count += 1
+            elif state == QUEUED:
+                if self._transmit(i):
+                    self._states[i] = SENT
+                    count += 1
+        self._advance()
+        return count
+
+    def _advance(self):
+        while self._count and self._states[self._tail] == FREE:
+            self._tail = (self._tail + 1) % self.window
+            self._count -= 1
+
+    def _transmit(self, index):
+        lora = self.lora
+        length = self._lengths[index]
+        if self.scheduler:
+            frequency = lora.parameters['frequency']
+            airtime = lora.timeOnAir(length)
+            delay = self.scheduler.delay_ms(frequency, airtime)
+            if delay < 0:
+                self._states[index] = FREE
+                self.given_up += 1
+                return False
+            if delay > 0:
+                return False
+            self.scheduler.record(frequency, airtime)
+
+        lora.beginPacket()
+        lora.write(memoryview(self._frames[index])[:length])
+        lora.endPacket()
+        self._attempts[index] += 1
+        self._sent_at[index] = ticks_ms()
+        self.sent += 1
+        if self.link:
+            self.link.uplink_sent()
+        return True
+
+    def stats(self):
+        return {'sent': self.sent, 'retransmitted': self.retransmitted, 'acked': self.acked,
+                'given_up': self.given_up, 'in_flight': self.in_flight()}
@@ -23,15 +23,35 @@ SET_PRECHARGE       = const(0xd9)
 SET_VCOM_DESEL      = const(0xdb)
 SET_CHARGE_PUMP     = const(0x8d)
 
+# I2C bytes to open an address window (control byte, SET_COL_ADDR and
+# SET_PAGE_ADDR with their arguments), plus one control byte per data write
+WINDOW_BYTES        = const(7)
+
 class SSD1306:
+    '''
+    Draw calls mark the pages and column range they touch, show() sends
+    only what changed: per dirty page, the columns that differ from what the
+    display already holds (a copy of the last frame sent is kept), each
+    through its own SET_COL_ADDR / SET_PAGE_ADDR window. bytes_saved counts
+    the I2C bytes this avoided against full refreshes; when the windows
+    would cost more, the whole frame goes in one.
+    '''
+
     def __init__(self, width, height, external_vcc):
         self.width = width
         self.height = height
         self.external_vcc = external_vcc
         self.pages = self.height // 8
-        # Note the subclass must initialize self.framebuf to a framebuffer.
+        # Note the subclass must initialize self.framebuf to a framebuffer,
+        # and self.data to a memoryview of the pixel bytes behind it.
         # This is necessary because the underlying data buffer is different
         # between I2C and SPI implementations (I2C needs an extra byte).
+        self._sent = bytearray(self.pages * width)  # what the display RAM holds
+        self._dirty_x0 = bytearray(b'\xff' * self.pages)  # x0 > x1: page clean
+        self._dirty_x1 = bytearray(self.pages)
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self.invalidate()
         self.poweron()
         self.init_display()
 
@@ -72,47 +92,132 @@ class SSD1306:
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
+    def invalidate(self):
+        # next show() sends the whole frame, e.g. after the display was reset
+        self._sent_valid = False
+        self.mark(0, 0, self.width, self.height)
+
+    def mark(self, x, y, w, h):
+        # flag the pages and columns of a drawn rectangle as dirty
+        x0 = max(x, 0)
+        x1 = min(x + w, self.width) - 1
+        y0 = max(y, 0)
+        y1 = min(y + h, self.height) - 1
+        if x0 > x1 or y0 > y1:
+            return
+        for page in range(y0 >> 3, (y1 >> 3) + 1):
+            if self._dirty_x0[page] > self._dirty_x1[page]:
+                self._dirty_x0[page] = x0
+                self._dirty_x1[page] = x1
+            else:
+                self._dirty_x0[page] = min(self._dirty_x0[page], x0)
+                self._dirty_x1[page] = max(self._dirty_x1[page], x1)
+
     def show(self):
         x0 = 0
-        x1 = self.width - 1
         if self.width == 64:
             # displays with width of 64 pixels are shifted by 32
             x0 += 32
-            x1 += 32
+        width = self.width
+        data = self.data
+        sent = self._sent
+        dirty_x0 = self._dirty_x0
+        dirty_x1 = self._dirty_x1
+        full = WINDOW_BYTES + 1 + self.pages * width
+
+        # narrow every dirty page down to the columns that really changed
+        cost = 0
+        for page in range(self.pages):
+            a = dirty_x0[page]
+            b = dirty_x1[page]
+            if a > b:
+                continue
+            if self._sent_valid:
+                offset = page * width
+                while a <= b and data[offset + a] == sent[offset + a]:
+                    a += 1
+                while b >= a and data[offset + b] == sent[offset + b]:
+                    b -= 1
+                dirty_x0[page] = a
+                dirty_x1[page] = b
+            if a <= b:
+                cost += WINDOW_BYTES + 1 + b + 1 - a
+
+        if cost >= full:
+            # windows would cost more than one full frame
+            self.write_window(x0, x0 + width - 1, 0, self.pages - 1)
+            self.write_data(data)
+            sent[:] = data
+            cost = full
+        else:
+            for page in range(self.pages):
+                a = dirty_x0[page]
+                b = dirty_x1[page]
+                if a > b:
+                    continue
+                offset = page * width
+                self.write_window(x0 + a, x0 + b, page, page)
+                self.write_data(data[offset + a:offset + b + 1])
+                sent[offset + a:offset + b + 1] = data[offset + a:offset + b + 1]
+
+        for page in range(self.pages):
+            dirty_x0[page] = 255
+            dirty_x1[page] = 0
+        self._sent_valid = True
+        self.bytes_sent += cost
+        self.bytes_saved += full - cost
+
+    def write_window(self, x0, x1, page0, page1):
         self.write_cmd(SET_COL_ADDR)
         self.write_cmd(x0)
         self.write_cmd(x1)
         self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_framebuf()
+        self.write_cmd(page0)
+        self.write_cmd(page1)
+
+    def stats(self):
+        return {'bytes_sent': self.bytes_sent, 'bytes_saved': self.bytes_saved}
 
     def fill(self, col):
         self.framebuf.fill(col)
+        self.mark(0, 0, self.width, self.height)
 
     def pixel(self, x, y, col):
         self.framebuf.pixel(x, y, col)
+        self.mark(x, y, 1, 1)
 
     def scroll(self, dx, dy):
         self.framebuf.scroll(dx, dy)
+        self.mark(0, 0, self.width, self.height)
 
     def text(self, string, x, y, col=1):
         self.framebuf.text(string, x, y, col)
+        self.mark(x, y, 8 * len(string), 8)
 
     def hline(self, x, y, w, c=1):
         self.framebuf.hline(x, y, w, c)
+        self.mark(x, y, w, 1)
 
     def vline(self, x, y, h, c=1):
         self.framebuf.vline(x, y, h, c)
+        self.mark(x, y, 1, h)
 
     def line(self, x1, y1, x2, y2, c=1):
         self.framebuf.line(x1, y1, x2, y2, c)
+        self.mark(min(x1, x2), min(y1, y2), abs(x2 - x1) + 1, abs(y2 - y1) + 1)
 
     def rect(self, x, y, w, h, c=1):
         self.framebuf.rect(x, y, w, h, c)
+        self.mark(x, y, w, h)
 
     def fill_rect(self, x, y, w, h, c=1):
         self.framebuf.fill_rect(x, y, w, h, c)
+        self.mark(x, y, w, h)
+
+    def blit(self, fbuf, x, y, w, h, key=-1):
+        # w, h: size of fbuf, a FrameBuffer cannot tell
+        self.framebuf.blit(fbuf, x, y, key)
+        self.mark(x, y, w, h)
 
 class SSD1306_I2C(SSD1306):
     def __init__(self, width, height, i2c, addr=0x3c, external_vcc=False):
@@ -126,7 +231,10 @@ class SSD1306_I2C(SSD1306):
         # buffer).
         self.buffer = bytearray(((height // 8) * width) + 1)
         self.buffer[0] = 0x40  # Set first byte of data buffer to Co=0, D/C=1
-        self.framebuf = framebuf.FrameBuffer1(memoryview(self.buffer)[1:], width, height)
+        self.data = memoryview(self.buffer)[1:]
+        self.framebuf = framebuf.FrameBuffer1(self.data, width, height)
+        self._window = bytearray(7)
+        self._data_prefix = b'\x40'
         super().__init__(width, height, external_vcc)
 
     def write_cmd(self, cmd):
@@ -139,6 +247,21 @@ class SSD1306_I2C(SSD1306):
         # hardware I2C interfaces.
         self.i2c.writeto(self.addr, self.buffer)
 
+    def write_window(self, x0, x1, page0, page1):
+        # both address commands in one transaction, Co=0 D/C#=0 then the stream
+        window = self._window
+        window[0] = 0x00
+        window[1] = SET_COL_ADDR
+        window[2] = x0
+        window[3] = x1
+        window[4] = SET_PAGE_ADDR
+        window[5] = page0
+        window[6] = page1
+        self.i2c.writeto(self.addr, window)
+
+    def write_data(self, view):
+        self.i2c.writevto(self.addr, (self._data_prefix, view))
+
     def poweron(self):
         pass
 
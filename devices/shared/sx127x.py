@@ -1,6 +1,14 @@
 from time import sleep
 from micropython import const
-import gc
+from memory import ThresholdCollect
+from airtime import time_on_air_ms, low_data_rate_optimize, symbol_time_ms
+from timeline import TIMELINE
+from clock import ticks_ms, ticks_diff
+
+try:
+    from urandom import getrandbits
+except ImportError:
+    from random import getrandbits
 
 PA_OUTPUT_RFO_PIN = const(0)
 PA_OUTPUT_PA_BOOST_PIN = const(1)
@@ -25,10 +33,11 @@ REG_FIFO_RX_CURRENT_ADDR = const(0x10)
 REG_IRQ_FLAGS_MASK = const(0x11)
 REG_IRQ_FLAGS = const(0x12)
 REG_RX_NB_BYTES = const(0x13)
+REG_PKT_SNR_VALUE = const(0x19)
 REG_PKT_RSSI_VALUE = const(0x1a)
-REG_PKT_SNR_VALUE = const(0x1b)
 REG_MODEM_CONFIG_1 = const(0x1d)
 REG_MODEM_CONFIG_2 = const(0x1e)
+REG_SYMB_TIMEOUT_LSB = const(0x1f)
 REG_PREAMBLE_MSB = const(0x20)
 REG_PREAMBLE_LSB = const(0x21)
 REG_PAYLOAD_LENGTH = const(0x22)
@@ -39,20 +48,24 @@ REG_DETECTION_OPTIMIZE = const(0x31)
 REG_DETECTION_THRESHOLD = const(0x37)
 REG_SYNC_WORD = const(0x39)
 REG_DIO_MAPPING_1 = const(0x40)
+REG_DIO_MAPPING_2 = const(0x41)
 REG_VERSION = const(0x42)
 
 # modes
-MODE_LONG_RANGE_MODE = const(0x80  # bit 7: 1 => LoRa mode)
+MODE_LONG_RANGE_MODE = const(0x80)  # bit 7: 1 => LoRa mode
 MODE_SLEEP=const(0x00)
 MODE_STDBY=const(0x01)
 MODE_TX=const(0x03)
 MODE_RX_CONTINUOUS=const(0x05)
 MODE_RX_SINGLE=const(0x06)
+MODE_CAD=const(0x07)
 
 # PA config
 PA_BOOST=const(0x80)
 
 # IRQ masks
+IRQ_CAD_DETECTED_MASK=const(0x01)
+IRQ_CAD_DONE_MASK=const(0x04)
 IRQ_TX_DONE_MASK=const(0x08)
 IRQ_PAYLOAD_CRC_ERROR_MASK=const(0x20)
 IRQ_RX_DONE_MASK=const(0x40)
@@ -61,6 +74,25 @@ IRQ_RX_TIME_OUT_MASK=const(0x80)
 # Buffer size
 MAX_PKT_LENGTH=const(255)
 
+# listen before talk
+LBT_MAX_ATTEMPTS=const(6)
+LBT_BACKOFF_MS=const(50)  # first contention window, doubled after every busy channel
+CAD_TIMEOUT_SYMBOLS=const(4)  # a CAD cycle takes about 2, give up on CAD_DONE after that
+
+# configuration registers mirrored in the shadow cache: only the host changes
+# them, so their last written value is always what the chip holds.
+SHADOWED_REGISTERS=bytearray(128)
+for _address in (REG_FRF_MSB, REG_FRF_MID, REG_FRF_LSB, REG_PA_CONFIG, REG_LNA,
+                 REG_FIFO_TX_BASE_ADDR, REG_FIFO_RX_BASE_ADDR,
+                 REG_MODEM_CONFIG_1, REG_MODEM_CONFIG_2, REG_MODEM_CONFIG_3, REG_SYMB_TIMEOUT_LSB,
+                 REG_PREAMBLE_MSB, REG_PREAMBLE_LSB,
+                 REG_DETECTION_OPTIMIZE, REG_DETECTION_THRESHOLD,
+                 REG_SYNC_WORD, REG_DIO_MAPPING_1):
+    SHADOWED_REGISTERS[_address]=1
+
+SPAN_INIT=TIMELINE.span_id('SX127x.init')
+SPAN_READ_PAYLOAD=TIMELINE.span_id('read_payload')
+
 
 class SX127x:
     def __init__(self,
@@ -68,17 +100,31 @@ class SX127x:
                  parameters={'frequency': 915E6, 'tx_power_level': 20, 'signal_bandwidth': 125E3,
                              'spreading_factor': 12, 'coding_rate': 5, 'preamble_length': 8,
                              'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': False},
-                 onReceive=None):
+                 onReceive=None,
+                 memory_policy=None):
 
         self.name=name
         self.parameters=parameters
         self._onReceive=onReceive
         self._lock=False
+        self.memory_policy=memory_policy if memory_policy else ThresholdCollect()
+        self._cad_done=False
+        self.lbt_stats={'sends': 0, 'retries': 0, 'busy': 0, 'dropped': 0, 'cad_timeouts': 0}
+        self.last_send_retries=0
+        self.last_send_busy=0
+        self._rx_buffer=bytearray(MAX_PKT_LENGTH)
+        self._shadow=bytearray(128)
+        self._shadow_valid=bytearray(128)
+        self._payload_length=0
 
     def init(self, parameters=None):
+        started=TIMELINE.begin()
         if parameters:
             self.parameters=parameters
 
+        # chip may have been reset, forget everything cached about it.
+        self.resyncShadow()
+
         init_try=True
         re_try=0
         # check version
@@ -98,10 +144,10 @@ class SX127x:
         self.setSignalBandwidth(self.parameters['signal_bandwidth'])
 
         # set LNA boost
-        self.writeRegister(REG_LNA, self.readRegister(REG_LNA) | 0x03)
+        self.updateRegister(REG_LNA, self.readShadow(REG_LNA) | 0x03)
 
         # set auto AGC
-        self.writeRegister(REG_MODEM_CONFIG_3, 0x04)
+        self.updateRegister(REG_MODEM_CONFIG_3, 0x04)
 
         self.setTxPower(self.parameters['tx_power_level'])
         self._implicitHeaderMode=None
@@ -112,17 +158,54 @@ class SX127x:
         self.setSyncWord(self.parameters['sync_word'])
         self.enableCRC(self.parameters['enable_CRC'])
 
-        # set LowDataRateOptimize flag if symbol time > 16ms (default disable on reset)
-        # self.writeRegister(REG_MODEM_CONFIG_3, self.readRegister(REG_MODEM_CONFIG_3) & 0xF7)  # default disable on reset
-        if 1000 / (self.parameters['signal_bandwidth'] / 2**self.parameters['spreading_factor']) > 16:
-            self.writeRegister(REG_MODEM_CONFIG_3,
-                               self.readRegister(REG_MODEM_CONFIG_3) | 0x08)
+        self.setLowDataRateOptimize(self.needsLowDataRateOptimize())
 
         # set base addresses
-        self.writeRegister(REG_FIFO_TX_BASE_ADDR, FifoTxBaseAddr)
-        self.writeRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
+        self.updateRegister(REG_FIFO_TX_BASE_ADDR, FifoTxBaseAddr)
+        self.updateRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
 
         self.standby()
+        TIMELINE.end(SPAN_INIT, started)
+
+    def configure(self, parameters):
+        # apply a (partial) parameter set as one diff against the shadow
+        # registers, only changed registers go over SPI. Call in sleep or
+        # standby mode, as required by the chip for modem changes.
+        self.parameters=dict(self.parameters)
+        self.parameters.update(parameters)
+
+        if 'frequency' in parameters:
+            self.setFrequency(parameters['frequency'])
+        if 'signal_bandwidth' in parameters:
+            self.setSignalBandwidth(parameters['signal_bandwidth'])
+        if 'tx_power_level' in parameters:
+            self.setTxPower(parameters['tx_power_level'])
+        if 'implicitHeader' in parameters:
+            self.implicitHeaderMode(parameters['implicitHeader'])
+        if 'spreading_factor' in parameters:
+            self.setSpreadingFactor(parameters['spreading_factor'])
+        if 'coding_rate' in parameters:
+            self.setCodingRate(parameters['coding_rate'])
+        if 'preamble_length' in parameters:
+            self.setPreambleLength(parameters['preamble_length'])
+        if 'sync_word' in parameters:
+            self.setSyncWord(parameters['sync_word'])
+        if 'enable_CRC' in parameters:
+            self.enableCRC(parameters['enable_CRC'])
+
+        self.setLowDataRateOptimize(self.needsLowDataRateOptimize())
+
+    def needsLowDataRateOptimize(self):
+        # LowDataRateOptimize is mandated when the symbol time exceeds 16ms
+        return low_data_rate_optimize(self.parameters)
+
+    def timeOnAir(self, payloadLength, implicitHeader=None):
+        # milliseconds on air for a payload with the live parameters
+        parameters=self.parameters
+        if implicitHeader is not None and implicitHeader != parameters['implicitHeader']:
+            parameters=dict(parameters)
+            parameters['implicitHeader']=implicitHeader
+        return time_on_air_ms(parameters, payloadLength)
 
     def beginPacket(self, implicitHeaderMode=False):
         self.standby()
@@ -131,6 +214,7 @@ class SX127x:
         # reset FIFO address and paload length
         self.writeRegister(REG_FIFO_ADDR_PTR, FifoTxBaseAddr)
         self.writeRegister(REG_PAYLOAD_LENGTH, 0)
+        self._payload_length=0
 
     def endPacket(self):
         # put in TX mode
@@ -146,32 +230,110 @@ class SX127x:
         self.collect_garbage()
 
     def write(self, buffer):
-        currentLength=self.readRegister(REG_PAYLOAD_LENGTH)
+        currentLength=self._payload_length
         size=len(buffer)
 
         # check size
         size=min(size, (MAX_PKT_LENGTH - FifoTxBaseAddr - currentLength))
 
-        # write data
-        for i in range(size):
-            self.writeRegister(REG_FIFO, buffer[i])
+        # write data, streamed into the FIFO in a single burst
+        if size > 0:
+            self.write_burst(self.pin_ss, REG_FIFO | 0x80, memoryview(buffer)[:size])
 
         # update length
-        self.writeRegister(REG_PAYLOAD_LENGTH, currentLength + size)
+        self._payload_length=currentLength + size
+        self.writeRegister(REG_PAYLOAD_LENGTH, self._payload_length)
         return size
 
     def aquire_lock(self, lock=False):
         self._lock=False
 
-    def println(self, string, implicitHeader=False):
+    def println(self, string, implicitHeader=False, listen_before_talk=False):
         self.aquire_lock(True)  # wait until RX_Done, lock and begin writing.
 
-        self.beginPacket(implicitHeader)
-        self.write(string.encode())
-        self.endPacket()
+        if listen_before_talk:
+            self.sendListenBeforeTalk(string.encode(), implicitHeader)
+        else:
+            self.beginPacket(implicitHeader)
+            self.write(string.encode())
+            self.endPacket()
 
         self.aquire_lock(False)  # unlock when done writing
 
+    def channelActivityDetect(self):
+        # run one CAD cycle (~2 symbols), True if a LoRa preamble is on the channel.
+        # a CAD_DONE that does not come within CAD_TIMEOUT_SYMBOLS counts as busy.
+        self.standby()
+        self.writeRegister(REG_IRQ_FLAGS, IRQ_CAD_DONE_MASK | IRQ_CAD_DETECTED_MASK)
+        limit=int(CAD_TIMEOUT_SYMBOLS * symbol_time_ms(self.parameters)) + 1
+
+        if self.pin_CadDone:
+            # DIO3 => CadDone, wait on the interrupt instead of the SPI bus
+            self._cad_done=False
+            self.updateRegister(REG_DIO_MAPPING_1, self.readShadow(REG_DIO_MAPPING_1) & 0xfc)
+            self.pin_CadDone.set_handler_for_irq_on_rising_edge(self.handleOnCadDone)
+            self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_CAD)
+            started=ticks_ms()
+            while not self._cad_done and ticks_diff(ticks_ms(), started) <= limit:
+                pass
+            self.pin_CadDone.detach_irq()
+            done=self._cad_done
+        else:
+            # DIO3 not wired, poll the IRQ flags
+            self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_CAD)
+            started=ticks_ms()
+            while True:
+                done=self.readRegister(REG_IRQ_FLAGS) & IRQ_CAD_DONE_MASK
+                if done or ticks_diff(ticks_ms(), started) > limit:
+                    break
+                sleep(0.001)
+
+        if not done:
+            # DIO3 not actually wired or the chip stuck, do not transmit blind
+            self.standby()
+            self.getIrqFlags()
+            self.lbt_stats['cad_timeouts'] += 1
+            return True
+
+        # standby automatically on CAD_DONE
+        irqFlags=self.getIrqFlags()
+        return bool(irqFlags & IRQ_CAD_DETECTED_MASK)
+
+    def handleOnCadDone(self, event_source):
+        self._cad_done=True
+
+    def backoffMs(self, attempt, backoff_ms=LBT_BACKOFF_MS):
+        # random delay from an exponentially growing contention window
+        window=backoff_ms << min(attempt, 6)
+        return getrandbits(16) % window + 1
+
+    def sendListenBeforeTalk(self, buffer, implicitHeader=False,
+                             max_attempts=LBT_MAX_ATTEMPTS, backoff_ms=LBT_BACKOFF_MS):
+        # transmit only on a clear channel, backing off while it is busy.
+        # returns False if the channel stayed busy for max_attempts CAD cycles.
+        busy=0
+        for attempt in range(max_attempts):
+            if not self.channelActivityDetect():
+                self.beginPacket(implicitHeader)
+                self.write(buffer)
+                self.endPacket()
+                self._countSend(attempt, busy, True)
+                return True
+
+            busy += 1
+            if attempt + 1 < max_attempts:
+                sleep(self.backoffMs(attempt, backoff_ms) / 1000)
+
+        self._countSend(max_attempts - 1, busy, False)
+        return False
+
+    def _countSend(self, retries, busy, sent):
+        self.last_send_retries=retries
+        self.last_send_busy=busy
+        self.lbt_stats['retries'] += retries
+        self.lbt_stats['busy'] += busy
+        self.lbt_stats['sends' if sent else 'dropped'] += 1
+
     def getIrqFlags(self):
         irqFlags=self.readRegister(REG_IRQ_FLAGS)
         self.writeRegister(REG_IRQ_FLAGS, irqFlags)
@@ -181,7 +343,8 @@ class SX127x:
         return (self.readRegister(REG_PKT_RSSI_VALUE) - (164 if self._frequency < 868E6 else 157))
 
     def packetSnr(self):
-        return (self.readRegister(REG_PKT_SNR_VALUE)) * 0.25
+        snr=self.readRegister(REG_PKT_SNR_VALUE)  # two's complement
+        return (snr - 256 if snr > 127 else snr) * 0.25
 
     def standby(self):
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
@@ -193,12 +356,12 @@ class SX127x:
         if (outputPin == PA_OUTPUT_RFO_PIN):
             # RFO
             level=min(max(level, 0), 14)
-            self.writeRegister(REG_PA_CONFIG, 0x70 | level)
+            self.updateRegister(REG_PA_CONFIG, 0x70 | level)
 
         else:
             # PA BOOST
             level=min(max(level, 2), 17)
-            self.writeRegister(REG_PA_CONFIG, PA_BOOST | (level - 2))
+            self.updateRegister(REG_PA_CONFIG, PA_BOOST | (level - 2))
 
     def setFrequency(self, frequency):
         self._frequency=frequency
@@ -210,15 +373,15 @@ class SX127x:
                 868E6: (217, 0, 0),
                 915E6: (228, 192, 0)}
 
-        self.writeRegister(REG_FRF_MSB, frfs[frequency][0])
-        self.writeRegister(REG_FRF_MID, frfs[frequency][1])
-        self.writeRegister(REG_FRF_LSB, frfs[frequency][2])
+        self.updateRegister(REG_FRF_MSB, frfs[frequency][0])
+        self.updateRegister(REG_FRF_MID, frfs[frequency][1])
+        self.updateRegister(REG_FRF_LSB, frfs[frequency][2])
 
     def setSpreadingFactor(self, sf):
         sf=min(max(sf, 6), 12)
-        self.writeRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
-        self.writeRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
-        self.writeRegister(REG_MODEM_CONFIG_2, (self.readRegister(
+        self.updateRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
+        self.updateRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
+        self.updateRegister(REG_MODEM_CONFIG_2, (self.readShadow(
             REG_MODEM_CONFIG_2) & 0x0f) | ((sf << 4) & 0xf0))
 
     def setSignalBandwidth(self, sbw):
@@ -233,26 +396,31 @@ class SX127x:
 
         # bw = bins.index(sbw)
 
-        self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(
+        self.updateRegister(REG_MODEM_CONFIG_1, (self.readShadow(
             REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
 
     def setCodingRate(self, denominator):
         denominator=min(max(denominator, 5), 8)
         cr=denominator - 4
-        self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(
+        self.updateRegister(REG_MODEM_CONFIG_1, (self.readShadow(
             REG_MODEM_CONFIG_1) & 0xf1) | (cr << 1))
 
     def setPreambleLength(self, length):
-        self.writeRegister(REG_PREAMBLE_MSB,  (length >> 8) & 0xff)
-        self.writeRegister(REG_PREAMBLE_LSB,  (length >> 0) & 0xff)
+        self.updateRegister(REG_PREAMBLE_MSB,  (length >> 8) & 0xff)
+        self.updateRegister(REG_PREAMBLE_LSB,  (length >> 0) & 0xff)
 
     def enableCRC(self, enable_CRC=False):
-        modem_config_2=self.readRegister(REG_MODEM_CONFIG_2)
+        modem_config_2=self.readShadow(REG_MODEM_CONFIG_2)
         config=modem_config_2 | 0x04 if enable_CRC else modem_config_2 & 0xfb
-        self.writeRegister(REG_MODEM_CONFIG_2, config)
+        self.updateRegister(REG_MODEM_CONFIG_2, config)
 
     def setSyncWord(self, sw):
-        self.writeRegister(REG_SYNC_WORD, sw)
+        self.updateRegister(REG_SYNC_WORD, sw)
+
+    def setLowDataRateOptimize(self, enable=False):
+        modem_config_3=self.readShadow(REG_MODEM_CONFIG_3)
+        config=modem_config_3 | 0x08 if enable else modem_config_3 & 0xf7
+        self.updateRegister(REG_MODEM_CONFIG_3, config)
 
     # def enable_Rx_Done_IRQ(self, enable = True):
         # if enable:
@@ -267,9 +435,9 @@ class SX127x:
     def implicitHeaderMode(self, implicitHeaderMode=False):
         if self._implicitHeaderMode != implicitHeaderMode:  # set value only if different.
             self._implicitHeaderMode=implicitHeaderMode
-            modem_config_1=self.readRegister(REG_MODEM_CONFIG_1)
+            modem_config_1=self.readShadow(REG_MODEM_CONFIG_1)
             config=modem_config_1 | 0x01 if implicitHeaderMode else modem_config_1 & 0xfe
-            self.writeRegister(REG_MODEM_CONFIG_1, config)
+            self.updateRegister(REG_MODEM_CONFIG_1, config)
 
     def onReceive(self, callback):
         self._onReceive=callback
@@ -282,11 +450,25 @@ class SX127x:
             else:
                 self.pin_RxDone.detach_irq()
 
-    def receive(self, size=0):
+    def receive(self, size=0, timeoutMs=0):
+        # continuous reception, or with timeoutMs a single packet: the radio
+        # raises RX_TIME_OUT and goes to standby if no preamble starts in time.
         self.implicitHeaderMode(size > 0)
         if size > 0:
             self.writeRegister(REG_PAYLOAD_LENGTH, size & 0xff)
 
+        if timeoutMs:
+            symbols=min(max(-(-timeoutMs // symbol_time_ms(self.parameters)), 4), 1023)
+            symbols=int(symbols)
+            self.updateRegister(REG_MODEM_CONFIG_2, (self.readShadow(
+                REG_MODEM_CONFIG_2) & 0xfc) | (symbols >> 8))
+            self.updateRegister(REG_SYMB_TIMEOUT_LSB, symbols & 0xff)
+            self.writeRegister(REG_IRQ_FLAGS, IRQ_RX_DONE_MASK | IRQ_RX_TIME_OUT_MASK | IRQ_PAYLOAD_CRC_ERROR_MASK)
+            self.writeRegister(REG_FIFO_ADDR_PTR, FifoRxBaseAddr)
+            self.writeRegister(
+                REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_SINGLE)
+            return
+
         # The last packet always starts at FIFO_RX_CURRENT_ADDR
         # no need to reset FIFO_ADDR_PTR
         self.writeRegister(
@@ -359,9 +541,9 @@ class SX127x:
             self.writeRegister(
                 REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_SINGLE)
 
-    def read_payload(self):
+    def readinto(self, buffer):
+        started=TIMELINE.begin()
         # set FIFO address to current RX address
-        # fifo_rx_current_addr = self.readRegister(REG_FIFO_RX_CURRENT_ADDR)
         self.writeRegister(REG_FIFO_ADDR_PTR,
                            self.readRegister(REG_FIFO_RX_CURRENT_ADDR))
 
@@ -369,12 +551,22 @@ class SX127x:
         packetLength=self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
             self.readRegister(REG_RX_NB_BYTES)
 
-        payload=bytearray()
-        for i in range(packetLength):
-            payload.append(self.readRegister(REG_FIFO))
+        # stream the FIFO into the caller's buffer in a single burst
+        size=min(packetLength, len(buffer))
+        if size > 0:
+            self.read_burst(self.pin_ss, REG_FIFO & 0x7f, memoryview(buffer)[:size])
+        TIMELINE.end(SPAN_READ_PAYLOAD, started)
+        return size
+
+    def read_payload_view(self):
+        # valid until the next packet is read, copy it if it must be kept.
+        size=self.readinto(self._rx_buffer)
+        return memoryview(self._rx_buffer)[:size]
 
+    def read_payload(self):
+        payload=bytes(self.read_payload_view())
         self.collect_garbage()
-        return bytes(payload)
+        return payload
 
     def readRegister(self, address, byteorder='big', signed=False):
         response=self.transfer(self.pin_ss, address & 0x7f)
@@ -382,7 +574,28 @@ class SX127x:
 
     def writeRegister(self, address, value):
         self.transfer(self.pin_ss, address | 0x80, value)
+        if SHADOWED_REGISTERS[address]:
+            self._shadow[address]=value
+            self._shadow_valid[address]=1
+
+    def readShadow(self, address):
+        # cached value of a configuration register, read over SPI only once.
+        if not self._shadow_valid[address]:
+            self._shadow[address]=self.readRegister(address)
+            self._shadow_valid[address]=SHADOWED_REGISTERS[address]
+        return self._shadow[address]
+
+    def updateRegister(self, address, value):
+        # write a configuration register only if the chip does not hold value already.
+        if self._shadow_valid[address] and self._shadow[address] == value:
+            return False
+        self.writeRegister(address, value)
+        return True
+
+    def resyncShadow(self):
+        for address in range(128):
+            self._shadow_valid[address]=0
 
     def collect_garbage(self):
-        gc.collect()
-        # print('[Memory - free: {}   allocated: {}]'.format(gc.mem_free(), gc.mem_alloc()))
+        # per packet hook, the memory policy decides whether to gc.collect()
+        self.memory_policy.after_packet()
@@ -0,0 +1,239 @@
+'''
+Beacon time sync and TDMA slots.
+
+The hub broadcasts a BEACON frame every period_ms on each of its radios:
+the hub time at which it went on air, the period, and a page of the slot
+map of that radio's channel, (node id, offset ms, width ms) per slot. The
+slot map rotates through its pages from beacon to beacon.
+
+Nodes discipline a BeaconClock with every beacon heard (hub time + the
+beacon's time on air, against local ticks on reception) and, once the map
+shows their slot, transmit only inside it: offset ms after each beacon,
+guard_ms into the slot. The slot also holds the node's receive window
+after the uplink and the hub's answer in it, so it is
+
+    guard | uplink | receive window + DOWNLINK time on air | guard
+
+wide, and nothing the hub sends to one node runs into the next slot.
+Channels (frequency / spreading factor) are independent, each has its
+own slots.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from airtime import time_on_air_ms
+from clock import ticks_ms, ticks_diff, ticks_add
+from downlink import RX_WINDOW_MS, DOWNLINK_SIZE
+import codec
+
+SLOT_FORMAT = '<HIH'  # node id, offset ms from the beacon, width ms
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+MAX_SLOTS_PER_BEACON = (codec.MAX_FRAME_SIZE - codec.BEACON.size) // SLOT_SIZE
+
+# largest uplink frame a slot has room for, nodes cap their frames at it.
+# codec.MAX_FRAME_SIZE (the SX127x FIFO) would amortise the header over more
+# readings, but every slot is sized for it: at SF12 / 125 kHz 32 bytes take
+# 1.8 s on air, 255 bytes 9 s, so a period would hold a fifth of the nodes.
+SLOT_PAYLOAD_SIZE = 32
+
+REBASE_MS = 3600 * 1000  # well inside the range ticks_diff can span
+MAX_RATE_ERROR = 0.001   # 1000 ppm, anything beyond is not drift
+
+
+class BeaconClock:
+    '''
+    Local ms ticks mapped onto the hub clock: an offset from the last
+    beacon plus the clock rate against the hub, smoothed over beacons, so
+    drift is compensated between beacons. On the hub itself discipline it
+    once from the wall clock.
+    '''
+
+    def __init__(self, smoothing=0.25):
+        self.smoothing = smoothing
+        self.synced = False
+        self.beacons = 0
+        self.last_error_ms = 0
+        self._rate = 1.0
+        self._sync_ms = 0
+        self._sync_ticks = 0
+
+    def discipline(self, hub_ms, ticks):
+        # hub_ms: the hub clock at local ticks
+        if self.synced:
+            self.last_error_ms = hub_ms - self.now_ms(ticks)
+            elapsed = ticks_diff(ticks, self._sync_ticks)
+            if elapsed > 0:
+                rate = (hub_ms - self._sync_ms) / elapsed
+                if abs(rate - 1) < MAX_RATE_ERROR:
+                    self._rate += self.smoothing * (rate - self._rate)
+        self._sync_ms = hub_ms
+        self._sync_ticks = ticks
+        self.synced = True
+        self.beacons += 1
+
+    def now_ms(self, ticks=None):
+        ticks = ticks_ms() if ticks is None else ticks
+        elapsed = ticks_diff(ticks, self._sync_ticks)
+        if elapsed > REBASE_MS:
+            # move the reference forward before ticks wrap out of reach
+            self._sync_ms += int(elapsed * self._rate)
+            self._sync_ticks = ticks
+            elapsed = 0
+        return self._sync_ms + int(elapsed * self._rate)
+
+    def ticks_at(self, hub_ms):
+        # local ticks at which the hub clock reads hub_ms
+        return ticks_add(self._sync_ticks, int((hub_ms - self._sync_ms) / self._rate))
+
+
+class SlotSchedule:
+    '''
+    Hub side: slots per channel, first fit after the beacon window, each
+    the node's time on air for payload_size bytes, then rx_window_ms and the
+    time on air of a downlink_size answer, plus a guard on either side.
+    assign() returns (offset ms, width ms), None if the period is full.
+    '''
+
+    def __init__(self, period_ms=60000, guard_ms=10, payload_size=SLOT_PAYLOAD_SIZE,
+                 rx_window_ms=RX_WINDOW_MS, downlink_size=DOWNLINK_SIZE):
+        self.period_ms = period_ms
+        self.guard_ms = guard_ms
+        self.payload_size = payload_size
+        self.rx_window_ms = rx_window_ms
+        self.downlink_size = downlink_size
+        self._lanes = {}     # channel => sorted list of [offset, width, node id]
+        self._nodes = {}     # node id => channel
+        self._pages = {}     # channel => next slot map index to broadcast
+
+    def _channel(self, parameters):
+        return (parameters['frequency'], parameters['spreading_factor'])
+
+    def beacon_window_ms(self, parameters):
+        return int(time_on_air_ms(parameters, codec.MAX_FRAME_SIZE)) + self.guard_ms
+
+    def slot_width_ms(self, parameters):
+        width = int(time_on_air_ms(parameters, self.payload_size)) + 1 + 2 * self.guard_ms
+        if self.downlink_size:
+            # the answer starts within the receive window and is received to its end
+            width += self.rx_window_ms + int(time_on_air_ms(parameters, self.downlink_size)) + 1
+        return width
+
+    def assign(self, node_id, parameters):
+        slot = self.slot(node_id)
+        channel = self._channel(parameters)
+        if slot and self._nodes[node_id] == channel:
+            return slot
+        self.release(node_id)
+
+        lane = self._lanes.setdefault(channel, [])
+        width = self.slot_width_ms(parameters)
+        offset = self.beacon_window_ms(parameters)
+        index = 0
+        for entry in lane:
+            if entry[0] - offset >= width:
+                break
+            offset = entry[0] + entry[1]
+            index += 1
+        if offset + width > self.period_ms:
+            return None
+        lane.insert(index, [offset, width, node_id])
+        self._nodes[node_id] = channel
+        return offset, width
+
+    def slot(self, node_id):
+        channel = self._nodes.get(node_id)
+        if channel is None:
+            return None
+        for offset, width, node in self._lanes[channel]:
+            if node == node_id:
+                return offset, width
+
+    def release(self, node_id):
+        channel = self._nodes.pop(node_id, None)
+        if channel is not None:
+            lane = self._lanes[channel]
+            for i in range(len(lane)):
+                if lane[i][2] == node_id:
+                    del lane[i]
+                    break
+
+    def utilisation(self, parameters):
+        # share of the period the channel's slots take
+        lane = self._lanes.get(self._channel(parameters), ())
+        return sum(entry[1] for entry in lane) / self.period_ms
+
+    def beacon_into(self, buffer, hub_id, sequence, parameters, hub_ms):
+        # beacon for the channel, hub_ms being the hub clock as it goes on air;
+        # carries the next page of the slot map. Returns the frame length.
+        channel = self._channel(parameters)
+        lane = self._lanes.get(channel, ())
+        count = min(len(lane), MAX_SLOTS_PER_BEACON)
+        start = self._pages.get(channel, 0)
+        if start >= len(lane):
+            start = 0
+        self._pages[channel] = start + count
+
+        size = codec.BEACON.encode_into(buffer, hub_id, sequence,
+                                        (hub_ms // 1000, hub_ms % 1000, self.period_ms, count))
+        for i in range(count):
+            offset, width, node_id = lane[(start + i) % len(lane)]
+            struct.pack_into(SLOT_FORMAT, buffer, size, node_id, offset, width)
+            size += SLOT_SIZE
+        return size
+
+
+class SlotClient:
+    '''
+    Node side: feed every frame heard to handle_beacon() with its reception
+    ticks, then wait_ms() tells how long until the node may transmit.
+    '''
+
+    def __init__(self, node_id, clock=None, guard_ms=10):
+        self.node_id = node_id
+        self.clock = clock if clock else BeaconClock()
+        self.guard_ms = guard_ms
+        self.period_ms = 0
+        self.offset_ms = -1
+        self.width_ms = 0
+        self._beacon_ms = 0
+
+    def handle_beacon(self, view, ticks, lora):
+        # True if the frame was a beacon
+        hub_id, sequence, msg_type = codec.decode_header(view)
+        if msg_type != codec.MSG_BEACON:
+            return False
+        time_s, time_ms, period_ms, count = codec.BEACON.decode(view)
+        beacon_ms = time_s * 1000 + time_ms
+        self.clock.discipline(beacon_ms + int(lora.timeOnAir(len(view))), ticks)
+        self.period_ms = period_ms
+        self._beacon_ms = beacon_ms
+
+        position = codec.BEACON.size
+        for i in range(count):
+            node_id, offset, width = struct.unpack_from(SLOT_FORMAT, view, position)
+            if node_id == self.node_id:
+                self.offset_ms = offset
+                self.width_ms = width
+            position += SLOT_SIZE
+        return True
+
+    def has_slot(self):
+        return self.offset_ms >= 0 and self.clock.synced
+
+    def beacon_wait_ms(self, ticks=None):
+        # ms until the next beacon is due to go on air, -1 before the first one
+        if not self.clock.synced or not self.period_ms:
+            return -1
+        elapsed = self.clock.now_ms(ticks) - self._beacon_ms
+        return -elapsed % self.period_ms
+
+    def wait_ms(self, ticks=None):
+        # ms until the node may transmit in its next slot, -1 without a slot
+        if not self.has_slot():
+            return -1
+        now = self.clock.now_ms(ticks)
+        start = self._beacon_ms + self.offset_ms + self.guard_ms
+        if now > start:
+            start += -(-(now - start) // self.period_ms) * self.period_ms
+        return start - now
@@ -0,0 +1,174 @@
+'''
+Where boot and per-packet time goes: a timeline of named spans, cheap
+enough to leave enabled in production.
+
+Names are registered once, at import, and spans recorded by their id:
+
+    SPAN_INIT = TIMELINE.span_id('SX127x.init')
+    ...
+    started = TIMELINE.begin()
+    ...
+    TIMELINE.end(SPAN_INIT, started)
+
+Events go into a ring of preallocated arrays (span id, start, duration in
+us, from ticks_us), the oldest overwritten, so recording one allocates
+nothing and costs two ticks_us() reads and three array stores. Per span
+id there is also a count and the longest duration seen, which outlive the
+ring. dump() prints the ring over serial, blob_into() packs it for the
+hub to publish:
+
+    version (B) | names (B) | events (H) | recorded (I)
+    names:  id (B) | length (B) | name ...
+    events: id (B) | age us (I) | duration us (I), oldest first
+
+the age being how long before packing the span started, ticks_us() wraps
+too soon for absolute starts to mean anything off the device (ages beyond
+ticks_diff's range, some 9 minutes on the ESP32, wrap as well). Spans may
+be recorded from several threads, a race costs at most one overwritten
+event.
+'''
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from array import array
+from clock import ticks_us, ticks_diff
+
+VERSION = 1
+HEADER_FORMAT = '<BBHI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+EVENT_FORMAT = '<BII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+MAX_NAMES = 32
+
+
+class Timeline:
+    '''
+    A ring of the last size spans. Set enabled to False to stop recording,
+    begin() still hands out ticks then.
+    '''
+
+    def __init__(self, size=256):
+        self.size = size
+        self.enabled = True
+        self.names = []
+        self._ids = array('B', bytes(size))
+        self._starts = array('L', [0] * size)
+        self._durations = array('L', [0] * size)
+        self._next = 0
+        self.recorded = 0  # events ever, beyond size the oldest were overwritten
+        self.counts = array('L', [0] * MAX_NAMES)
+        self.longest = array('L', [0] * MAX_NAMES)
+
+    def span_id(self, name):
+        # the id to record name's spans with, registering it the first time
+        if name in self.names:
+            return self.names.index(name)
+        if len(self.names) >= MAX_NAMES:
+            raise Exception('Timeline holds {} span names at most.'.format(MAX_NAMES))
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def begin(self):
+        return ticks_us()
+
+    def end(self, span, started):
+        # records the span from started (begin()) until now, returns its duration in us
+        if not self.enabled:
+            return 0
+        duration = ticks_diff(ticks_us(), started)
+        if duration < 0:
+            duration = 0
+        i = self._next
+        self._next = i + 1 if i + 1 < self.size else 0
+        self._ids[i] = span
+        self._starts[i] = started
+        self._durations[i] = duration
+        self.recorded += 1
+        self.counts[span] += 1
+        if duration > self.longest[span]:
+            self.longest[span] = duration
+        return duration
+
+    def events(self):
+        # number of events in the ring
+        return self.recorded if self.recorded < self.size else self.size
+
+    def clear(self):
+        self._next = 0
+        self.recorded = 0
+        for i in range(MAX_NAMES):
+            self.counts[i] = 0
+            self.longest[i] = 0
+
+    def _oldest(self):
+        return 0 if self.recorded < self.size else self._next
+
+    def dump(self):
+        # prints the ring, oldest first, then a summary per span name
+        count = self.events()
+        first = self._oldest()
+        now = ticks_us()
+        print('[Timeline - {} events, {} recorded]'.format(count, self.recorded))
+        total = [0] * len(self.names)
+        for n in range(count):
+            i = (first + n) % self.size
+            span = self._ids[i]
+            total[span] += self._durations[i]
+            print('{:>12} {:>10} us  {}'.format(-ticks_diff(now, self._starts[i]), self._durations[i],
+                                                self.names[span]))
+        for span in range(len(self.names)):
+            if self.counts[span]:
+                print('{:<24} count: {}   longest: {} us   in ring: {} us'.format(
+                    self.names[span], self.counts[span], self.longest[span], total[span]))
+
+    def blob_size(self):
+        names = sum(2 + len(name.encode()) for name in self.names)
+        return HEADER_SIZE + names + self.size * EVENT_SIZE
+
+    def blob_into(self, buffer):
+        # packs names and ring into buffer (blob_size() bytes), returns the length
+        count = self.events()
+        first = self._oldest()
+        now = ticks_us()
+        struct.pack_into(HEADER_FORMAT, buffer, 0, VERSION, len(self.names), count,
+                         self.recorded & 0xffffffff)
+        position = HEADER_SIZE
+        for span in range(len(self.names)):
+            name = self.names[span].encode()
+            buffer[position] = span
+            buffer[position + 1] = len(name)
+            buffer[position + 2:position + 2 + len(name)] = name
+            position += 2 + len(name)
+        for n in range(count):
+            i = (first + n) % self.size
+            struct.pack_into(EVENT_FORMAT, buffer, position, self._ids[i],
+                             ticks_diff(now, self._starts[i]), self._durations[i])
+            position += EVENT_SIZE
+        return position
+
+    def blob(self):
+        buffer = bytearray(self.blob_size())
+        return bytes(memoryview(buffer)[:self.blob_into(buffer)])
+
+
+def unpack(blob):
+    # host side: (events recorded, [(name, age us, duration us), ...]), oldest first
+    version, count, events, recorded = struct.unpack_from(HEADER_FORMAT, blob, 0)
+    if version != VERSION:
+        raise Exception('Timeline blob version {} unknown.'.format(version))
+    names = {}
+    position = HEADER_SIZE
+    for n in range(count):
+        span, length = blob[position], blob[position + 1]
+        names[span] = bytes(blob[position + 2:position + 2 + length]).decode()
+        position += 2 + length
+    spans = []
+    for n in range(events):
+        span, age, duration = struct.unpack_from(EVENT_FORMAT, blob, position)
+        position += EVENT_SIZE
+        spans.append((names.get(span, str(span)), age, duration))
+    return recorded, spans
+
+
+TIMELINE = Timeline()
@@ -0,0 +1,46 @@
+import time
+from timeline import TIMELINE
+
+SPAN_WIFI = TIMELINE.span_id('wifi connect')
+_started = None  # ticks_us when association began, until the span is recorded
+
+
+def start_wifi(ssid: str, password: str):
+    # begin associating and return at once, the WiFi stack connects in the background
+    global _started
+    import network
+    sta = network.WLAN(network.STA_IF)
+    if not sta.isconnected():
+        print("connecting to %s wifi network ..." % ssid)
+        _started = TIMELINE.begin()
+        sta.active(True)
+        sta.connect(ssid, password)
+    return sta
+
+
+def _connected(sta):
+    global _started
+    if not sta.isconnected():
+        return False
+    if _started is not None:
+        TIMELINE.end(SPAN_WIFI, _started)
+        _started = None
+    return True
+
+
+def wifi_connected():
+    import network
+    return _connected(network.WLAN(network.STA_IF))
+
+
+def connect_to_wifi(ssid: str, password: str, timeout_ms=15000):
+    # True once connected, False if that took longer than timeout_ms
+    sta = start_wifi(ssid, password)
+    started = time.ticks_ms()
+    while not _connected(sta):
+        if time.ticks_diff(time.ticks_ms(), started) > timeout_ms:
+            print('no connection to %s after %d ms' % (ssid, timeout_ms))
+            return False
+        time.sleep_ms(50)
+    print('network config:', sta.ifconfig())
+    return True